@@ -29,7 +29,8 @@ import math
 import copy
 import base64
 import io
-from PIL import Image, ImageTk
+from PIL import Image, ImageTk, ImageColor
+import numpy as np
 import webbrowser
 import logging
 import traceback
@@ -38,6 +39,7 @@ import threading
 import queue
 from scipy.optimize import linear_sum_assignment
 import shutil
+import multiprocessing
 
 # --- Constants ---
 TILE_WIDTH = 8
@@ -63,6 +65,8 @@ MINIMAP_INITIAL_WIDTH = 256  # Default desired width of minimap window in pixels
 MINIMAP_INITIAL_HEIGHT = 212  # Default desired height of minimap window in pixels
 
 DRAG_THRESHOLD_PIXELS = 3 # Minimum pixels mouse must move to initiate a drag
+STROKE_REFRESH_INTERVAL_MS = 50 # Max refresh rate of dependent views while a paint stroke is active
+PALETTE_CYCLE_DEFAULT_FPS = 8 # Default step rate of the palette cycling preview
 
 RESERVED_BYTES_COUNT = 4 # NEW constant for clarity
 
@@ -121,6 +125,10 @@ WHITE_IDX = 15
 # --- Placeholder Colors ---
 INVALID_TILE_COLOR = "#FF00FF"
 INVALID_SUPERTILE_COLOR = "#00FFFF"
+# Extra slots of the indexed supertile render palette, after the 16 MSX colors
+RENDER_INVALID_TILE_IDX = 16
+RENDER_INVALID_SUPERTILE_IDX = 17
+RENDER_BACKGROUND_IDX = 18 # Viewport/minimap fill, set per image
 
 # --- Grid & Overlay Constants ---
 GRID_COLOR_CYCLE = [
@@ -193,6 +201,37 @@ def get_contrast_color(hex_color):
     except:
         return "#000000"
 
+def get_line_cells(r0, c0, r1, c1):
+    # Bresenham walk between two grid cells, both ends included.
+    cells = []
+    dr, dc = abs(r1 - r0), abs(c1 - c0)
+    step_r = 1 if r1 >= r0 else -1
+    step_c = 1 if c1 >= c0 else -1
+    err = dc - dr
+    r, c = r0, c0
+    while True:
+        cells.append((r, c))
+        if r == r1 and c == c1:
+            break
+        err2 = 2 * err
+        if err2 > -dr:
+            err -= dr
+            c += step_c
+        if err2 < dc:
+            err += dc
+            r += step_r
+    return cells
+
+# Project components are read from a file path or from an in-memory (name, bytes) pair.
+def _component_name(source):
+    return source[0] if isinstance(source, tuple) else os.path.basename(source)
+
+def _component_size(source):
+    return len(source[1]) if isinstance(source, tuple) else os.path.getsize(source)
+
+def _open_component(source):
+    return io.BytesIO(source[1]) if isinstance(source, tuple) else open(source, "rb")
+
 def _debug(message):
     logger.debug(f"{str(message)}")
 
@@ -309,6 +348,33 @@ class PaintPixelCommand(ICommand):
         _debug(f"  <- UNDO PaintPixelCommand for Tile {self.tile_index} ({self.r},{self.c})")
         self._apply_and_update(self.old_value)
 
+class PaintStrokeCommand(ICommand):
+    """Command for a whole pixel stroke in the Tile Editor, committed on release."""
+    def __init__(self, app_ref, tile_index, pixel_changes):
+        super().__init__("Paint Stroke")
+        self.app_ref = app_ref
+        self.tile_index = tile_index
+        self.pixel_changes = dict(pixel_changes) # (r, c) -> (old_value, new_value)
+        _debug(f"[PaintStrokeCommand CREATED] Tile {self.tile_index}, {len(self.pixel_changes)} pixels.")
+
+    def _apply_and_update(self, use_new_values):
+        pattern = tileset_patterns[self.tile_index]
+        for (r, c), (old_value, new_value) in self.pixel_changes.items():
+            pattern[r][c] = new_value if use_new_values else old_value
+        self.app_ref._mark_project_modified()
+        self.app_ref.invalidate_tile_cache(self.tile_index)
+        self.app_ref._request_color_usage_refresh()
+        self.app_ref._request_tile_usage_refresh()
+        self.app_ref._request_supertile_usage_refresh()
+
+    def execute(self):
+        _debug(f"  -> EXECUTE PaintStrokeCommand for Tile {self.tile_index}")
+        self._apply_and_update(True)
+
+    def undo(self):
+        _debug(f"  <- UNDO PaintStrokeCommand for Tile {self.tile_index}")
+        self._apply_and_update(False)
+
 class SetRowColorCommand(ICommand):
     """Command to set the foreground or background color of a tile row."""
     def __init__(self, app_ref, tile_index, row, fg_or_bg, new_color_index):
@@ -385,6 +451,26 @@ class PaintMapCellCommand(ICommand):
     def undo(self):
         self._apply_and_update(self.old_st_index)
 
+class PaintMapStrokeCommand(ICommand):
+    """Command for a whole brush stroke on the map, committed on release."""
+    def __init__(self, app_ref, cell_changes):
+        super().__init__("Paint Stroke")
+        self.app_ref = app_ref
+        self.cell_changes = dict(cell_changes) # (r, c) -> (old_st_index, new_st_index)
+
+    def _apply_and_update(self, use_new_values):
+        for (r, c), (old_st_index, new_st_index) in self.cell_changes.items():
+            map_data[r][c] = new_st_index if use_new_values else old_st_index
+        self.app_ref._mark_project_modified()
+        self.app_ref.invalidate_minimap_background_cache()
+        self.app_ref._request_supertile_usage_refresh()
+
+    def execute(self):
+        self._apply_and_update(True)
+
+    def undo(self):
+        self._apply_and_update(False)
+
 class CompositeCommand(ICommand):
     """A command that groups multiple commands into a single undoable action."""
     def __init__(self, description, commands_list, app_ref=None, post_hooks=None):
@@ -523,8 +609,7 @@ class SetPaletteColorCommand(ICommand):
     def _apply_and_update(self, hex_color):
         self.app_ref.active_msx_palette[self.slot_index] = hex_color
         self.app_ref._mark_project_modified()
-        self.app_ref.clear_all_caches()
-        self.app_ref.invalidate_minimap_background_cache()
+        self.app_ref.apply_palette_to_render_caches()
         self.app_ref._request_color_usage_refresh()
         self.app_ref._request_tile_usage_refresh()
         self.app_ref._request_supertile_usage_refresh()
@@ -2300,6 +2385,95 @@ class SupertileUsageWindow(tk.Toplevel):
         if self.tree.cget("cursor") != new_cursor:
             self.tree.config(cursor=new_cursor)
 
+class PaletteCycleWindow(tk.Toplevel):
+    """Previews palette-register cycling (water, lava...) over the map without re-rendering."""
+    def __init__(self, master_app):
+        super().__init__(master_app.root)
+        self.app_ref = master_app
+        self.title("Palette Cycling Preview")
+        self.transient(master_app.root)
+        self.resizable(False, False)
+
+        self.fps_var = tk.IntVar(value=PALETTE_CYCLE_DEFAULT_FPS)
+
+        main_frame = ttk.Frame(self, padding="10")
+        main_frame.pack(expand=True, fill="both")
+
+        # Rotation sequences
+        seq_frame = ttk.LabelFrame(main_frame, text="Slot Rotations (one per line, e.g. 4,5,6,7)")
+        seq_frame.pack(fill="x", padx=5, pady=5)
+        self.sequences_text = tk.Text(seq_frame, height=6, width=40, font=("Consolas", 9))
+        self.sequences_text.pack(fill="x", expand=True, padx=5, pady=5)
+        if self.app_ref.palette_cycle_sequences:
+            self.sequences_text.insert(
+                "1.0", "\n".join(",".join(str(s) for s in seq) for seq in self.app_ref.palette_cycle_sequences)
+            )
+
+        # Frame rate
+        fps_frame = ttk.LabelFrame(main_frame, text="Frame Rate")
+        fps_frame.pack(fill="x", padx=5, pady=5)
+        ttk.Label(fps_frame, text="Steps per second:").pack(side=tk.LEFT, padx=5, pady=5)
+        ttk.Spinbox(fps_frame, from_=1, to=60, width=5, textvariable=self.fps_var).pack(side=tk.LEFT, padx=5, pady=5)
+
+        # Buttons
+        button_frame = ttk.Frame(main_frame)
+        button_frame.pack(padx=5, pady=(5, 0))
+        self.start_button = ttk.Button(button_frame, text="Start", command=self.start_cycle)
+        self.stop_button = ttk.Button(button_frame, text="Stop", command=self.stop_cycle)
+        close_button = ttk.Button(button_frame, text="Close", command=self.on_close)
+        self.start_button.pack(side=tk.LEFT, padx=5)
+        self.stop_button.pack(side=tk.LEFT, padx=5)
+        close_button.pack(side=tk.LEFT, padx=5)
+        self._update_button_states()
+
+        self.protocol("WM_DELETE_WINDOW", self.on_close)
+
+    def _parse_sequences(self):
+        sequences = []
+        for line_num, line in enumerate(self.sequences_text.get("1.0", tk.END).splitlines(), start=1):
+            tokens = line.replace(",", " ").split()
+            if not tokens:
+                continue
+            try:
+                slots = [int(tok) for tok in tokens]
+            except ValueError:
+                raise ValueError(f"Line {line_num}: slots must be numbers.")
+            if len(slots) < 2:
+                raise ValueError(f"Line {line_num}: a rotation needs at least two slots.")
+            if any(not (0 <= s < 16) for s in slots):
+                raise ValueError(f"Line {line_num}: slots must be between 0 and 15.")
+            if len(set(slots)) != len(slots):
+                raise ValueError(f"Line {line_num}: a slot appears more than once.")
+            sequences.append(slots)
+        if not sequences:
+            raise ValueError("Enter at least one slot rotation.")
+        return sequences
+
+    def start_cycle(self):
+        try:
+            sequences = self._parse_sequences()
+            fps = int(self.fps_var.get())
+        except (ValueError, tk.TclError) as e:
+            messagebox.showerror("Invalid Input", str(e) or "Frame rate must be a number.", parent=self)
+            return
+        self.app_ref.start_palette_cycle(sequences, max(1, min(60, fps)))
+        self._update_button_states()
+
+    def stop_cycle(self):
+        self.app_ref.stop_palette_cycle()
+        self._update_button_states()
+
+    def _update_button_states(self):
+        running = self.app_ref.palette_cycle_timer is not None
+        self.start_button.config(state=tk.DISABLED if running else tk.NORMAL)
+        self.stop_button.config(state=tk.NORMAL if running else tk.DISABLED)
+
+    def on_close(self):
+        self.app_ref.stop_palette_cycle()
+        self.app_ref.palette_cycle_window = None
+        self.destroy()
+
+
 class ExportDialog(tk.Toplevel):
     def __init__(self, parent, app_instance, project_path):
         super().__init__(parent)
@@ -2716,6 +2890,13 @@ class TileEditorApp:
         self.scroll_speed_units = 3 
         self.is_currently_painting_tile = False
         self.pending_command_list = []
+        self.tile_stroke_tile_index = None
+        self.tile_stroke_old_values = {}
+        self.tile_stroke_refresh_timer = None
+        self.map_stroke_old_values = {}
+        self.map_viewport_origin = (0, 0)
+        self.map_stroke_blit_photo = None
+        self.minimap_stroke_refresh_timer = None
         self.is_changing_projects = False
 
         self.config_app_name = "MSXTileForge" 
@@ -2742,6 +2923,8 @@ class TileEditorApp:
         self.tile_image_cache = {}      
         self.supertile_image_cache = {} 
         self.map_render_cache = {}      
+        self.tile_render_cache = {}      # Canonical indexed 8x8 tile renders
+        self.supertile_render_cache = {} # Canonical indexed supertile renders
         self.pil_map_viewport_image = None 
         self.tk_map_photoimage = None      
 
@@ -2775,6 +2958,7 @@ class TileEditorApp:
         self.MINIMAP_VIEWPORT_COLOR = "#FF0000"
         self.MINIMAP_WIN_VIEW_COLOR = "#0000FF"
         self.minimap_background_cache = None
+        self.minimap_background_indexed = None
         self.minimap_bg_rendered_width = 0
         self.minimap_bg_rendered_height = 0
         self.minimap_resize_timer = None
@@ -2809,6 +2993,14 @@ class TileEditorApp:
         self.color_usage_window = None
         self.tile_usage_window = None
         self.supertile_usage_window = None 
+
+        self.palette_cycle_window = None
+        self.palette_cycle_timer = None
+        self.palette_cycle_sequences = []
+        self.palette_cycle_frame = 0
+        self.palette_cycle_interval_ms = round(1000 / PALETTE_CYCLE_DEFAULT_FPS)
+        self.palette_cycle_display_hex = None # Palette currently shown on the map/minimap while cycling
+        self.map_viewport_background_rgb = (0, 0, 0)
         
         # --- Load settings, which will be used later ---
         self._load_app_settings()
@@ -2927,6 +3119,7 @@ class TileEditorApp:
 
     # --- Cache Management ---
     def invalidate_tile_cache(self, tile_index):
+        self.tile_render_cache.pop(tile_index, None)
         keys_to_remove = [k for k in self.tile_image_cache if k[0] == tile_index]
         for key in keys_to_remove:
             self.tile_image_cache.pop(key, None)
@@ -2967,6 +3160,12 @@ class TileEditorApp:
                 self.invalidate_supertile_cache(st_index)
 
     def invalidate_supertile_cache(self, supertile_index):
+        keys_to_remove_canonical = [
+            k for k in self.supertile_render_cache if k[0] == supertile_index
+        ]
+        for key_canonical in keys_to_remove_canonical:
+            self.supertile_render_cache.pop(key_canonical, None)
+
         keys_to_remove_st_img = [
             k for k in self.supertile_image_cache if k[0] == supertile_index
         ]
@@ -2980,10 +3179,33 @@ class TileEditorApp:
         for key_map_render in keys_to_remove_map_render:
             self.map_render_cache.pop(key_map_render, None)
 
+    def clear_supertile_render_caches(self):
+        # Drops the canonical supertile renders and every scaled variant served from them.
+        self.supertile_render_cache.clear()
+        self.supertile_image_cache.clear()
+        self.map_render_cache.clear()
+
     def clear_all_caches(self):
+        self.tile_render_cache.clear()
+        self.tile_image_cache.clear()
+        self.clear_supertile_render_caches()
+
+    def apply_palette_to_render_caches(self):
+        # Palette-only changes keep every indexed render and just swap its palette.
+        # Tk images cannot swap palettes, so those are rebuilt from the indexed renders.
+        render_palette = self._render_palette()
+        for indexed_cache in (self.tile_render_cache, self.supertile_render_cache, self.map_render_cache):
+            for indexed_image in indexed_cache.values():
+                indexed_image.putpalette(render_palette)
         self.tile_image_cache.clear()
         self.supertile_image_cache.clear()
-        self.map_render_cache.clear() # Added to clear the new map render cache
+
+        if self.minimap_background_indexed is not None: # Updated in place so the open minimap follows
+            self.minimap_background_indexed.putpalette(
+                self._render_palette(background_rgb=(0, 0, 0), palette_hex=self.palette_cycle_display_hex)
+            )
+            if self.minimap_background_cache is not None:
+                self.minimap_background_cache.paste(self.minimap_background_indexed)
 
     # --- Image Generation ---
     def create_tile_image(self, tile_index, size):
@@ -2996,38 +3218,153 @@ class TileEditorApp:
             img.put(INVALID_TILE_COLOR, to=(0, 0, render_size, render_size))
             self.tile_image_cache[cache_key] = img
             return img
-        pattern = tileset_patterns[tile_index]
-        colors = tileset_colors[tile_index]
-        pixel_w_ratio = TILE_WIDTH / render_size
-        pixel_h_ratio = TILE_HEIGHT / render_size
-        for y in range(render_size):
-            tile_r = min(TILE_HEIGHT - 1, int(y * pixel_h_ratio))
-            try:
-                fg_idx, bg_idx = colors[tile_r]
-                fg_color = self.active_msx_palette[fg_idx]
-                bg_color = self.active_msx_palette[bg_idx]
-            except IndexError:
-                fg_color, bg_color = INVALID_TILE_COLOR, INVALID_TILE_COLOR
-            row_colors_hex = []
-            for x in range(render_size):
-                tile_c = min(TILE_WIDTH - 1, int(x * pixel_w_ratio))
-                try:
-                    pixel_val = pattern[tile_r][tile_c]
-                except IndexError:
-                    pixel_val = 0
-                color_hex = fg_color if pixel_val == 1 else bg_color
-                row_colors_hex.append(color_hex)
-            try:
-                img.put("{" + " ".join(row_colors_hex) + "}", to=(0, y))
-            except tk.TclError as e:
-                print(
-                    f"Warning [create_tile_image]: TclError tile {tile_index} size {size} row {y}: {e}"
-                )
-                if row_colors_hex:
-                    img.put(row_colors_hex[0], to=(0, y, render_size, y + 1))
+        pil_scaled = self.render_tile_canonical(tile_index).resize((render_size, render_size), Image.Resampling.NEAREST)
+        temp_photo = ImageTk.PhotoImage(pil_scaled)
+        img.tk.call(img, 'copy', temp_photo)
         self.tile_image_cache[cache_key] = img
         return img
 
+    # --- Palette Cycling Preview ---
+    def toggle_palette_cycle_window(self):
+        if self.palette_cycle_window is None or not tk.Toplevel.winfo_exists(self.palette_cycle_window):
+            self.palette_cycle_window = PaletteCycleWindow(self)
+        else:
+            self.palette_cycle_window.lift()
+            self.palette_cycle_window.focus_set()
+
+    def start_palette_cycle(self, sequences, fps):
+        self.stop_palette_cycle()
+        self.palette_cycle_sequences = [list(seq) for seq in sequences]
+        self.palette_cycle_frame = 0
+        self.palette_cycle_interval_ms = max(1, round(1000 / fps))
+        self._palette_cycle_tick()
+
+    def stop_palette_cycle(self):
+        if self.palette_cycle_timer is not None:
+            try:
+                self.root.after_cancel(self.palette_cycle_timer)
+            except tk.TclError:
+                pass
+            self.palette_cycle_timer = None
+        if self.palette_cycle_display_hex is not None:
+            self.palette_cycle_display_hex = None
+            self._show_display_palette(self.active_msx_palette)
+
+    def _cycled_palette(self, frame):
+        # Slot seq[i] shows the colour of slot seq[i + frame], like rotating the VDP palette registers.
+        cycled = list(self.active_msx_palette[:16])
+        for seq in self.palette_cycle_sequences:
+            for i, slot in enumerate(seq):
+                cycled[slot] = self.active_msx_palette[seq[(i + frame) % len(seq)]]
+        return cycled
+
+    def _palette_cycle_tick(self):
+        self.palette_cycle_display_hex = self._cycled_palette(self.palette_cycle_frame)
+        self._show_display_palette(self.palette_cycle_display_hex)
+        self.palette_cycle_frame += 1
+        self.palette_cycle_timer = self.root.after(self.palette_cycle_interval_ms, self._palette_cycle_tick)
+
+    def _show_display_palette(self, palette_hex):
+        # Only the palettes of the indexed viewport/minimap images change; no pixel data is re-rendered.
+        if self.pil_map_viewport_image is not None and self.tk_map_photoimage is not None:
+            self.pil_map_viewport_image.putpalette(
+                self._render_palette(background_rgb=self.map_viewport_background_rgb, palette_hex=palette_hex)
+            )
+            self.tk_map_photoimage.paste(self.pil_map_viewport_image)
+        if self.minimap_background_indexed is not None and self.minimap_background_cache is not None:
+            self.minimap_background_indexed.putpalette(self._render_palette(background_rgb=(0, 0, 0), palette_hex=palette_hex))
+            self.minimap_background_cache.paste(self.minimap_background_indexed)
+
+    # --- Indexed Render Service ---
+    def _render_palette(self, background_rgb=(0, 0, 0), palette_hex=None):
+        # Layout shared by every indexed render: 16 MSX slots, the two invalid markers, then the background fill.
+        if palette_hex is None:
+            palette_hex = self.active_msx_palette
+        palette_flat = []
+        for hex_color in list(palette_hex[:16]) + [INVALID_TILE_COLOR, INVALID_SUPERTILE_COLOR]:
+            try:
+                palette_flat.extend(ImageColor.getrgb(hex_color)[:3])
+            except ValueError:
+                palette_flat.extend(ImageColor.getrgb(INVALID_TILE_COLOR))
+        palette_flat.extend(background_rgb)
+        return palette_flat
+
+    def render_tile_canonical(self, tile_index, color_fallback=None):
+        # Renders a tile once as an 8x8 palette-indexed image. With color_fallback (fg, bg), out-of-range
+        # colour indices fall back to those slots instead of marking the row invalid; such renders are not cached.
+        if color_fallback is None and tile_index in self.tile_render_cache:
+            return self.tile_render_cache[tile_index]
+
+        indices = bytearray([RENDER_INVALID_TILE_IDX]) * (TILE_WIDTH * TILE_HEIGHT)
+        if 0 <= tile_index < num_tiles_in_set:
+            pattern = tileset_patterns[tile_index]
+            colors = tileset_colors[tile_index]
+            num_palette_slots = min(16, len(self.active_msx_palette))
+            for y_in_tile in range(TILE_HEIGHT):
+                row_start = y_in_tile * TILE_WIDTH
+                try:
+                    fg_idx, bg_idx = colors[y_in_tile]
+                    row_pattern = pattern[y_in_tile]
+                    if color_fallback is not None:
+                        fg_idx = fg_idx if 0 <= fg_idx < num_palette_slots else color_fallback[0]
+                        bg_idx = bg_idx if 0 <= bg_idx < num_palette_slots else color_fallback[1]
+                    elif not (0 <= fg_idx < num_palette_slots and 0 <= bg_idx < num_palette_slots):
+                        continue
+                    indices[row_start:row_start + TILE_WIDTH] = bytes(
+                        fg_idx if row_pattern[x] == 1 else bg_idx for x in range(TILE_WIDTH)
+                    )
+                except (IndexError, TypeError, ValueError):
+                    continue
+
+        tile_image = Image.frombytes('P', (TILE_WIDTH, TILE_HEIGHT), bytes(indices))
+        tile_image.putpalette(self._render_palette())
+        if color_fallback is None:
+            self.tile_render_cache[tile_index] = tile_image
+        return tile_image
+
+    def render_supertile_canonical(self, supertile_index, color_fallback=None):
+        # Renders a supertile once, at native MSX resolution, as a palette-indexed image.
+        # Every scaled view of a supertile is derived from this render. With color_fallback (fg, bg),
+        # out-of-range colour indices fall back to those slots instead of marking the row invalid.
+        cache_key = (supertile_index, self.supertile_grid_width, self.supertile_grid_height, color_fallback)
+        if cache_key in self.supertile_render_cache:
+            return self.supertile_render_cache[cache_key]
+
+        grid_w = self.supertile_grid_width
+        grid_h = self.supertile_grid_height
+        if grid_w <= 0 or grid_h <= 0:
+            return None
+        canonical_image = Image.new('P', (grid_w * TILE_WIDTH, grid_h * TILE_HEIGHT), RENDER_INVALID_SUPERTILE_IDX)
+        canonical_image.putpalette(self._render_palette())
+
+        definition = supertiles_data[supertile_index] if 0 <= supertile_index < num_supertiles else None
+        if definition is not None and (len(definition) != grid_h or len(definition[0]) != grid_w):
+            _debug(f" Supertile {supertile_index} dim mismatch for canonical render.")
+            definition = None
+
+        if definition is not None:
+            for r_def in range(grid_h):
+                for c_def in range(grid_w):
+                    # Indexed paste copies the tile's palette indices as-is
+                    canonical_image.paste(
+                        self.render_tile_canonical(definition[r_def][c_def], color_fallback),
+                        (c_def * TILE_WIDTH, r_def * TILE_HEIGHT)
+                    )
+
+        self.supertile_render_cache[cache_key] = canonical_image
+        return canonical_image
+
+    def _scale_supertile_render(self, supertile_index, target_width, target_height, color_fallback=None):
+        # Uncached indexed variant of the canonical render at the requested size.
+        canonical_image = self.render_supertile_canonical(supertile_index, color_fallback)
+        if canonical_image is None:
+            invalid_image = Image.new('P', (target_width, target_height), RENDER_INVALID_SUPERTILE_IDX)
+            invalid_image.putpalette(self._render_palette())
+            return invalid_image
+        if canonical_image.size != (target_width, target_height):
+            return canonical_image.resize((target_width, target_height), Image.Resampling.NEAREST)
+        return canonical_image.copy()
+
     def create_supertile_image(self, supertile_index, target_preview_width, target_preview_height): # Renamed parameters
         # Ensure target dimensions are at least 1x1
         safe_target_preview_width = max(1, int(target_preview_width))
@@ -3040,89 +3377,16 @@ class TileEditorApp:
 
         img = tk.PhotoImage(width=safe_target_preview_width, height=safe_target_preview_height)
 
-        if not (0 <= supertile_index < num_supertiles):
-            img.put(INVALID_SUPERTILE_COLOR, to=(0, 0, safe_target_preview_width, safe_target_preview_height))
-            self.supertile_image_cache[cache_key] = img
-            return img
-
-        definition = supertiles_data[supertile_index]
-        src_st_tile_grid_w = self.supertile_grid_width
-        src_st_tile_grid_h = self.supertile_grid_height
-
-        if src_st_tile_grid_w <= 0 or src_st_tile_grid_h <= 0:
-            img.put(INVALID_SUPERTILE_COLOR, to=(0, 0, safe_target_preview_width, safe_target_preview_height))
-            self.supertile_image_cache[cache_key] = img
-            return img
-        
-        if len(definition) != src_st_tile_grid_h or \
-           (src_st_tile_grid_h > 0 and (len(definition[0]) != src_st_tile_grid_w)):
-            _warning(f"Supertile {supertile_index} internal dim mismatch for create_supertile_image. Expected {src_st_tile_grid_w}x{src_st_tile_grid_h}")
+        # Heuristic: if rendering a source tile column/row to less than 1 pixel on average.
+        if safe_target_preview_width < self.supertile_grid_width or safe_target_preview_height < self.supertile_grid_height:
             img.put(INVALID_SUPERTILE_COLOR, to=(0, 0, safe_target_preview_width, safe_target_preview_height))
             self.supertile_image_cache[cache_key] = img
             return img
 
-        # --- Letterboxing/Pillarboxing logic REMOVED ---
-        # The image is created with exact target dimensions, and we render directly into it.
+        pil_scaled = self._scale_supertile_render(supertile_index, safe_target_preview_width, safe_target_preview_height)
+        temp_photo = ImageTk.PhotoImage(pil_scaled)
+        img.tk.call(img, 'copy', temp_photo)
 
-        # Pixels of one original base tile (e.g., 8x8) when rendered within the target_preview_width/height
-        output_pixels_per_base_tile_w = safe_target_preview_width / src_st_tile_grid_w
-        output_pixels_per_base_tile_h = safe_target_preview_height / src_st_tile_grid_h
-        
-        # Heuristic: if rendering a source tile column/row to less than 1 pixel on average.
-        if safe_target_preview_width < src_st_tile_grid_w or safe_target_preview_height < src_st_tile_grid_h:
-             img.put(INVALID_SUPERTILE_COLOR, to=(0, 0, safe_target_preview_width, safe_target_preview_height))
-             self.supertile_image_cache[cache_key] = img
-             return img
-
-        # Ratio of source base tile pixels (e.g., TILE_WIDTH) to its display size in the preview.
-        src_pixels_per_output_pixel_w_ratio = TILE_WIDTH / output_pixels_per_base_tile_w if output_pixels_per_base_tile_w > 1e-9 else float('inf')
-        src_pixels_per_output_pixel_h_ratio = TILE_HEIGHT / output_pixels_per_base_tile_h if output_pixels_per_base_tile_h > 1e-9 else float('inf')
-
-        for y_out_preview in range(safe_target_preview_height):
-            row_colors_hex_preview = []
-            for x_out_preview in range(safe_target_preview_width):
-                src_base_tile_c_in_st_grid_preview = min(src_st_tile_grid_w - 1, int(x_out_preview / output_pixels_per_base_tile_w))
-                src_base_tile_r_in_st_grid_preview = min(src_st_tile_grid_h - 1, int(y_out_preview / output_pixels_per_base_tile_h))
-
-                x_in_scaled_base_tile_area_preview = (x_out_preview / output_pixels_per_base_tile_w - src_base_tile_c_in_st_grid_preview) * output_pixels_per_base_tile_w
-                y_in_scaled_base_tile_area_preview = (y_out_preview / output_pixels_per_base_tile_h - src_base_tile_r_in_st_grid_preview) * output_pixels_per_base_tile_h
-                
-                src_pixel_c_in_base_tile_preview = min(TILE_WIDTH - 1, int(x_in_scaled_base_tile_area_preview * src_pixels_per_output_pixel_w_ratio))
-                src_pixel_r_in_base_tile_preview = min(TILE_HEIGHT - 1, int(y_in_scaled_base_tile_area_preview * src_pixels_per_output_pixel_h_ratio))
-
-                pixel_color_hex_final_preview = INVALID_TILE_COLOR
-
-                try:
-                    tile_idx_from_st_def_preview = definition[src_base_tile_r_in_st_grid_preview][src_base_tile_c_in_st_grid_preview]
-                    if 0 <= tile_idx_from_st_def_preview < num_tiles_in_set:
-                        if not (0 <= src_pixel_r_in_base_tile_preview < TILE_HEIGHT and \
-                                len(tileset_patterns[tile_idx_from_st_def_preview]) > src_pixel_r_in_base_tile_preview and \
-                                0 <= src_pixel_c_in_base_tile_preview < TILE_WIDTH and \
-                                len(tileset_patterns[tile_idx_from_st_def_preview][src_pixel_r_in_base_tile_preview]) > src_pixel_c_in_base_tile_preview and \
-                                len(tileset_colors[tile_idx_from_st_def_preview]) > src_pixel_r_in_base_tile_preview):
-                            pixel_color_hex_final_preview = INVALID_TILE_COLOR
-                        else:
-                            pattern_pixel_val_preview = tileset_patterns[tile_idx_from_st_def_preview][src_pixel_r_in_base_tile_preview][src_pixel_c_in_base_tile_preview]
-                            fg_idx_val_preview, bg_idx_val_preview = tileset_colors[tile_idx_from_st_def_preview][src_pixel_r_in_base_tile_preview]
-                            
-                            if not (0 <= fg_idx_val_preview < len(self.active_msx_palette) and 0 <= bg_idx_val_preview < len(self.active_msx_palette)):
-                                fg_color_preview = INVALID_TILE_COLOR; bg_color_preview = INVALID_TILE_COLOR
-                            else:
-                                fg_color_preview = self.active_msx_palette[fg_idx_val_preview]
-                                bg_color_preview = self.active_msx_palette[bg_idx_val_preview]
-                            pixel_color_hex_final_preview = fg_color_preview if pattern_pixel_val_preview == 1 else bg_color_preview
-                except IndexError:
-                    pixel_color_hex_final_preview = INVALID_TILE_COLOR
-                
-                row_colors_hex_preview.append(pixel_color_hex_final_preview)
-            
-            try:
-                if safe_target_preview_width > 0:
-                    img.put("{" + " ".join(row_colors_hex_preview) + "}", to=(0, y_out_preview))
-            except tk.TclError as e:
-                if row_colors_hex_preview and safe_target_preview_width > 0:
-                    img.put(row_colors_hex_preview[0], to=(0, y_out_preview, safe_target_preview_width, y_out_preview + 1))
-        
         self.supertile_image_cache[cache_key] = img # Store in the original cache
         return img
 
@@ -3234,6 +3498,8 @@ class TileEditorApp:
         view_menu.add_command(label="Color Usage", command=self.toggle_color_usage_window, accelerator="F1")
         view_menu.add_command(label="Tile Usage", command=self.toggle_tile_usage_window, accelerator="F2")
         view_menu.add_command(label="Supertile Usage", command=self.toggle_supertile_usage_window, accelerator="F3")
+        view_menu.add_separator()
+        view_menu.add_command(label="Palette Cycling Preview...", command=self.toggle_palette_cycle_window)
 
         import_export_menu = tk.Menu(menubar, tearoff=0)
         menubar.add_cascade(label="Import/Export", menu=import_export_menu)
@@ -4175,9 +4441,20 @@ class TileEditorApp:
                 x2 = x1 + EDITOR_PIXEL_SIZE
                 y2 = y1 + EDITOR_PIXEL_SIZE
                 self.editor_canvas.create_rectangle(
-                    x1, y1, x2, y2, fill=color, outline="darkgrey", width=1
+                    x1, y1, x2, y2, fill=color, outline="darkgrey", width=1,
+                    tags=f"editor_px_{r}_{c}"
                 )
 
+    def _repaint_editor_pixel(self, r, c):
+        # Recolors a single editor pixel in place instead of redrawing the whole canvas.
+        try:
+            fg_idx, bg_idx = tileset_colors[current_tile_index][r]
+            pixel_val = tileset_patterns[current_tile_index][r][c]
+            color = self.active_msx_palette[fg_idx if pixel_val == 1 else bg_idx]
+        except IndexError:
+            color = INVALID_TILE_COLOR
+        self.editor_canvas.itemconfig(f"editor_px_{r}_{c}", fill=color)
+
     def draw_attribute_editor(self):
         if not (0 <= current_tile_index < num_tiles_in_set):
             return
@@ -4449,21 +4726,18 @@ class TileEditorApp:
         # SUPERTILE_DEF_TILE_SIZE is the display size of one mini-tile (e.g., 32x32 pixels)
         mini_tile_display_size = SUPERTILE_DEF_TILE_SIZE 
 
+        # The whole definition is one scaled variant of the canonical supertile render
+        img = self.create_supertile_image(
+            current_supertile_index,
+            self.supertile_grid_width * mini_tile_display_size,
+            self.supertile_grid_height * mini_tile_display_size
+        )
+        canvas.create_image(0, 0, image=img, anchor=tk.NW, tags="def_supertile_image")
+
         for r_def in range(self.supertile_grid_height):
             for c_def in range(self.supertile_grid_width):
-                try:
-                    tile_idx = definition[r_def][c_def]
-                except IndexError: # Should be caught by the check above, but for safety
-                    _error(f"Error drawing ST def: index out of bounds for ST {current_supertile_index} at {r_def},{c_def}")
-                    tile_idx = 0 # Default to tile 0 on error
-
                 base_x = c_def * mini_tile_display_size
                 base_y = r_def * mini_tile_display_size
-                
-                img = self.create_tile_image(tile_idx, mini_tile_display_size)
-                canvas.create_image(
-                    base_x, base_y, image=img, anchor=tk.NW, tags=f"def_tile_{r_def}_{c_def}"
-                )
                 canvas.create_rectangle(
                     base_x, base_y, base_x + mini_tile_display_size, base_y + mini_tile_display_size, outline="grey"
                 )
@@ -4643,24 +4917,31 @@ class TileEditorApp:
         # --- 4. Create/Resize Pillow Viewport Image Buffer ---
         # self.pil_map_viewport_image stores the Pillow Image
         # self.tk_map_photoimage stores the Tk PhotoImage for display (and keeps a reference)
+        # The viewport is palette-indexed like the supertile renders pasted into it.
         if self.pil_map_viewport_image is None or \
            self.pil_map_viewport_image.width != canvas_viewport_width or \
            self.pil_map_viewport_image.height != canvas_viewport_height:
             try:
-                self.pil_map_viewport_image = Image.new('RGB', 
+                self.pil_map_viewport_image = Image.new('P', 
                                                         (max(1,canvas_viewport_width), max(1,canvas_viewport_height)), 
-                                                        canvas.cget("bg")) # Fill with canvas BG
+                                                        RENDER_BACKGROUND_IDX) # Fill with canvas BG
                 _debug(f" draw_map_canvas: Created/Resized self.pil_map_viewport_image to {canvas_viewport_width}x{canvas_viewport_height}")
             except ValueError as e_pil_new:
                 _error(f" draw_map_canvas: Error creating pil_map_viewport_image: {e_pil_new}")
                 return
         else:
             # Fill existing image with background color
-            try:
-                self.pil_map_viewport_image.paste(canvas.cget("bg"), (0,0,canvas_viewport_width,canvas_viewport_height) )
-            except Exception as e_fill: # Catch potential errors if canvas.cget("bg") is not a valid color for paste
-                _error(f" draw_map_canvas: Error filling pil_map_viewport_image: {e_fill}. Filling with black.")
-                self.pil_map_viewport_image.paste("black", (0,0,canvas_viewport_width,canvas_viewport_height) )
+            self.pil_map_viewport_image.paste(RENDER_BACKGROUND_IDX, (0,0,canvas_viewport_width,canvas_viewport_height) )
+
+        try:
+            canvas_bg_rgb = tuple(v // 256 for v in canvas.winfo_rgb(canvas.cget("bg")))
+        except tk.TclError as e_bg: # Fall back to black if the canvas BG is not a valid Tk color
+            _error(f" draw_map_canvas: Error resolving canvas background: {e_bg}. Filling with black.")
+            canvas_bg_rgb = (0, 0, 0)
+        self.map_viewport_background_rgb = canvas_bg_rgb
+        self.pil_map_viewport_image.putpalette(
+            self._render_palette(background_rgb=canvas_bg_rgb, palette_hex=self.palette_cycle_display_hex)
+        )
 
 
         # --- 5. Determine Visible Supertile Range & Composite onto Pillow Viewport Image ---
@@ -4717,6 +4998,7 @@ class TileEditorApp:
 
         # Place the single viewport image onto the canvas at the current scroll position
         # This ensures it aligns with other canvas items drawn using content coordinates.
+        self.map_viewport_origin = (view_content_x1, view_content_y1)
         try:
             if canvas.winfo_exists():
                 canvas.create_image(view_content_x1, view_content_y1, 
@@ -5002,8 +5284,7 @@ class TileEditorApp:
                     selected_color_index = WHITE_IDX
                     # These side-effects are still needed here because they are
                     # specific to this high-level "reset" action.
-                    self.clear_all_caches()
-                    self.invalidate_minimap_background_cache()
+                    self.apply_palette_to_render_caches()
                     self._request_color_usage_refresh()
                     self._request_tile_usage_refresh()
                     self._request_supertile_usage_refresh()
@@ -5026,8 +5307,7 @@ class TileEditorApp:
         if not (0 <= current_tile_index < num_tiles_in_set):
             return
         
-        self.pending_command_list.clear()
-        self.is_currently_painting_tile = True 
+        self._begin_tile_stroke()
         c = event.x // EDITOR_PIXEL_SIZE
         r = event.y // EDITOR_PIXEL_SIZE
 
@@ -5038,13 +5318,7 @@ class TileEditorApp:
                 return
 
             pixel_value_to_set = 1 if event.num == 1 else 0
-            
-            if tileset_patterns[current_tile_index][r][c] != pixel_value_to_set:
-                command = PaintPixelCommand(self, current_tile_index, r, c, pixel_value_to_set)
-                command.execute() # Apply change immediately for visual feedback
-                self.pending_command_list.append(command)
-                self.update_all_displays(changed_level="tile_edit")
-                
+            self._paint_tile_stroke_pixel(r, c, pixel_value_to_set)
             last_drawn_pixel = (r, c)
 
     def handle_editor_drag(self, event):
@@ -5052,7 +5326,8 @@ class TileEditorApp:
         if not (0 <= current_tile_index < num_tiles_in_set):
             return
         
-        self.is_currently_painting_tile = True 
+        if self.tile_stroke_tile_index != current_tile_index:
+            self._begin_tile_stroke()
         c = event.x // EDITOR_PIXEL_SIZE
         r = event.y // EDITOR_PIXEL_SIZE
 
@@ -5070,16 +5345,71 @@ class TileEditorApp:
                 elif event.state & 0x400: # Right mouse button drag
                     pixel_value_to_set = 0
                 
-                if (pixel_value_to_set != -1 and
-                    tileset_patterns[current_tile_index][r][c] != pixel_value_to_set):
-                  
-                    command = PaintPixelCommand(self, current_tile_index, r, c, pixel_value_to_set)
-                    command.execute() # Apply change immediately for visual feedback
-                    self.pending_command_list.append(command)
-                    self.update_all_displays(changed_level="tile_edit")
+                if pixel_value_to_set != -1:
+                    # Fill in the cells skipped between two motion events
+                    if last_drawn_pixel is not None:
+                        cells = get_line_cells(last_drawn_pixel[0], last_drawn_pixel[1], r, c)
+                    else:
+                        cells = [(r, c)]
+                    for cell_r, cell_c in cells:
+                        self._paint_tile_stroke_pixel(cell_r, cell_c, pixel_value_to_set)
 
                 last_drawn_pixel = (r, c)
 
+    # --- Tile Editor Stroke Pipeline ---
+    def _begin_tile_stroke(self):
+        if self.tile_stroke_tile_index is not None:
+            self._commit_tile_stroke()
+        self.tile_stroke_tile_index = current_tile_index
+        self.tile_stroke_old_values = {}
+        self.is_currently_painting_tile = True
+
+    def _paint_tile_stroke_pixel(self, r, c, value):
+        # Writes one pixel of the active stroke and repaints only that editor cell.
+        pattern = tileset_patterns[self.tile_stroke_tile_index]
+        if r >= len(pattern) or c >= len(pattern[r]) or pattern[r][c] == value:
+            return
+        if not self.tile_stroke_old_values:
+            self._mark_project_modified()
+        self.tile_stroke_old_values.setdefault((r, c), pattern[r][c])
+        pattern[r][c] = value
+        self._repaint_editor_pixel(r, c)
+        if self.tile_stroke_refresh_timer is None:
+            self.tile_stroke_refresh_timer = self.root.after(
+                STROKE_REFRESH_INTERVAL_MS, self._refresh_tile_stroke_dependents
+            )
+
+    def _refresh_tile_stroke_dependents(self):
+        # Rate-limited refresh of every view that shows the tile being painted.
+        self.tile_stroke_refresh_timer = None
+        if self.tile_stroke_tile_index is None:
+            return
+        self.invalidate_tile_cache(self.tile_stroke_tile_index)
+        self.update_all_displays(changed_level="tile_edit")
+
+    def _commit_tile_stroke(self):
+        # Registers the finished stroke as one undoable command.
+        if self.tile_stroke_refresh_timer is not None:
+            self.root.after_cancel(self.tile_stroke_refresh_timer)
+            self.tile_stroke_refresh_timer = None
+
+        tile_index = self.tile_stroke_tile_index
+        self.tile_stroke_tile_index = None
+        if tile_index is None or not self.tile_stroke_old_values:
+            return
+
+        pattern = tileset_patterns[tile_index]
+        pixel_changes = {
+            (r, c): (old_value, pattern[r][c])
+            for (r, c), old_value in self.tile_stroke_old_values.items()
+            if pattern[r][c] != old_value
+        }
+        self.tile_stroke_old_values = {}
+        self.invalidate_tile_cache(tile_index)
+        if pixel_changes:
+            self.undo_manager.register(PaintStrokeCommand(self, tile_index, pixel_changes))
+        self.update_all_displays(changed_level="tile_edit")
+
     def handle_tile_editor_palette_click(self, event):
         global selected_color_index
         
@@ -5467,27 +5797,142 @@ class TileEditorApp:
             return
 
         current_cell_id = (r_map, c_map)
-        try:
-            current_data_val = map_data[r_map][c_map]
-        except IndexError:
-            _error(f"IndexError accessing map_data[{r_map}][{c_map}]. Map size: {map_width}x{map_height}")
+        if current_cell_id == last_painted_map_cell:
             return
 
-        if current_cell_id != last_painted_map_cell: 
-            if current_data_val != selected_supertile_for_map:
-                if self._clear_marked_unused(trigger_redraw=False):
-                    pass 
+        # Fill in the cells skipped between two motion events
+        if last_painted_map_cell is not None:
+            cells = get_line_cells(last_painted_map_cell[0], last_painted_map_cell[1], r_map, c_map)
+        else:
+            cells = [current_cell_id]
 
-                command = PaintMapCellCommand(self, r_map, c_map, selected_supertile_for_map)
-                command.execute() # Apply change immediately
-                self.pending_command_list.append(command)
-                
+        for r_cell, c_cell in cells:
+            try:
+                current_data_val = map_data[r_cell][c_cell]
+            except IndexError:
+                _error(f"IndexError accessing map_data[{r_cell}][{c_cell}]. Map size: {map_width}x{map_height}")
+                continue
+            if current_data_val == selected_supertile_for_map:
+                continue
+
+            if self._clear_marked_unused(trigger_redraw=False):
+                self.draw_map_canvas() # Drop stale highlight frames once
+            if not self.map_stroke_old_values:
                 self._mark_project_modified()
-                self.draw_map_canvas() 
-                self.draw_minimap()    
-                self._request_supertile_usage_refresh()
+            self.map_stroke_old_values.setdefault((r_cell, c_cell), current_data_val)
+            map_data[r_cell][c_cell] = selected_supertile_for_map
+
+            self._blit_map_cell(r_cell, c_cell)
+            self._update_minimap_cell(r_cell, c_cell)
+
+        last_painted_map_cell = current_cell_id
+
+    # --- Map Stroke Fast Path ---
+    def _blit_map_cell(self, r_map, c_map):
+        # Pastes one cell's supertile render straight into the on-screen viewport image.
+        if self.pil_map_viewport_image is None or self.tk_map_photoimage is None:
+            self.draw_map_canvas()
+            return
+
+        zoomed_st_w, zoomed_st_h = self._get_zoomed_supertile_pixel_dims()
+        pil_supertile_render = self.create_map_render_of_supertile(
+            map_data[r_map][c_map], round(zoomed_st_w), round(zoomed_st_h)
+        )
+        origin_x, origin_y = self.map_viewport_origin
+        paste_x = round(c_map * zoomed_st_w - origin_x)
+        paste_y = round(r_map * zoomed_st_h - origin_y)
+        self.pil_map_viewport_image.paste(pil_supertile_render, (paste_x, paste_y))
+
+        # Only the visible part of the cell is copied into the Tk photo
+        box = (
+            max(0, paste_x),
+            max(0, paste_y),
+            min(self.pil_map_viewport_image.width, paste_x + pil_supertile_render.width),
+            min(self.pil_map_viewport_image.height, paste_y + pil_supertile_render.height),
+        )
+        if box[2] <= box[0] or box[3] <= box[1]:
+            return
+        try:
+            self.map_stroke_blit_photo = ImageTk.PhotoImage(self.pil_map_viewport_image.crop(box))
+            self.map_canvas.tk.call(
+                str(self.tk_map_photoimage), "copy", str(self.map_stroke_blit_photo),
+                "-to", box[0], box[1]
+            )
+        except tk.TclError as e:
+            _debug(f" _blit_map_cell: TclError, falling back to full redraw: {e}")
+            self.draw_map_canvas()
+
+    def _update_minimap_cell(self, r_map, c_map):
+        # Rewrites only the minimap background pixels sampled from one map cell.
+        minimap_indexed = self.minimap_background_indexed
+        if minimap_indexed is None or self.minimap_background_cache is None:
+            return
+
+        target_width_mm = self.minimap_bg_rendered_width
+        target_height_mm = self.minimap_bg_rendered_height
+        pixels_per_st_w = self.supertile_grid_width * TILE_WIDTH
+        pixels_per_st_h = self.supertile_grid_height * TILE_HEIGHT
+        map_base_pixel_w = map_width * pixels_per_st_w
+        map_base_pixel_h = map_height * pixels_per_st_h
+        if target_width_mm <= 0 or target_height_mm <= 0 or map_base_pixel_w <= 0 or map_base_pixel_h <= 0:
+            return
+
+        scale_mm = min(target_width_mm / map_base_pixel_w, target_height_mm / map_base_pixel_h)
+        offset_x_mm_render = (target_width_mm - map_base_pixel_w * scale_mm) / 2
+        offset_y_mm_render = (target_height_mm - map_base_pixel_h * scale_mm) / 2
+
+        x_start = max(0, math.ceil(offset_x_mm_render + c_map * pixels_per_st_w * scale_mm))
+        x_end = min(target_width_mm, math.ceil(offset_x_mm_render + (c_map + 1) * pixels_per_st_w * scale_mm))
+        y_start = max(0, math.ceil(offset_y_mm_render + r_map * pixels_per_st_h * scale_mm))
+        y_end = min(target_height_mm, math.ceil(offset_y_mm_render + (r_map + 1) * pixels_per_st_h * scale_mm))
+        if x_end <= x_start or y_end <= y_start:
+            return
+
+        # The canonical render is already at 1:1 MSX resolution
+        supertile_render = self.render_supertile_canonical(map_data[r_map][c_map])
+        if supertile_render is None:
+            return
+
+        def _local_coords(start, end, offset, cell_index, cell_size, total_size):
+            src = np.clip((np.arange(start, end) - offset) / max(1e-9, scale_mm), 0, total_size - 1).astype(np.intp)
+            return np.clip(src - cell_index * cell_size, 0, cell_size - 1)
 
-            last_painted_map_cell = current_cell_id
+        local_xs = _local_coords(x_start, x_end, offset_x_mm_render, c_map, pixels_per_st_w, map_base_pixel_w)
+        local_ys = _local_coords(y_start, y_end, offset_y_mm_render, r_map, pixels_per_st_h, map_base_pixel_h)
+        cell_pixels = np.asarray(supertile_render)[np.ix_(local_ys, local_xs)]
+        minimap_indexed.paste(
+            Image.frombytes('P', (x_end - x_start, y_end - y_start), cell_pixels.tobytes()), (x_start, y_start)
+        )
+        # The Tk image is refreshed at most once per interval while the stroke lasts
+        if self.minimap_stroke_refresh_timer is None:
+            self.minimap_stroke_refresh_timer = self.root.after(
+                STROKE_REFRESH_INTERVAL_MS, self._refresh_minimap_stroke_pixels
+            )
+
+    def _refresh_minimap_stroke_pixels(self):
+        # Uploads the minimap pixels rewritten since the last refresh in one paste.
+        self.minimap_stroke_refresh_timer = None
+        if self.minimap_background_indexed is not None and self.minimap_background_cache is not None:
+            self.minimap_background_cache.paste(self.minimap_background_indexed)
+
+    def _commit_map_stroke(self):
+        # Registers the finished brush stroke as one undoable command.
+        if self.minimap_stroke_refresh_timer is not None:
+            self.root.after_cancel(self.minimap_stroke_refresh_timer)
+            self._refresh_minimap_stroke_pixels()
+        cell_changes = {
+            (r, c): (old_st_index, map_data[r][c])
+            for (r, c), old_st_index in self.map_stroke_old_values.items()
+            if map_data[r][c] != old_st_index
+        }
+        self.map_stroke_old_values = {}
+        self.map_stroke_blit_photo = None
+        if not cell_changes:
+            return
+        self.undo_manager.register(PaintMapStrokeCommand(self, cell_changes))
+        self._request_supertile_usage_refresh()
+        self.draw_map_canvas()
+        self.draw_minimap()
 
     def _do_window_move_drag(self, current_canvas_x, current_canvas_y):
         """Helper: Calculates and applies window movement during drag."""
@@ -6034,9 +6479,9 @@ class TileEditorApp:
             new_palette_hex_from_file = [] 
             
             try:
-                file_size = os.path.getsize(load_path)
+                file_size = _component_size(load_path)
             except OSError as e:
-                raise ValueError(f"Could not get size of file '{os.path.basename(load_path)}': {e}")
+                raise ValueError(f"Could not get size of file '{_component_name(load_path)}': {e}")
 
             is_new_format_with_reserved_bytes = False
             expected_size_new = RESERVED_BYTES_COUNT + expected_color_data_size 
@@ -6051,7 +6496,7 @@ class TileEditorApp:
                     f"Invalid file size for palette. Expected {expected_size_old} (old) or {expected_size_new} (new) bytes, got {file_size}."
                 )
 
-            with open(load_path, "rb") as f:
+            with _open_component(load_path) as f:
                 if is_new_format_with_reserved_bytes:
                     reserved_bytes_read = f.read(RESERVED_BYTES_COUNT)
                     if len(reserved_bytes_read) < RESERVED_BYTES_COUNT:
@@ -6074,7 +6519,7 @@ class TileEditorApp:
                         continue
 
                     if not (0 <= r_val <= 7 and 0 <= g_val <= 7 and 0 <= b_val <= 7):
-                        _warning(f"Invalid RGB ({r_val},{g_val},{b_val}) at slot {i} in '{os.path.basename(load_path)}'. Clamping.")
+                        _warning(f"Invalid RGB ({r_val},{g_val},{b_val}) at slot {i} in '{_component_name(load_path)}'. Clamping.")
                         r_val = max(0, min(7, r_val))
                         g_val = max(0, min(7, g_val))
                         b_val = max(0, min(7, b_val))
@@ -6083,7 +6528,7 @@ class TileEditorApp:
                 
                 extra_data_check = f.read(1)
                 if extra_data_check:
-                    _warning(f"Palette file '{os.path.basename(load_path)}' contains additional unexpected data at the end.")
+                    _warning(f"Palette file '{_component_name(load_path)}' contains additional unexpected data at the end.")
 
             confirm_load = True
             if is_standalone_operation:
@@ -6103,8 +6548,7 @@ class TileEditorApp:
                 selected_color_index = WHITE_IDX
                 
                 if is_standalone_operation: 
-                    self.clear_all_caches()
-                    self.invalidate_minimap_background_cache()
+                    self.apply_palette_to_render_caches()
                     self.update_all_displays(changed_level="all")
                     self._request_color_usage_refresh()
                     self._request_tile_usage_refresh()
@@ -6116,7 +6560,7 @@ class TileEditorApp:
                     except tk.TclError: pass
                     messagebox.showinfo(
                         "Load Successful",
-                        f"Loaded palette from {os.path.basename(load_path)}",
+                        f"Loaded palette from {_component_name(load_path)}",
                         parent=self.root
                     )
                     self._mark_project_modified()
@@ -6135,7 +6579,7 @@ class TileEditorApp:
             if is_standalone_operation:
                 messagebox.showerror(
                     "Open Palette Error",
-                    f"Invalid data, size, or format in palette file '{os.path.basename(load_path)}':\n{e}",
+                    f"Invalid data, size, or format in palette file '{_component_name(load_path)}':\n{e}",
                     parent=self.root
                 )
             return False
@@ -6143,7 +6587,7 @@ class TileEditorApp:
             if is_standalone_operation:
                 messagebox.showerror(
                     "Open Palette Error",
-                    f"Failed to open or parse palette file '{os.path.basename(load_path)}':\n{e}",
+                    f"Failed to open or parse palette file '{_component_name(load_path)}':\n{e}",
                     parent=self.root
                 )
             return False
@@ -6251,11 +6695,11 @@ class TileEditorApp:
 
         try:
             try:
-                file_size_check = os.path.getsize(load_path)
+                file_size_check = _component_size(load_path)
             except OSError as e:
-                raise ValueError(f"Could not get size of file '{os.path.basename(load_path)}': {e}")
+                raise ValueError(f"Could not get size of file '{_component_name(load_path)}': {e}")
 
-            with open(load_path, "rb") as f:
+            with _open_component(load_path) as f:
                 num_tiles_header_byte_val = f.read(1)
                 if not num_tiles_header_byte_val:
                     raise ValueError("File empty or missing tile count header byte.")
@@ -6279,7 +6723,7 @@ class TileEditorApp:
                     has_reserved_bytes_to_read = False
                 else:
                     raise ValueError(
-                        f"Tileset file '{os.path.basename(load_path)}' has an unexpected size ({file_size_check} bytes) "
+                        f"Tileset file '{_component_name(load_path)}' has an unexpected size ({file_size_check} bytes) "
                         f"for {loaded_num_tiles} tiles. Expected {expected_total_size_old_format} (old format) "
                         f"or {expected_total_size_new_format} (new format)."
                     )
@@ -6331,7 +6775,7 @@ class TileEditorApp:
                 
                 extra_data_check = f.read(1)
                 if extra_data_check:
-                    _warning(f" Tileset file '{os.path.basename(load_path)}' contains additional unexpected data at the end.")
+                    _warning(f" Tileset file '{_component_name(load_path)}' contains additional unexpected data at the end.")
 
             confirm = True
             if is_standalone_operation:
@@ -6371,7 +6815,7 @@ class TileEditorApp:
                         _debug(" open_tileset: TclError selecting tile editor tab.")
                     messagebox.showinfo(
                         "Load Successful",
-                        f"Loaded {num_tiles_in_set} tiles from {os.path.basename(load_path)}",
+                        f"Loaded {num_tiles_in_set} tiles from {_component_name(load_path)}",
                     )
                     self._mark_project_modified()
                     self._add_to_recent_list("modules", load_path)
@@ -6389,14 +6833,14 @@ class TileEditorApp:
             if is_standalone_operation:
                 messagebox.showerror(
                     "Open Tileset Error",
-                    f"Invalid data, size, or format in tileset file '{os.path.basename(load_path)}':\n{e}",
+                    f"Invalid data, size, or format in tileset file '{_component_name(load_path)}':\n{e}",
                 )
             return False
         except Exception as e:
             if is_standalone_operation:
                 messagebox.showerror(
                     "Open Tileset Error",
-                    f"Failed to open or parse tileset file '{os.path.basename(load_path)}':\n{e}",
+                    f"Failed to open or parse tileset file '{_component_name(load_path)}':\n{e}",
                 )
             return False
 
@@ -6497,7 +6941,7 @@ class TileEditorApp:
             return False
 
         try:
-            with open(load_path, "rb") as f:
+            with _open_component(load_path) as f:
                 first_count_byte_val = f.read(1)
                 if not first_count_byte_val: raise ValueError("File empty.")
                 
@@ -6524,7 +6968,7 @@ class TileEditorApp:
                     else:
                         raise ValueError(f"Invalid supertile dimensions in file: {loaded_grid_width_from_file}x{loaded_grid_height_from_file}")
 
-                file_size_check = os.path.getsize(load_path)
+                file_size_check = _component_size(load_path)
                 header_size = 3 if indicator_byte == 0 else 1
                 header_size += 2 # For dimensions
                 data_payload_size = loaded_num_st_from_file * loaded_grid_width_from_file * loaded_grid_height_from_file
@@ -6593,8 +7037,7 @@ class TileEditorApp:
                                 supertiles_data[st_idx][r][c] = 0
 
                 if is_standalone_operation:
-                    self.supertile_image_cache.clear()
-                    self.map_render_cache.clear()
+                    self.clear_supertile_render_caches()
                     self.invalidate_minimap_background_cache()
                     self.update_all_displays(changed_level="all")
                     self._update_editor_button_states()
@@ -6616,10 +7059,10 @@ class TileEditorApp:
             if is_standalone_operation: self._handle_missing_recent_file("modules", load_path)
             return False
         except (EOFError, ValueError, struct.error) as e:
-            if is_standalone_operation: messagebox.showerror("Open Supertile Error", f"Invalid data or format in file '{os.path.basename(load_path)}':\n{e}")
+            if is_standalone_operation: messagebox.showerror("Open Supertile Error", f"Invalid data or format in file '{_component_name(load_path)}':\n{e}")
             return False
         except Exception as e:
-            if is_standalone_operation: messagebox.showerror("Open Supertile Error", f"Failed to open file '{os.path.basename(load_path)}':\n{e}")
+            if is_standalone_operation: messagebox.showerror("Open Supertile Error", f"Failed to open file '{_component_name(load_path)}':\n{e}")
             return False
 
     def save_map(self, filepath=None, is_standalone_operation=True):
@@ -6714,7 +7157,7 @@ class TileEditorApp:
             return False
 
         try:
-            with open(load_path, "rb") as f:
+            with _open_component(load_path) as f:
                 dim_bytes = f.read(4)
                 if len(dim_bytes) < 4: raise ValueError("Invalid map header.")
                 loaded_w_map, loaded_h_map = struct.unpack("<HH", dim_bytes)
@@ -6722,7 +7165,7 @@ class TileEditorApp:
                 if not (MIN_DIM <= loaded_w_map <= MAX_DIM and MIN_DIM <= loaded_h_map <= MAX_DIM):
                     raise ValueError(f"Invalid map dimensions in file: {loaded_w_map}x{loaded_h_map}")
 
-                file_size = os.path.getsize(load_path)
+                file_size = _component_size(load_path)
                 num_cells = loaded_w_map * loaded_h_map
                 header_size = 4
                 
@@ -6776,7 +7219,7 @@ class TileEditorApp:
                     messagebox.showwarning("Map Load Warning", msg, parent=self.root)
 
                 if is_standalone_operation:
-                    self.map_render_cache.clear()
+                    self.clear_supertile_render_caches()
                     self.invalidate_minimap_background_cache()
                     self.update_all_displays(changed_level="all")
                     self._trigger_minimap_reconfigure()
@@ -6800,11 +7243,11 @@ class TileEditorApp:
         except (EOFError, ValueError, struct.error) as e:
             _error(f"open_map: map structure error: {e}")
             if is_standalone_operation:
-                messagebox.showerror("Open Map Error", f"Invalid data or format in file '{os.path.basename(load_path)}':\n{e}")
+                messagebox.showerror("Open Map Error", f"Invalid data or format in file '{_component_name(load_path)}':\n{e}")
             return False
         except Exception as e:
             _error(f"open_map: general error: {e}")
-            if is_standalone_operation: messagebox.showerror("Open Map Error", f"Failed to open file '{os.path.basename(load_path)}':\n{e}")
+            if is_standalone_operation: messagebox.showerror("Open Map Error", f"Failed to open file '{_component_name(load_path)}':\n{e}")
             return False
 
     # --- Project Save/Load Methods ---
@@ -6930,7 +7373,28 @@ class TileEditorApp:
         sup_path = base_path + ".SC4Super"
         map_path = base_path + ".SC4Map"
 
-        _debug(" open_project: Preparing state for new project load (clearing clipboards, etc.).")
+        success = self._load_project_components(actual_pal_path_to_load, til_path, sup_path, map_path, preserved_palette)
+        _debug(f" open_project: All components processed. Overall success status: {success}")
+        
+        if success:
+            _debug(" open_project: Finalizing SUCCESS. Setting project path and modified status.")
+            self.current_project_base_path = base_path
+            self.project_modified = False
+            _debug(f" open_project: Project '{base_name}' data loaded successfully.")
+            _debug(" open_project: Returning True.")
+            return True
+        else: 
+            _error("open_project: Finalizing FAILURE. One or more components failed to load.")
+            if not is_auto_load:
+                messagebox.showerror("Project Open Error", 
+                                     f"Failed to load one or more components for project '{base_name}'. The application state might be inconsistent.",
+                                     parent=self.root)
+            _debug(" open_project: Returning False.")
+            return False
+
+    def _load_project_components(self, pal_source, til_source, sup_source, map_source, preserved_palette=None):
+        # Loads the four components (file paths or in-memory (name, bytes) pairs), stopping at the first failure.
+        _debug(" _load_project_components: Preparing state for new project load (clearing clipboards, etc.).")
         self.is_ctrl_pressed = False
         self.is_shift_pressed = False
         self.current_mouse_action = None
@@ -6939,54 +7403,51 @@ class TileEditorApp:
         self._clear_paste_preview_rect()
         self._clear_marked_unused(trigger_redraw=False) 
         
-        _debug(" open_project: Starting component load sequence...")
+        _debug(" _load_project_components: Starting component load sequence...")
         success = True
 
-        _debug(f" open_project: --> Calling self.open_palette('{actual_pal_path_to_load}')")
-        success = self.open_palette(filepath=actual_pal_path_to_load, is_standalone_operation=False, preserved_palette=preserved_palette)
-        _debug(f" open_project: <-- self.open_palette returned: {success}")
+        _debug(f" _load_project_components: --> Calling self.open_palette('{_component_name(pal_source)}')")
+        success = self.open_palette(filepath=pal_source, is_standalone_operation=False, preserved_palette=preserved_palette)
+        _debug(f" _load_project_components: <-- self.open_palette returned: {success}")
 
         if success:
-            _debug(f" open_project: --> Calling self.open_tileset('{til_path}')")
-            success = self.open_tileset(til_path, is_standalone_operation=False)
-            _debug(f" open_project: <-- self.open_tileset returned: {success}")
+            _debug(f" _load_project_components: --> Calling self.open_tileset('{_component_name(til_source)}')")
+            success = self.open_tileset(til_source, is_standalone_operation=False)
+            _debug(f" _load_project_components: <-- self.open_tileset returned: {success}")
         else:
-            _debug(" open_project: Palette load failed. Aborting project open.")
+            _debug(" _load_project_components: Palette load failed. Aborting project open.")
 
         if success:
-            _debug(f" open_project: --> Calling self.open_supertiles('{sup_path}')")
-            success = self.open_supertiles(sup_path, is_standalone_operation=False) 
-            _debug(f" open_project: <-- self.open_supertiles returned: {success}")
+            _debug(f" _load_project_components: --> Calling self.open_supertiles('{_component_name(sup_source)}')")
+            success = self.open_supertiles(sup_source, is_standalone_operation=False) 
+            _debug(f" _load_project_components: <-- self.open_supertiles returned: {success}")
         else:
-            _debug(" open_project: Tileset load failed. Aborting project open.")
+            _debug(" _load_project_components: Tileset load failed. Aborting project open.")
             
         if success:
-            _debug(f" open_project: --> Calling self.open_map('{map_path}')")
-            success = self.open_map(map_path, is_standalone_operation=False)
-            _debug(f" open_project: <-- self.open_map returned: {success}")
+            _debug(f" _load_project_components: --> Calling self.open_map('{_component_name(map_source)}')")
+            success = self.open_map(map_source, is_standalone_operation=False)
+            _debug(f" _load_project_components: <-- self.open_map returned: {success}")
         else:
-            _debug(" open_project: Supertile load failed. Aborting project open.")
+            _debug(" _load_project_components: Supertile load failed. Aborting project open.")
 
-        _debug(f" open_project: All components processed. Overall success status: {success}")
-        
+        return success
+
+    def open_project_from_memory(self, components, project_name, preserved_palette=None):
+        # Loads a project from in-memory component files keyed by extension ("SC4Pal", "SC4Tiles", "SC4Super", "SC4Map").
+        _debug(f" open_project_from_memory: Loading '{project_name}' from memory.")
+        sources = {extension: (f"{project_name}.{extension}", data) for extension, data in components.items()}
+        success = self._load_project_components(sources["SC4Pal"], sources["SC4Tiles"], sources["SC4Super"], sources["SC4Map"], preserved_palette)
         if success:
-            _debug(" open_project: Finalizing SUCCESS. Setting project path and modified status.")
-            self.current_project_base_path = base_path
+            self.current_project_base_path = None
             self.project_modified = False
-            _debug(f" open_project: Project '{base_name}' data loaded successfully.")
-            _debug(" open_project: Returning True.")
-            return True
-        else: 
-            _error("open_project: Finalizing FAILURE. One or more components failed to load.")
-            if not is_auto_load:
-                messagebox.showerror("Project Open Error", 
-                                     f"Failed to load one or more components for project '{base_name}'. The application state might be inconsistent.",
-                                     parent=self.root)
-            _debug(" open_project: Returning False.")
-            return False
+        else:
+            _error(f"open_project_from_memory: One or more components of '{project_name}' failed to load.")
+        return success
 
-    def _execute_project_open(self, path_to_open, open_mode, preserved_palette=None):
-        """The single, authoritative function to open a project based on the open_mode."""
+    def _execute_project_open(self, path_to_open, open_mode, preserved_palette=None, components=None):
+        """The single, authoritative function to open a project based on the open_mode.
+        With in-memory components, path_to_open is only the project name and nothing is added to the recent list."""
         _debug(f" _execute_project_open: Opening '{path_to_open}', mode='{open_mode}'")
 
         # 1. Prepare for the change (gather states, close windows)
@@ -6994,12 +7455,16 @@ class TileEditorApp:
 
         # 2. Attempt to load the project data
         suppress_dialogs_on_fail = (open_mode == OPEN_MODE_STARTUP)
-        success = self.open_project(filepath=path_to_open, is_auto_load=suppress_dialogs_on_fail, preserved_palette=preserved_palette)
+        if components is not None:
+            success = self.open_project_from_memory(components, path_to_open, preserved_palette=preserved_palette)
+        else:
+            success = self.open_project(filepath=path_to_open, is_auto_load=suppress_dialogs_on_fail, preserved_palette=preserved_palette)
         
         if success:
             # 3a. If successful, update recent list and finalize the UI
-            base_path, _ = os.path.splitext(path_to_open)
-            self._add_to_recent_list("projects", base_path)
+            if components is None:
+                base_path, _ = os.path.splitext(path_to_open)
+                self._add_to_recent_list("projects", base_path)
             
             # Save the updated recent list to disk on an interactive open
             if open_mode in [OPEN_MODE_INTERACTIVE, OPEN_MODE_RECENT]:
@@ -7020,6 +7485,7 @@ class TileEditorApp:
             # If opening fails, default to the Palette Editor for the new blank project.
             if hasattr(self, 'notebook') and self.notebook.winfo_exists():
                 self.notebook.select(self.tab_palette_editor)
+        return success
     
     def _perform_project_load_ui_updates(self):
         """Helper method to perform UI updates after a project load and Tkinter idle cycle."""
@@ -7261,8 +7727,7 @@ class TileEditorApp:
                     current_supertile_index = max(0, min(current_supertile_index, num_supertiles - 1 if num_supertiles > 0 else 0))
                     selected_supertile_for_map = max(0, min(selected_supertile_for_map, num_supertiles - 1 if num_supertiles > 0 else 0))
 
-                    self.supertile_image_cache.clear()
-                    self.map_render_cache.clear() # If map refs changed
+                    self.clear_supertile_render_caches() # If map refs changed
                     self.invalidate_minimap_background_cache() # If map refs changed
                     
                     self.update_all_displays(changed_level="all")
@@ -8026,7 +8491,7 @@ class TileEditorApp:
         
         # --- Start a paint action ---
         self.current_mouse_action = "painting"
-        self.pending_command_list.clear() # Clear list for new stroke
+        self.map_stroke_old_values = {} # Clear delta for new stroke
         self._paint_map_cell(canvas_x, canvas_y)
 
     def handle_map_drag(self, event):
@@ -8060,11 +8525,9 @@ class TileEditorApp:
         global last_painted_map_cell
         action_at_release = self.current_mouse_action
 
-        # If the action was painting and we have pending commands, create a composite command.
-        if action_at_release == "painting" and self.pending_command_list:
-            composite = CompositeCommand("Paint Stroke", self.pending_command_list[:], self)
-            self.undo_manager.register(composite)
-            self.pending_command_list.clear()
+        # If the action was painting, commit the stroke's cell delta as one command.
+        if action_at_release == "painting":
+            self._commit_map_stroke()
 
         last_painted_map_cell = None
         self.current_mouse_action = None
@@ -8295,6 +8758,7 @@ class TileEditorApp:
     def invalidate_minimap_background_cache(self):
         """Clears the cached minimap background image."""
         self.minimap_background_cache = None
+        self.minimap_background_indexed = None
         # Reset rendered size trackers too
         self.minimap_bg_rendered_width = 0
         self.minimap_bg_rendered_height = 0
@@ -8303,108 +8767,79 @@ class TileEditorApp:
         if target_width_mm <= 0 or target_height_mm <= 0:
             return None
 
-        minimap_img_bg = tk.PhotoImage(width=target_width_mm, height=target_height_mm)
+        # The background is kept palette-indexed so palette edits only swap its palette.
+        minimap_indexed = Image.new('P', (target_width_mm, target_height_mm), RENDER_BACKGROUND_IDX)
+        minimap_indexed.putpalette(self._render_palette(background_rgb=(0, 0, 0), palette_hex=self.palette_cycle_display_hex))
         
         map_base_pixel_w = map_width * self.supertile_grid_width * TILE_WIDTH
         map_base_pixel_h = map_height * self.supertile_grid_height * TILE_HEIGHT
 
         if map_base_pixel_w <= 0 or map_base_pixel_h <= 0:
             _warning("Invalid base map pixel dimensions for minimap background.")
-            minimap_img_bg.put("black", to=(0, 0, target_width_mm, target_height_mm))
-            self.minimap_bg_rendered_width = target_width_mm
-            self.minimap_bg_rendered_height = target_height_mm
-            self.minimap_background_cache = minimap_img_bg
-            return minimap_img_bg
+            return self._set_minimap_background(minimap_indexed)
 
-        scale_x_mm = target_width_mm / map_base_pixel_w
-        scale_y_mm = target_height_mm / map_base_pixel_h
-        scale_mm = min(scale_x_mm, scale_y_mm)
-        
+        scale_mm = min(target_width_mm / map_base_pixel_w, target_height_mm / map_base_pixel_h)
         scaled_map_content_w = map_base_pixel_w * scale_mm
         scaled_map_content_h = map_base_pixel_h * scale_mm
         offset_x_mm_render = (target_width_mm - scaled_map_content_w) / 2
         offset_y_mm_render = (target_height_mm - scaled_map_content_h) / 2
-        
-        bg_fill_color_mm = "#000000"
-
-        for y_pix_mm in range(target_height_mm):
-            row_hex_colors_mm = []
-            for x_pix_mm in range(target_width_mm):
-                pixel_color_hex_mm = bg_fill_color_mm
-
-                if (offset_x_mm_render <= x_pix_mm < offset_x_mm_render + scaled_map_content_w and
-                    offset_y_mm_render <= y_pix_mm < offset_y_mm_render + scaled_map_content_h):
-
-                    map_src_base_x = (x_pix_mm - offset_x_mm_render) / max(1e-9, scale_mm)
-                    map_src_base_y = (y_pix_mm - offset_y_mm_render) / max(1e-9, scale_mm)
-
-                    map_src_base_x = max(0, min(map_base_pixel_w - 1, map_src_base_x))
-                    map_src_base_y = max(0, min(map_base_pixel_h - 1, map_src_base_y))
-
-                    map_pixel_col_src = int(map_src_base_x)
-                    map_pixel_row_src = int(map_src_base_y)
-
-                    pixels_per_st_w = self.supertile_grid_width * TILE_WIDTH
-                    pixels_per_st_h = self.supertile_grid_height * TILE_HEIGHT
-                    if pixels_per_st_w <=0 : pixels_per_st_w = 1
-                    if pixels_per_st_h <=0 : pixels_per_st_h = 1
-
-                    st_col_mm = map_pixel_col_src // pixels_per_st_w
-                    st_row_mm = map_pixel_row_src // pixels_per_st_h
 
-                    tile_col_in_st_mm = (map_pixel_col_src % pixels_per_st_w) // TILE_WIDTH
-                    tile_row_in_st_mm = (map_pixel_row_src % pixels_per_st_h) // TILE_HEIGHT
-                    
-                    pixel_col_in_tile_mm = map_pixel_col_src % TILE_WIDTH
-                    pixel_row_in_tile_mm = map_pixel_row_src % TILE_HEIGHT
-                    
-                    try:
-                        if 0 <= st_row_mm < map_height and 0 <= st_col_mm < map_width:
-                            supertile_idx_mm = map_data[st_row_mm][st_col_mm]
-                            if 0 <= supertile_idx_mm < num_supertiles:
-                                st_def_mm = supertiles_data[supertile_idx_mm]
-                                if st_def_mm and len(st_def_mm) == self.supertile_grid_height and \
-                                   (self.supertile_grid_height == 0 or (self.supertile_grid_width > 0 and len(st_def_mm[0]) == self.supertile_grid_width) or self.supertile_grid_width == 0) and \
-                                   0 <= tile_row_in_st_mm < self.supertile_grid_height and \
-                                   0 <= tile_col_in_st_mm < self.supertile_grid_width:
-
-                                    tile_idx_mm = st_def_mm[tile_row_in_st_mm][tile_col_in_st_mm]
-                                    if 0 <= tile_idx_mm < num_tiles_in_set:
-                                        if 0 <= pixel_row_in_tile_mm < TILE_HEIGHT and \
-                                           0 <= pixel_col_in_tile_mm < TILE_WIDTH:
-                                            pattern_val_mm = tileset_patterns[tile_idx_mm][pixel_row_in_tile_mm][pixel_col_in_tile_mm]
-                                            fg_idx_mm, bg_idx_mm = tileset_colors[tile_idx_mm][pixel_row_in_tile_mm]
-                                            
-                                            if not (0 <= fg_idx_mm < len(self.active_msx_palette) and \
-                                                    0 <= bg_idx_mm < len(self.active_msx_palette)):
-                                                _warning(f"Invalid palette indices ({fg_idx_mm}, {bg_idx_mm}) in minimap render.")
-                                                fg_idx_mm = WHITE_IDX; bg_idx_mm = BLACK_IDX
-
-                                            fg_color_mm = self.active_msx_palette[fg_idx_mm]
-                                            bg_color_mm = self.active_msx_palette[bg_idx_mm]
-                                            pixel_color_hex_mm = fg_color_mm if pattern_val_mm == 1 else bg_color_mm
-                                        else: pixel_color_hex_mm = INVALID_TILE_COLOR
-                                    else: pixel_color_hex_mm = INVALID_TILE_COLOR
-                                else: pixel_color_hex_mm = INVALID_SUPERTILE_COLOR
-                            else: pixel_color_hex_mm = INVALID_SUPERTILE_COLOR
-                        else: pixel_color_hex_mm = "#808080"
-                    except IndexError:
-                        pixel_color_hex_mm = "#FF0000"
-                
-                row_hex_colors_mm.append(pixel_color_hex_mm)
+        pixels_per_st_w = self.supertile_grid_width * TILE_WIDTH
+        pixels_per_st_h = self.supertile_grid_height * TILE_HEIGHT
+
+        def _source_coords(size, offset, scaled_size, total_size, cell_size):
+            # Minimap pixels covered by the map content, with their (cell, pixel inside cell) sources.
+            pix = np.arange(size)
+            pix = pix[(pix >= offset) & (pix < offset + scaled_size)]
+            src = np.clip((pix - offset) / max(1e-9, scale_mm), 0, total_size - 1).astype(np.intp)
+            return pix, src // cell_size, src % cell_size
+
+        xs, st_cols, local_xs = _source_coords(target_width_mm, offset_x_mm_render, scaled_map_content_w,
+                                               map_base_pixel_w, pixels_per_st_w)
+        ys, st_rows, local_ys = _source_coords(target_height_mm, offset_y_mm_render, scaled_map_content_h,
+                                               map_base_pixel_h, pixels_per_st_h)
+        if xs.size == 0 or ys.size == 0:
+            return self._set_minimap_background(minimap_indexed)
+
+        # Each map cell points at one stacked canonical render; slot 0 marks cells that cannot be drawn.
+        invalid_render = np.full((pixels_per_st_h, pixels_per_st_w), RENDER_INVALID_SUPERTILE_IDX, dtype=np.uint8)
+        renders = [invalid_render]
+        render_slots = {}
+        used_rows = np.unique(st_rows)
+        used_cols = np.unique(st_cols)
+        cell_slots = np.zeros((map_height, map_width), dtype=np.intp)
+        for st_row_mm in used_rows:
+            map_row = map_data[st_row_mm]
+            for st_col_mm in used_cols:
+                if st_col_mm >= len(map_row):
+                    continue
+                st_index = map_row[st_col_mm]
+                if st_index not in render_slots:
+                    supertile_render = self.render_supertile_canonical(st_index)
+                    if supertile_render is None or supertile_render.size != (pixels_per_st_w, pixels_per_st_h):
+                        render_slots[st_index] = 0
+                    else:
+                        render_slots[st_index] = len(renders)
+                        renders.append(np.asarray(supertile_render))
+                cell_slots[st_row_mm, st_col_mm] = render_slots[st_index]
 
-            try:
-                minimap_img_bg.put("{" + " ".join(row_hex_colors_mm) + "}", to=(0, y_pix_mm))
-            except tk.TclError as e:
-                _warning(f"[Minimap BG]: TclError put row {y_pix_mm}: {e}")
-                if row_hex_colors_mm:
-                    minimap_img_bg.put(row_hex_colors_mm[0], to=(0, y_pix_mm, target_width_mm, y_pix_mm + 1))
+        content = np.stack(renders)[
+            cell_slots[np.ix_(st_rows, st_cols)], local_ys[:, None], local_xs[None, :]
+        ]
+        minimap_pixels = np.full((target_height_mm, target_width_mm), RENDER_BACKGROUND_IDX, dtype=np.uint8)
+        minimap_pixels[np.ix_(ys, xs)] = content
+        minimap_indexed = Image.frombytes('P', (target_width_mm, target_height_mm), minimap_pixels.tobytes())
+        minimap_indexed.putpalette(self._render_palette(background_rgb=(0, 0, 0), palette_hex=self.palette_cycle_display_hex))
 
         _debug("Minimap background generated.")
-        self.minimap_bg_rendered_width = target_width_mm
-        self.minimap_bg_rendered_height = target_height_mm
-        self.minimap_background_cache = minimap_img_bg
-        return minimap_img_bg
+        return self._set_minimap_background(minimap_indexed)
+
+    def _set_minimap_background(self, minimap_indexed):
+        self.minimap_background_indexed = minimap_indexed
+        self.minimap_bg_rendered_width = minimap_indexed.width
+        self.minimap_bg_rendered_height = minimap_indexed.height
+        self.minimap_background_cache = ImageTk.PhotoImage(minimap_indexed)
+        return self.minimap_background_cache
 
     def _update_window_title(self):
         """Updates the main window title based on the current project path."""
@@ -9702,8 +10137,7 @@ class TileEditorApp:
         # Define post-action hooks for UI updates
         def post_add_hooks():
             self._mark_project_modified()
-            self.supertile_image_cache.clear()
-            self.map_render_cache.clear()
+            self.clear_supertile_render_caches()
             self.invalidate_minimap_background_cache()
             self._update_editor_button_states()
             self._request_tile_usage_refresh()
@@ -9772,8 +10206,7 @@ class TileEditorApp:
         # Define post-action hooks for UI updates
         def post_insert_hooks():
             self._mark_project_modified()
-            self.supertile_image_cache.clear()
-            self.map_render_cache.clear()
+            self.clear_supertile_render_caches()
             self.invalidate_minimap_background_cache()
             self._update_editor_button_states()
             self._request_tile_usage_refresh()
@@ -9851,8 +10284,7 @@ class TileEditorApp:
 
         def post_delete_hooks():
             self._mark_project_modified()
-            self.supertile_image_cache.clear()
-            self.map_render_cache.clear()
+            self.clear_supertile_render_caches()
             self.invalidate_minimap_background_cache()
             self._update_editor_button_states()
             self._request_tile_usage_refresh()
@@ -12070,8 +12502,8 @@ class TileEditorApp:
 
 
     def create_map_render_of_supertile(self, supertile_index, target_render_width, target_render_height):
-        # Creates a Pillow Image for a supertile, scaled to target_render_width/height.
-        # Cache now stores Pillow.Image objects.
+        # Returns a Pillow Image for a supertile, scaled to target_render_width/height.
+        # Scaled variants are cut from the canonical render and kept for the map viewport.
 
         safe_target_render_width = max(1, int(target_render_width))
         safe_target_render_height = max(1, int(target_render_height))
@@ -12082,127 +12514,7 @@ class TileEditorApp:
         if cache_key in self.map_render_cache:
             return self.map_render_cache[cache_key]
 
-        # Create a Pillow Image for the entire scaled supertile
-        # Use 'RGB' mode. If alpha is needed later, can change to 'RGBA'.
-        try:
-            # Ensure dimensions are positive for Image.new
-            pil_supertile_image = Image.new('RGB', 
-                                          (max(1, safe_target_render_width), max(1, safe_target_render_height)), 
-                                          INVALID_SUPERTILE_COLOR) # Fill with invalid color initially
-        except ValueError as e_img_new: # e.g. negative size if calculations somehow fail
-            _error(f"Error creating Pillow image for supertile {supertile_index} (size {safe_target_render_width}x{safe_target_render_height}): {e_img_new}")
-            # Return a minimal placeholder Pillow image on error
-            placeholder_pil = Image.new('RGB', (1,1), INVALID_SUPERTILE_COLOR)
-            self.map_render_cache[cache_key] = placeholder_pil # Cache placeholder to avoid re-erroring
-            return placeholder_pil
-
-
-        if not (0 <= supertile_index < num_supertiles):
-            # Already filled with INVALID_SUPERTILE_COLOR
-            self.map_render_cache[cache_key] = pil_supertile_image
-            return pil_supertile_image
-
-        definition = supertiles_data[supertile_index]
-        src_st_tile_grid_w = self.supertile_grid_width
-        src_st_tile_grid_h = self.supertile_grid_height
-
-        if src_st_tile_grid_w <= 0 or src_st_tile_grid_h <= 0:
-            self.map_render_cache[cache_key] = pil_supertile_image # Already filled with invalid
-            return pil_supertile_image
-        
-        if len(definition) != src_st_tile_grid_h or \
-           (src_st_tile_grid_h > 0 and (len(definition[0]) != src_st_tile_grid_w)):
-            _debug(f" Supertile {supertile_index} dim mismatch for map render.")
-            self.map_render_cache[cache_key] = pil_supertile_image # Already filled with invalid
-            return pil_supertile_image
-
-        # Size of one base 8x8 tile when scaled to fit within the target_render_width/height
-        scaled_base_tile_w = safe_target_render_width / src_st_tile_grid_w
-        scaled_base_tile_h = safe_target_render_height / src_st_tile_grid_h
-
-        # Ensure scaled base tile dimensions are at least 1 pixel for Pillow's resize
-        # Pillow's resize to (0,0) or (0,X) or (X,0) might error or produce unexpected results.
-        # We round them, then ensure they are at least 1.
-        final_scaled_base_tile_w = max(1, round(scaled_base_tile_w))
-        final_scaled_base_tile_h = max(1, round(scaled_base_tile_h))
-
-
-        # Temporary 8x8 Pillow image for rendering individual base tiles
-        pil_temp_base_tile = Image.new('RGB', (TILE_WIDTH, TILE_HEIGHT))
-
-        for r_st_def in range(src_st_tile_grid_h): # Row in supertile definition
-            for c_st_def in range(src_st_tile_grid_w): # Col in supertile definition
-                tile_idx_from_st_def = definition[r_st_def][c_st_def]
-                
-                pixel_data_for_base_tile = [] # Flat list of (r,g,b) tuples for 8x8 tile
-                valid_tile = True
-
-                if not (0 <= tile_idx_from_st_def < num_tiles_in_set):
-                    valid_tile = False
-                else:
-                    pattern = tileset_patterns[tile_idx_from_st_def]
-                    colors = tileset_colors[tile_idx_from_st_def]
-
-                    for y_pixel_in_base in range(TILE_HEIGHT): # 0-7
-                        if not (y_pixel_in_base < len(pattern) and y_pixel_in_base < len(colors)):
-                            valid_tile = False; break # Malformed tile data
-                        
-                        fg_idx, bg_idx = colors[y_pixel_in_base]
-                        if not (0 <= fg_idx < len(self.active_msx_palette) and \
-                                0 <= bg_idx < len(self.active_msx_palette)):
-                            fg_color_hex = INVALID_TILE_COLOR; bg_color_hex = INVALID_TILE_COLOR
-                        else:
-                            fg_color_hex = self.active_msx_palette[fg_idx]
-                            bg_color_hex = self.active_msx_palette[bg_idx]
-
-                        row_pattern_data = pattern[y_pixel_in_base]
-                        if not (len(row_pattern_data) == TILE_WIDTH):
-                            valid_tile = False; break # Malformed tile row
-
-                        for x_pixel_in_base in range(TILE_WIDTH): # 0-7
-                            pixel_val = row_pattern_data[x_pixel_in_base]
-                            color_hex_to_use = fg_color_hex if pixel_val == 1 else bg_color_hex
-                            try:
-                                # Pillow needs RGB tuples, not hex strings for putdata
-                                r_int = int(color_hex_to_use[1:3], 16)
-                                g_int = int(color_hex_to_use[3:5], 16)
-                                b_int = int(color_hex_to_use[5:7], 16)
-                                pixel_data_for_base_tile.append((r_int, g_int, b_int))
-                            except ValueError: # Invalid hex string
-                                pixel_data_for_base_tile.append((255,0,255)) # Magenta for error
-                    if not valid_tile: break
-                
-                if not valid_tile or len(pixel_data_for_base_tile) != TILE_WIDTH * TILE_HEIGHT:
-                    # Fill this part of supertile with invalid color if base tile is bad
-                    # Create a temporary Pillow image for the scaled error tile
-                    error_scaled_tile = Image.new('RGB', (final_scaled_base_tile_w, final_scaled_base_tile_h), INVALID_TILE_COLOR)
-                    paste_x = round(c_st_def * scaled_base_tile_w)
-                    paste_y = round(r_st_def * scaled_base_tile_h)
-                    pil_supertile_image.paste(error_scaled_tile, (paste_x, paste_y))
-                    continue
-
-                # Populate the 8x8 temporary Pillow image
-                pil_temp_base_tile.putdata(pixel_data_for_base_tile)
-
-                # Scale the 8x8 temporary image to its final size within the supertile
-                try:
-                    pil_scaled_base_tile = pil_temp_base_tile.resize(
-                        (final_scaled_base_tile_w, final_scaled_base_tile_h),
-                        Image.Resampling.NEAREST
-                    )
-                except ValueError as e_resize: # e.g. if final_scaled_base_tile_w/h are zero
-                    _error(f"Error resizing base tile in supertile {supertile_index}: {e_resize}")
-                    pil_scaled_base_tile = Image.new('RGB', (final_scaled_base_tile_w, final_scaled_base_tile_h), INVALID_TILE_COLOR)
-
-
-                # Calculate paste position (top-left) for this scaled base tile
-                # Use floating point scaled_base_tile_w/h for paste position calculation
-                # then round for the final integer paste coordinates.
-                paste_x = round(c_st_def * scaled_base_tile_w)
-                paste_y = round(r_st_def * scaled_base_tile_h)
-
-                pil_supertile_image.paste(pil_scaled_base_tile, (paste_x, paste_y))
-
+        pil_supertile_image = self._scale_supertile_render(supertile_index, safe_target_render_width, safe_target_render_height)
         self.map_render_cache[cache_key] = pil_supertile_image
         return pil_supertile_image
 
@@ -13643,11 +13955,8 @@ class TileEditorApp:
     def _handle_editor_paint_release(self, event):
         global last_drawn_pixel
         
-        if self.pending_command_list:
-            # Group all the individual pixel changes into a single undoable action
-            composite = CompositeCommand("Paint Stroke", self.pending_command_list[:], self)
-            self.undo_manager.register(composite) # Use register for pre-executed commands
-            self.pending_command_list.clear()
+        # Group all the pixel changes of the stroke into a single undoable action
+        self._commit_tile_stroke()
 
         if self.is_currently_painting_tile:
             # Refresh all usage windows once at the end of the drawing action.
@@ -13755,59 +14064,12 @@ class TileEditorApp:
             except tk.TclError: pass
             return ph_photo
 
-        # --- Part 3: Render supertile content onto temp_full_photo ---
-        if not (0 <= supertile_index < num_supertiles):
-            temp_full_photo.put(INVALID_SUPERTILE_COLOR, to=(0,0, temp_full_photo_w, temp_full_photo_h))
-        else:
-            definition = supertiles_data[supertile_index]
-            if not (definition and 
-                    len(definition) == self.supertile_grid_height and
-                    (self.supertile_grid_height == 0 or (self.supertile_grid_width > 0 and len(definition[0]) == self.supertile_grid_width) or self.supertile_grid_width == 0)):
-                temp_full_photo.put(INVALID_SUPERTILE_COLOR, to=(0,0, temp_full_photo_w, temp_full_photo_h))
-            else:
-                # No initial green fill here; temp_full_photo should be fully covered by actual content or error colors
-                px_per_base_tile_w_on_temp = TILE_WIDTH * SUPERTILE_USAGE_SCREEN_PIXELS_PER_MSX_PIXEL
-                px_per_base_tile_h_on_temp = TILE_HEIGHT * SUPERTILE_USAGE_SCREEN_PIXELS_PER_MSX_PIXEL
-
-                for r_st_def in range(self.supertile_grid_height):
-                    for c_st_def in range(self.supertile_grid_width):
-                        tile_idx_val = definition[r_st_def][c_st_def]
-                        base_tile_draw_x = int(c_st_def * px_per_base_tile_w_on_temp)
-                        base_tile_draw_y = int(r_st_def * px_per_base_tile_h_on_temp)
-
-                        if not (0 <= tile_idx_val < num_tiles_in_set):
-                            for y_fill_inv in range(int(px_per_base_tile_h_on_temp)):
-                                for x_fill_inv in range(int(px_per_base_tile_w_on_temp)):
-                                    dest_x_inv = base_tile_draw_x + x_fill_inv
-                                    dest_y_inv = base_tile_draw_y + y_fill_inv
-                                    if dest_x_inv < temp_full_photo_w and dest_y_inv < temp_full_photo_h:
-                                        temp_full_photo.put(INVALID_TILE_COLOR, to=(dest_x_inv, dest_y_inv))
-                            continue
-                        pattern = tileset_patterns[tile_idx_val]
-                        colors = tileset_colors[tile_idx_val]
-                        for r_msx in range(TILE_HEIGHT): 
-                            fg_idx, bg_idx = WHITE_IDX, BLACK_IDX 
-                            if r_msx < len(colors): fg_idx, bg_idx = colors[r_msx]
-                            safe_fg_idx = fg_idx if 0 <= fg_idx < 16 else WHITE_IDX
-                            safe_bg_idx = bg_idx if 0 <= bg_idx < 16 else BLACK_IDX
-                            fg_color_hex = self.active_msx_palette[safe_fg_idx]
-                            bg_color_hex = self.active_msx_palette[safe_bg_idx]
-                            row_pattern_data_list = []
-                            if r_msx < len(pattern): row_pattern_data_list = pattern[r_msx]
-                            for c_msx in range(TILE_WIDTH):
-                                pixel_pattern_bit = 0
-                                if c_msx < len(row_pattern_data_list): pixel_pattern_bit = row_pattern_data_list[c_msx]
-                                color_to_draw_hex = fg_color_hex if pixel_pattern_bit == 1 else bg_color_hex
-                                for y_offset_in_block in range(SUPERTILE_USAGE_SCREEN_PIXELS_PER_MSX_PIXEL):
-                                    for x_offset_in_block in range(SUPERTILE_USAGE_SCREEN_PIXELS_PER_MSX_PIXEL):
-                                        dest_screen_x = base_tile_draw_x + (c_msx * SUPERTILE_USAGE_SCREEN_PIXELS_PER_MSX_PIXEL) + x_offset_in_block
-                                        dest_screen_y = base_tile_draw_y + (r_msx * SUPERTILE_USAGE_SCREEN_PIXELS_PER_MSX_PIXEL) + y_offset_in_block
-                                        if dest_screen_x < temp_full_photo_w and dest_screen_y < temp_full_photo_h:
-                                            try:
-                                                temp_full_photo.put(color_to_draw_hex, to=(dest_screen_x, dest_screen_y))
-                                            except tk.TclError: break 
-                                    else: continue
-                                    break 
+        # --- Part 3: Copy the scaled canonical render onto temp_full_photo ---
+        # Out-of-range colours show as white on black, as this preview always did
+        pil_supertile_scaled = self._scale_supertile_render(supertile_index, temp_full_photo_w, temp_full_photo_h,
+                                                            color_fallback=(WHITE_IDX, BLACK_IDX))
+        scaled_photo = ImageTk.PhotoImage(pil_supertile_scaled)
+        temp_full_photo.tk.call(temp_full_photo, 'copy', scaled_photo)
 
         # --- Part 4: Determine final_photo_width and create final_photo ---
         # final_photo_width is the minimum of the actual scaled content width and the available column area
@@ -14241,11 +14503,7 @@ class TileEditorApp:
         if st_width_msx <= 0 or st_height_msx <= 0:
              return final_photo
 
-        pil_supertile_native = self.create_map_render_of_supertile(
-            supertile_index,
-            st_width_msx,
-            st_height_msx
-        )
+        pil_supertile_native = self.render_supertile_canonical(supertile_index)
 
         if not pil_supertile_native:
             return final_photo
@@ -14840,6 +15098,9 @@ class TileEditorApp:
         if self.tile_usage_window and tk.Toplevel.winfo_exists(self.tile_usage_window): self.tile_usage_window.destroy()
         if self.supertile_usage_window and tk.Toplevel.winfo_exists(self.supertile_usage_window): self.supertile_usage_window.destroy()
         self.color_usage_window, self.tile_usage_window, self.supertile_usage_window = None, None, None
+        self.stop_palette_cycle()
+        if self.palette_cycle_window and tk.Toplevel.winfo_exists(self.palette_cycle_window): self.palette_cycle_window.destroy()
+        self.palette_cycle_window = None
         _debug(" _prepare_for_project_change: Method finished.")
 
     def _finalize_project_change(self):
@@ -14929,6 +15190,9 @@ class TileEditorApp:
         if self.tile_usage_window and tk.Toplevel.winfo_exists(self.tile_usage_window): self.tile_usage_window.destroy()
         if self.supertile_usage_window and tk.Toplevel.winfo_exists(self.supertile_usage_window): self.supertile_usage_window.destroy()
         self.color_usage_window, self.tile_usage_window, self.supertile_usage_window = None, None, None
+        self.stop_palette_cycle()
+        if self.palette_cycle_window and tk.Toplevel.winfo_exists(self.palette_cycle_window): self.palette_cycle_window.destroy()
+        self.palette_cycle_window = None
         
         self.root.update_idletasks() # Process the destroy events
         
@@ -16304,49 +16568,42 @@ class TileEditorApp:
         palette_before_load = list(self.active_msx_palette)
         _debug(f"Saved pre-import palette state: {palette_before_load}")
 
-        # --- Assemble the command ---
-        script_path = os.path.join(os.path.dirname(sys.argv[0]), "msxtilemagic.py")
-        if not os.path.exists(script_path):
-            messagebox.showerror("Script Error", f"Could not find the 'msxtilemagic.py' script.\nExpected location: {script_path}", parent=self.root)
+        try:
+            import msxtilemagic # Loaded on first use, so the editor starts without the converter's dependencies
+        except ImportError:
+            messagebox.showerror("Import Error", "The image converter 'msxtilemagic.py' could not be loaded.\nIt must be in the application directory, with its requirements (numpy, scipy, tqdm) installed.", parent=self.root)
             return
 
-        output_dir = os.path.join(platformdirs.user_cache_dir(self.config_app_name, appauthor=False, ensure_exists=True), "img_import_temp")
-        os.makedirs(output_dir, exist_ok=True)
-        basename = os.path.splitext(os.path.basename(image_filepath))[0] + "_imp"
-        
-        command = [
-            sys.executable,
-            script_path,
-            image_filepath,
-            "--output-dir", output_dir,
-            "--output-basename", basename,
-            "--max-tiles", str(options["max_tiles"]),
-            "--optimization-mode", options["opt_mode"],
-            "--supertile-width", str(options["st_width"]),
-            "--supertile-height", str(options["st_height"]),
-            "--color-metric", options["metric"],
-            "--sort-tileset", options["sort_tiles"]
-        ]
-        
-        palette_rules = options["palette_rules"]
-        for i, rule in enumerate(palette_rules):
-            command.append("--palette-slot")
-            command.append(str(i))
-            command.append(rule)
-
-        if not options["dithering"]:
-            command.append("--no-dithering")
-        if options["find_offset"]:
-            command.append("--find-best-offset")
-        if options["synthesize"]:
-            command.append("--synthesize-tiles")
-        if options["limit_cores"]:
-            command.append("--cores")
-            command.append(str(options["cores"]))
-            
-        _info(f"Executing external command: {' '.join(command)}")
+        try:
+            source_image = Image.open(image_filepath)
+            source_image.load()
+        except Exception as e:
+            messagebox.showerror("Import Error", f"Could not open image '{os.path.basename(image_filepath)}':\n{e}", parent=self.root)
+            return
 
-        # --- Run the script ---
+        # --- Assemble the conversion options (same defaults as the command line) ---
+        palette_rules = ["auto"] * 16
+        for i, rule in enumerate(options["palette_rules"]):
+            palette_rules[i] = rule.lower()
+
+        conversion_options = {
+            "palette_rules": palette_rules,
+            "max_tiles": options["max_tiles"],
+            "optimization_mode": options["opt_mode"],
+            "supertile_width": options["st_width"],
+            "supertile_height": options["st_height"],
+            "color_metric": options["metric"],
+            "sort_tileset": options["sort_tiles"],
+            "dithering": options["dithering"],
+            "find_best_offset": options["find_offset"],
+            "synthesize_tiles": options["synthesize"],
+            "cores": options["cores"] if options["limit_cores"] else None,
+        }
+        project_name = os.path.splitext(os.path.basename(image_filepath))[0] + "_imp"
+
+        _info(f"Converting '{image_filepath}' in-process with options: {conversion_options}")
+
+        # --- Run the conversion ---
         runner_dialog = tk.Toplevel(self.root)
         runner_dialog.title("Importing Project...")
         runner_dialog.transient(self.root)
@@ -16358,41 +16615,66 @@ class TileEditorApp:
         log_text['yscrollcommand'] = scrollbar.set
         scrollbar.pack(side=tk.RIGHT, fill=tk.Y)
         log_text.pack(side=tk.LEFT, fill=tk.BOTH, expand=True, padx=5, pady=5)
-        
-        def cleanup_and_close():
+
+        cancel_event = threading.Event()
+        output_queue = queue.Queue()
+        conversion = {}
+
+        def request_cancel():
+            if not cancel_event.is_set():
+                cancel_event.set()
+                cancel_button.config(state=tk.DISABLED)
+                output_queue.put("\n--- Cancelling... ---\n")
+
+        button_frame = ttk.Frame(runner_dialog)
+        button_frame.pack(pady=5)
+        cancel_button = ttk.Button(button_frame, text="Cancel", command=request_cancel)
+        cancel_button.pack(side=tk.LEFT, padx=5)
+        close_button = ttk.Button(button_frame, text="Close", state=tk.DISABLED, command=runner_dialog.destroy)
+        close_button.pack(side=tk.LEFT, padx=5)
+        runner_dialog.protocol("WM_DELETE_WINDOW", request_cancel)
+
+        def convert_in_background():
+            # Runs in a worker thread; the GUI only sees the queue.
             try:
-                if os.path.exists(output_dir):
-                    shutil.rmtree(output_dir)
-                    _debug(f"Cleaned up temporary import directory: {output_dir}")
+                result = msxtilemagic.convert_image(
+                    source_image,
+                    progress_callback=lambda stage, message: output_queue.put(f"{stage}. {message}\n" if stage is not None else f"{message}\n"),
+                    cancel_event=cancel_event,
+                    **conversion_options
+                )
+                conversion["components"] = msxtilemagic.encode_sc4_project(result)
+                output_queue.put("\n--- Conversion finished ---")
+                output_queue.put(True)
+            except msxtilemagic.ConversionCancelled:
+                output_queue.put("\n--- Conversion cancelled ---")
+                output_queue.put(False)
             except Exception as e:
-                _error(f"Failed to clean up temporary directory {output_dir}: {e}")
-            runner_dialog.destroy()
+                output_queue.put(f"\n--- CONVERSION ERROR: {e} ---")
+                output_queue.put(False)
 
-        close_button = ttk.Button(runner_dialog, text="Close", state=tk.DISABLED, command=cleanup_and_close)
-        close_button.pack(pady=5)
-        
-        def on_script_complete(success):
+        def on_conversion_complete(success):
             if success:
                 runner_dialog.destroy()
-                project_base_path = os.path.join(output_dir, basename)
-                self._execute_project_open(project_base_path, OPEN_MODE_STARTUP, preserved_palette=palette_before_load)
-                
-                self.current_project_base_path = None
-                self._mark_project_modified()
-                messagebox.showinfo("Import Successful", "Project successfully created from image.\nUse 'Save Project As...' to save it.", parent=self.root)
-
-                try:
-                    if os.path.exists(output_dir):
-                        shutil.rmtree(output_dir)
-                        _debug(f"Cleaned up temporary import directory: {output_dir}")
-                except Exception as e:
-                    _error(f"Failed to clean up temporary directory after successful import: {e}")
+                if self._execute_project_open(project_name, OPEN_MODE_STARTUP, preserved_palette=palette_before_load, components=conversion["components"]):
+                    self._mark_project_modified()
+                    messagebox.showinfo("Import Successful", "Project successfully created from image.\nUse 'Save Project As...' to save it.", parent=self.root)
+                else:
+                    messagebox.showerror("Import Failed", "The converted project could not be loaded.", parent=self.root)
+            elif cancel_event.is_set():
+                _info("Image import cancelled during conversion.")
+                runner_dialog.destroy()
             else:
-                messagebox.showerror("Import Failed", "The import script failed to complete. See log for details.", parent=self.root)
+                messagebox.showerror("Import Failed", "The image conversion failed to complete. See log for details.", parent=self.root)
+                cancel_button.config(state=tk.DISABLED)
                 close_button.config(state=tk.NORMAL)
+                runner_dialog.protocol("WM_DELETE_WINDOW", runner_dialog.destroy)
                 runner_dialog.grab_release()
 
-        self._run_script_and_stream_output(command, log_text, on_script_complete)
+        thread = threading.Thread(target=convert_in_background)
+        thread.daemon = True
+        thread.start()
+        self._check_output_queue(log_text, output_queue, on_conversion_complete)
 
     def _cleanup_temp_dirs(self):
         """Deletes temporary directories used by the application on startup."""
@@ -16419,6 +16701,7 @@ class TileEditorApp:
 
 # --- Main Execution ---
 if __name__ == "__main__":
+    multiprocessing.freeze_support() # The image converter's worker processes start from this executable in frozen builds
     import argparse
     import webbrowser # Import for the splash screen link
     import tkinter.font as font # Import for the splash screen link font
@@ -9,15 +9,27 @@ MSXTILEFORGE_VERSION = APP_VERSION
 # --- Imports ---
 import os
 import sys
+import io
 import argparse
-from collections import Counter, defaultdict
+import functools
+import threading
+from collections import defaultdict, deque
 import numpy as np
 from PIL import Image
 from tqdm import tqdm
 import multiprocessing
-from itertools import combinations
+from multiprocessing import shared_memory
+from contextlib import contextmanager, redirect_stdout, redirect_stderr, ExitStack
 import heapq
+import time
+import hashlib
+import json
 import warnings
+from scipy.spatial import cKDTree
+try:
+    import resource # Peak RSS fallback where /proc is unavailable; missing on Windows
+except ImportError:
+    resource = None
 
 # --- Global Warning Filter ---
 warnings.filterwarnings("ignore", message='.*"Matplotlib" related API features are not available.*')
@@ -33,6 +45,23 @@ except ImportError:
 # --- MSX2 Palette Constants ---
 MSX2_MASTER_PALETTE_0_7 = [(r,g,b) for r in range(8) for g in range(8) for b in range(8)]
 MSX2_MASTER_PALETTE_0_255 = [(r * 255 // 7, g * 255 // 7, b * 255 // 7) for r, g, b in MSX2_MASTER_PALETTE_0_7]
+MSX2_MASTER_PALETTE_255_NP = np.array(MSX2_MASTER_PALETTE_0_255, dtype=np.int64)
+
+# --- Tile Cost Kernel ---
+SC4_ROW_BLOCK = 1 << 14               # 8-pixel rows per block of the whole-image SCREEN4 quantizer
+COST_BLOCK_TARGET_ELEMENTS = 1 << 22  # Pixel lookups per cost block sent to a worker
+STREAMING_BYTES_PER_NEIGHBOR = 320    # Heap entry, similarity entry and candidate slot per kept neighbour
+MERGE_REFRESH_NEIGHBORS = 64          # Nearest neighbours of a merged tile whose costs are recomputed
+CLUSTER_MAX_ITERATIONS = 50           # Lloyd iterations of the cluster-based reduction mode
+ANN_FEATURE_DIMS = 24                 # Principal components kept in the KD-tree tile features
+ANN_PCA_SAMPLE_SIZE = 4096            # Tiles sampled to fit the feature projection
+SORT_GRAPH_NEIGHBORS = 16             # Nearest neighbours per item used by the MST sort and 2-opt refinement
+RGB_SUM_CHUNK_TILES = 1 << 14         # Source tiles per chunk when summing their colours for tile synthesis
+SUPERTILE_MERGE_NEIGHBORS = 8         # Nearest supertiles per hash group kept as merge candidates
+PALETTE_SEARCH_ROWS = 4096            # 8-pixel source rows sampled to score candidate palettes
+PALETTE_SEARCH_ROW_BLOCK = 64         # Sampled rows per block when scoring all single-colour swaps
+PALETTE_SEARCH_VERIFY_SWAPS = 16      # Best-scored swaps per step checked against the exact row conversion
+PALETTE_SEARCH_COLOR_BLOCK = 1024     # Source colours per block of the CIEDE2000 distance table
 
 # --- Splash Screen ---
 def print_splash_screen(script_name, script_version):
@@ -79,58 +108,70 @@ def color_distance_rgb(c1_rgb255, c2_rgb255):
     r2,g2,b2 = c2_rgb255
     return (r1-r2)**2 + (g1-g2)**2 + (b1-b2)**2
 
-def color_distance_weighted_rgb(c1_rgb255, c2_rgb255):
-    r1,g1,b1 = c1_rgb255
-    r2,g2,b2 = c2_rgb255
-    dr, dg, db = r1-r2, g1-g2, b1-b2
-    return (30*dr)**2 + (59*dg)**2 + (11*db)**2
-
-if COLOUR_SCIENCE_AVAILABLE:
-    def color_distance_cie76(c1_rgb255, c2_rgb255):
-        rgb_array = np.array([c1_rgb255, c2_rgb255]) / 255.0
-        xyz_array = colour.sRGB_to_XYZ(rgb_array)
-        lab_array = colour.XYZ_to_Lab(xyz_array)
-        delta_e = colour.delta_E(lab_array[0], lab_array[1], method='CIE 1976')
-        return delta_e.item()
-
-    def color_distance_ciede2000(c1_rgb255, c2_rgb255):
-        rgb_array = np.array([c1_rgb255, c2_rgb255]) / 255.0
-        xyz_array = colour.sRGB_to_XYZ(rgb_array)
-        lab_array = colour.XYZ_to_Lab(xyz_array)
-        delta_e = colour.delta_E(lab_array[0], lab_array[1], method='CIE 2000')
-        return delta_e.item()
-
-def get_color_distance_function(metric_name):
-    if metric_name == 'rgb':
-        return color_distance_rgb
-    if metric_name == 'weighted-rgb':
-        return color_distance_weighted_rgb
-    if metric_name == 'cie76':
-        return color_distance_cie76
-    if metric_name == 'ciede2000':
-        return color_distance_ciede2000
-    return color_distance_weighted_rgb
+# --- Palette Distance Tables ---
+# Distances are computed once per palette as whole arrays; every later cost is a table lookup.
+RGB_METRIC_WEIGHTS = {'rgb': (1, 1, 1), 'weighted-rgb': (30, 59, 11)}
+CIE_DELTA_E_METHODS = {'cie76': 'CIE 1976', 'ciede2000': 'CIE 2000'}
+_master_palette_lab = None
+_master_distance_tables = {}
+
+def rgb255_to_lab(rgb_array_255):
+    return colour.XYZ_to_Lab(colour.sRGB_to_XYZ(np.asarray(rgb_array_255, dtype=np.float64) / 255.0))
+
+def get_master_palette_lab():
+    global _master_palette_lab
+    if _master_palette_lab is None:
+        _master_palette_lab = rgb255_to_lab(MSX2_MASTER_PALETTE_255_NP)
+    return _master_palette_lab
+
+def get_master_distance_table(metric_name):
+    # 512 x 512 distances between all MSX colours, computed once per metric.
+    if metric_name not in _master_distance_tables:
+        lab_master = get_master_palette_lab() if metric_name in CIE_DELTA_E_METHODS else None
+        distances = pairwise_color_distances(MSX2_MASTER_PALETTE_255_NP, MSX2_MASTER_PALETTE_255_NP, metric_name, lab_b=lab_master)
+        _master_distance_tables[metric_name] = distances.astype(np.float32)
+    return _master_distance_tables[metric_name]
+
+def pairwise_color_distances(colors_a_255, colors_b_255, metric_name, lab_b=None):
+    # Returns a len(a) x len(b) matrix of metric distances: squared (weighted) RGB differences or CIE delta E.
+    if metric_name in CIE_DELTA_E_METHODS:
+        lab_a = rgb255_to_lab(np.asarray(colors_a_255, dtype=np.float64).reshape(-1, 3))
+        if lab_b is None:
+            lab_b = rgb255_to_lab(np.asarray(colors_b_255, dtype=np.float64).reshape(-1, 3))
+        return colour.delta_E(lab_a[:, None, :], lab_b[None, :, :], method=CIE_DELTA_E_METHODS[metric_name])
+
+    weights = np.array(RGB_METRIC_WEIGHTS.get(metric_name, RGB_METRIC_WEIGHTS['weighted-rgb']))
+    a = np.asarray(colors_a_255).reshape(-1, 3)
+    b = np.asarray(colors_b_255).reshape(-1, 3)
+    if a.dtype.kind == 'f' or b.dtype.kind == 'f':
+        diff = a.astype(np.float64)[:, None, :] - b.astype(np.float64)[None, :, :]
+    else:
+        diff = a.astype(np.int64)[:, None, :] - b.astype(np.int64)[None, :, :]
+    return ((diff * weights) ** 2).sum(axis=2)
 
-# --- Helper Functions ---
-def find_closest_msx_color(rgb_tuple_0_255, color_dist_func, exclude_colors_0_7=None):
-    min_dist = float('inf')
-    closest_msx_color_0_7 = (0,0,0)
-    exclude_set = set(exclude_colors_0_7) if exclude_colors_0_7 else set()
-
-    for idx, msx_color_candidate in enumerate(MSX2_MASTER_PALETTE_0_255):
-        msx_color_0_7 = MSX2_MASTER_PALETTE_0_7[idx]
-        if msx_color_0_7 in exclude_set:
-            continue
-            
-        dist = color_dist_func(rgb_tuple_0_255, msx_color_candidate)
-        if dist < min_dist:
-            min_dist = dist
-            closest_msx_color_0_7 = msx_color_0_7
-        if dist == 0:
-            break
-    return closest_msx_color_0_7
+def build_palette_distance_matrix(palette_255, metric_name):
+    return pairwise_color_distances(palette_255, palette_255, metric_name)
+
+def build_palette_features(palette_255, metric_name):
+    # Per-slot coordinates where Euclidean distance follows the metric (exactly for the RGB metrics).
+    if metric_name in CIE_DELTA_E_METHODS:
+        return rgb255_to_lab(palette_255)
+    weights = np.array(RGB_METRIC_WEIGHTS.get(metric_name, RGB_METRIC_WEIGHTS['weighted-rgb']), dtype=np.float64)
+    return np.asarray(palette_255, dtype=np.float64).reshape(-1, 3) * weights
 
-def find_best_auto_colors_neutral(image: Image.Image, num_auto_colors: int, fixed_colors_0_7: list, color_dist_func):
+# --- Helper Functions ---
+def find_closest_msx_color(rgb_tuple_0_255, color_metric, exclude_colors_0_7=None):
+    lab_master = get_master_palette_lab() if color_metric in CIE_DELTA_E_METHODS else None
+    distances = pairwise_color_distances([rgb_tuple_0_255], MSX2_MASTER_PALETTE_255_NP, color_metric, lab_b=lab_master)[0]
+    if exclude_colors_0_7:
+        distances = distances.astype(np.float64)
+        for r, g, b in set(exclude_colors_0_7):
+            distances[r * 64 + g * 8 + b] = np.inf
+        if np.isinf(distances).all():
+            return (0,0,0)
+    return MSX2_MASTER_PALETTE_0_7[int(np.argmin(distances))]
+
+def find_best_auto_colors_neutral(image: Image.Image, num_auto_colors: int, fixed_colors_0_7: list, color_metric):
     if num_auto_colors <= 0:
         return []
     
@@ -153,7 +194,7 @@ def find_best_auto_colors_neutral(image: Image.Image, num_auto_colors: int, fixe
     auto_colors_0_7_list = []
     
     for r255,g255,b255 in ideal_colors_255:
-        msx_color_0_7 = find_closest_msx_color((r255,g255,b255), color_dist_func, exclude_colors_0_7=fixed_colors_0_7)
+        msx_color_0_7 = find_closest_msx_color((r255,g255,b255), color_metric, exclude_colors_0_7=fixed_colors_0_7)
         if msx_color_0_7 not in auto_colors_0_7_set and msx_color_0_7 not in fixed_colors_0_7:
             auto_colors_0_7_set.add(msx_color_0_7)
             auto_colors_0_7_list.append(msx_color_0_7)
@@ -169,10 +210,10 @@ def find_best_auto_colors_neutral(image: Image.Image, num_auto_colors: int, fixe
             
     return auto_colors_0_7_list[:num_auto_colors]
 
-def find_best_auto_colors_sharp(image: Image.Image, num_auto_colors: int, fixed_colors_0_7: list, color_dist_func):
-    return find_best_auto_colors_neutral(image, num_auto_colors, fixed_colors_0_7, color_dist_func)
+def find_best_auto_colors_sharp(image: Image.Image, num_auto_colors: int, fixed_colors_0_7: list, color_metric):
+    return find_best_auto_colors_neutral(image, num_auto_colors, fixed_colors_0_7, color_metric)
 
-def find_best_auto_colors_soft(image: Image.Image, num_auto_colors: int, fixed_colors_0_7: list, color_dist_func):
+def find_best_auto_colors_soft(image: Image.Image, num_auto_colors: int, fixed_colors_0_7: list, color_metric):
     if num_auto_colors <= 0:
         return []
 
@@ -196,7 +237,7 @@ def find_best_auto_colors_soft(image: Image.Image, num_auto_colors: int, fixed_c
     for r255,g255,b255 in ideal_colors_255:
         if len(auto_colors_0_7_list) >= num_auto_colors:
             break
-        msx_color_0_7 = find_closest_msx_color((r255,g255,b255), color_dist_func, exclude_colors_0_7=fixed_colors_0_7)
+        msx_color_0_7 = find_closest_msx_color((r255,g255,b255), color_metric, exclude_colors_0_7=fixed_colors_0_7)
         if msx_color_0_7 not in auto_colors_0_7_set and msx_color_0_7 not in fixed_colors_0_7:
             auto_colors_0_7_set.add(msx_color_0_7)
             auto_colors_0_7_list.append(msx_color_0_7)
@@ -287,219 +328,898 @@ def process_palette_constraints(args):
                 print(f"Warning: Invalid slot index '{idx_str}' in --palette-slot. Must be an integer. Ignoring.")
     return rules
 
-def _offset_worker_initializer(img_data):
-    global worker_img_data, worker_height, worker_width
-    worker_img_data = img_data
-    worker_height, worker_width = img_data.shape
-
-def _calculate_offset_score_worker(offset):
-    dx, dy = offset
-    current_score = 0
-    num_tile_rows = (worker_height - dy) // 8
-    num_tile_cols = (worker_width - dx) // 8
-
-    for ty in range(num_tile_rows):
-        for tx in range(num_tile_cols):
-            y_start = dy + ty * 8
-            x_start = dx + tx * 8
-            tile = worker_img_data[y_start : y_start + 8, x_start : x_start + 8]
-            
-            if tile.shape != (8, 8):
+def color_pair_table(palette_dist_matrix):
+    # All colour pairs (a <= b) and, per source colour, the distance to the nearer colour of each pair.
+    pair_a, pair_b = np.triu_indices(palette_dist_matrix.shape[0])
+    return pair_a, pair_b, np.minimum(palette_dist_matrix[:, pair_a], palette_dist_matrix[:, pair_b])
+
+def quantize_rows_for_screen4(rows, palette_dist_matrix, best_pairs=False, pair_table=None):
+    # Reduces (N, 8) runs of palette indices to SCREEN4 pattern/colour bytes, two colours per run.
+    num_rows, num_colors = len(rows), palette_dist_matrix.shape[0]
+    row_ids = np.arange(num_rows)
+    counts = np.bincount((row_ids[:, None] * num_colors + rows).ravel(), minlength=num_rows * num_colors).reshape(num_rows, num_colors)
+
+    # The two most frequent colours; ties go to the colour seen first, as with Counter.most_common
+    first_seen = np.full((num_rows, num_colors), 8, dtype=np.int64)
+    for col in range(7, -1, -1):
+        first_seen[row_ids, rows[:, col]] = col
+    rank = np.where(counts > 0, counts * 9 + (8 - first_seen), -1)
+    color1 = rank.argmax(axis=1)
+    rank[row_ids, color1] = -1
+    color2 = np.where(rank.max(axis=1) >= 0, rank.argmax(axis=1), color1)
+
+    if best_pairs:
+        # Error of every candidate pair from the row histogram; keep the frequent pair unless another is strictly better
+        pair_a, pair_b, pair_costs = pair_table if pair_table is not None else color_pair_table(palette_dist_matrix)
+        pair_errors = counts @ pair_costs
+        best = pair_errors.argmin(axis=1)
+        default_errors = (counts * np.minimum(palette_dist_matrix[:, color1], palette_dist_matrix[:, color2]).T).sum(axis=1)
+        improved = pair_errors[row_ids, best] < default_errors - 1e-6
+        color1 = np.where(improved, pair_a[best], color1)
+        color2 = np.where(improved, pair_b[best], color2)
+
+    c1, c2 = color1[:, None], color2[:, None]
+    closer_to_c1 = palette_dist_matrix[rows, c1] <= palette_dist_matrix[rows, c2]
+    remapped = np.where(rows == c1, c1, np.where(rows == c2, c2, np.where(closer_to_c1, c1, c2)))
+    bg_idx, fg_idx = np.minimum(color1, color2), np.maximum(color1, color2)
+    pattern_data = np.packbits(remapped == fg_idx[:, None], axis=1)[:, 0]
+    color_data = ((fg_idx << 4) | bg_idx).astype(np.uint8)
+    return pattern_data, color_data
+
+def quantize_rows_in_blocks(rows, palette_dist_matrix, best_pairs=False, desc=None):
+    # Runs the row quantizer over SC4_ROW_BLOCK rows at a time to bound temporary memory.
+    pattern_data = np.empty(len(rows), dtype=np.uint8)
+    color_data = np.empty(len(rows), dtype=np.uint8)
+    pair_table = color_pair_table(palette_dist_matrix) if best_pairs else None
+    for row_start in tqdm(range(0, len(rows), SC4_ROW_BLOCK), desc=desc, disable=desc is None):
+        row_end = min(row_start + SC4_ROW_BLOCK, len(rows))
+        pattern_data[row_start:row_end], color_data[row_start:row_end] = quantize_rows_for_screen4(
+            rows[row_start:row_end], palette_dist_matrix, best_pairs, pair_table)
+    return pattern_data, color_data
+
+def quantize_image_to_sc4_arrays(indices_np, palette_dist_matrix, best_pairs=False, desc="   Processing Tiles"):
+    # Whole-image SCREEN4 conversion into (tiles, 8) pattern and colour arrays, tiles in row-major order.
+    height, width = indices_np.shape
+    tile_rows = indices_np.reshape(height // 8, 8, width // 8, 8).swapaxes(1, 2).reshape(-1, 8)
+    pattern_data, color_data = quantize_rows_in_blocks(tile_rows, palette_dist_matrix, best_pairs, desc=desc)
+    return pattern_data.reshape(-1, 8), color_data.reshape(-1, 8)
+
+def score_tiling_offsets(indices_np, palette_dist_matrix, criterion='error', best_pairs=False):
+    # Scores all 64 tile grid offsets in one pass: the 8-pixel row windows of each horizontal phase are
+    # converted once, and their per-row scores are then summed over the tile rows of each vertical phase.
+    height, width = indices_np.shape
+    scores = {}
+    for dx in tqdm(range(8), desc="   Finding best offset", leave=False, unit="phase"):
+        num_cols = (width - dx) // 8
+        if num_cols == 0 or height < 8:
+            continue
+        windows = np.ascontiguousarray(indices_np[:, dx:dx + num_cols * 8]).reshape(-1, 8)
+        if criterion == 'clash': # Rows that need more than two colours
+            num_distinct = np.count_nonzero(np.diff(np.sort(windows, axis=1), axis=1), axis=1) + 1
+            row_totals = (num_distinct > 2).reshape(height, num_cols).sum(axis=1)
+        else:
+            pattern_data, color_data = quantize_rows_in_blocks(windows, palette_dist_matrix, best_pairs)
+        if criterion == 'error': # Palette distance between the source rows and their two-colour conversion
+            is_foreground = np.unpackbits(pattern_data[:, None], axis=1).astype(bool)
+            converted = np.where(is_foreground, (color_data >> 4)[:, None], (color_data & 0x0F)[:, None])
+            row_totals = palette_dist_matrix[windows, converted].sum(axis=1).reshape(height, num_cols).sum(axis=1)
+
+        for dy in range(8):
+            num_rows = (height - dy) // 8
+            if num_rows == 0:
                 continue
+            band = slice(dy, dy + num_rows * 8)
+            if criterion == 'tiles': # Distinct converted tiles
+                tile_bytes = np.concatenate([
+                    data.reshape(height, num_cols)[band].reshape(num_rows, 8, num_cols).transpose(0, 2, 1)
+                    for data in (pattern_data, color_data)], axis=2)
+                tile_keys = np.ascontiguousarray(tile_bytes).reshape(-1, 16).view(np.dtype((np.void, 16)))
+                scores[(dx, dy)] = len(np.unique(tile_keys))
+            else:
+                scores[(dx, dy)] = row_totals[band].sum().item()
+    return scores
 
-            for r in range(8):
-                if len(np.unique(tile[r, :])) > 2:
-                    current_score += 1
-    
-    return current_score, offset
-
-def find_best_tiling_offset(quantized_image, num_cores):
-    img_data = np.array(quantized_image)
-    tasks = [(dx, dy) for dy in range(8) for dx in range(8)]
-    
-    results = []
-    init_args = (img_data,)
-    with multiprocessing.Pool(processes=num_cores, initializer=_offset_worker_initializer, initargs=init_args) as pool:
-        for result in tqdm(pool.imap_unordered(_calculate_offset_score_worker, tasks), total=len(tasks), desc="   Finding best offset", leave=False, unit="offset"):
-            results.append(result)
-            
-    if not results:
+def find_best_tiling_offset(quantized_image, palette_dist_matrix, criterion='error', best_pairs=False):
+    scores = score_tiling_offsets(np.array(quantized_image), palette_dist_matrix, criterion, best_pairs)
+    if not scores:
         return (0, 0)
-        
-    best_score, best_offset = min(results, key=lambda item: item[0])
-    return best_offset
+    return min(((dx, dy) for dy in range(8) for dx in range(8) if (dx, dy) in scores), key=scores.get)
 
-def process_tile_for_screen4(tile_indices_np, palette_0_255, color_dist_func):
-    pattern_data=np.zeros(8,dtype=np.uint8)
-    color_data=np.zeros(8,dtype=np.uint8)
-    for r in range(8):
-        row_indices=tile_indices_np[r]
-        counts=Counter(row_indices)
-        bg_idx,fg_idx=0,0
-        if len(counts)>2:
-            (c1_idx,_),(c2_idx,_) = counts.most_common(2)
-            bg_idx,fg_idx=sorted([c1_idx,c2_idx])
-            c1_rgb=palette_0_255[c1_idx]
-            c2_rgb=palette_0_255[c2_idx]
-            new_row=np.copy(row_indices)
-            for c in range(8):
-                original_idx=row_indices[c]
-                if original_idx!=c1_idx and original_idx!=c2_idx:
-                    original_rgb=palette_0_255[original_idx]
-                    dist1=color_dist_func(original_rgb,c1_rgb)
-                    dist2=color_dist_func(original_rgb,c2_rgb)
-                    new_row[c]=c1_idx if dist1<=dist2 else c2_idx
-            row_indices=new_row
-        elif len(counts)==2:
-            c1_idx,c2_idx=counts.keys()
-            bg_idx,fg_idx=sorted([c1_idx,c2_idx])
-        elif len(counts)==1:
-            bg_idx=fg_idx=list(counts.keys())[0]
-        color_data[r]=(fg_idx<<4)|bg_idx
-        row_pattern_byte=0
-        for c in range(8):
-            if row_indices[c]==fg_idx:
-                row_pattern_byte|=(1<<(7-c))
-        pattern_data[r]=row_pattern_byte
-    return pattern_data,color_data
-
-def calculate_tile_difference(tile1_tuple, tile2_tuple, palette_255, color_dist_func):
-    pattern1, color1 = tile1_tuple
-    pattern2, color2 = tile2_tuple
-    total_damage = 0
-    def _get_pixel_rgb(row, col, pattern_data, color_data):
-        pattern_byte = pattern_data[row]
-        color_byte = color_data[row]
-        is_foreground = (pattern_byte >> (7 - col)) & 1
-        palette_idx = (color_byte >> 4) & 0x0F if is_foreground else color_byte & 0x0F
-        return palette_255[palette_idx]
-    for r in range(8):
-        for c in range(8):
-            rgb1 = _get_pixel_rgb(r, c, pattern1, color1)
-            rgb2 = _get_pixel_rgb(r, c, pattern2, color2)
-            total_damage += color_dist_func(rgb1, rgb2)
-    return total_damage
+def expand_sc4_tile(tile_tuple):
+    # Returns the 8x8 palette indices encoded by a (pattern, color) tile.
+    pattern_data, color_data = tile_tuple
+    is_foreground = np.unpackbits(np.asarray(pattern_data, dtype=np.uint8)[:, None], axis=1).astype(bool)
+    color_data = np.asarray(color_data, dtype=np.uint8)
+    return np.where(is_foreground, (color_data >> 4)[:, None], (color_data & 0x0F)[:, None])
+
+def expand_sc4_tiles(tiles):
+    # Expands a list of (pattern, color) tiles into an (N, 64) palette index array.
+    pattern_data = np.array([pattern for pattern, _ in tiles], dtype=np.uint8).reshape(-1, 8)
+    color_data = np.array([color for _, color in tiles], dtype=np.uint8).reshape(-1, 8)
+    is_foreground = np.unpackbits(pattern_data[:, :, None], axis=2).astype(bool)
+    return np.where(is_foreground, (color_data >> 4)[:, :, None], (color_data & 0x0F)[:, :, None]).reshape(-1, 64)
+
+def calculate_tile_cost_block(expanded_tiles, tile_counts, palette_dist_matrix, row_start, row_end):
+    # Costs of all pairs (i, j) with row_start <= i < row_end and j > i, as whole-array lookups.
+    # Returned in condensed order (upper triangle, row by row); identical tiles give a zero cost.
+    num_tiles, num_colors = len(expanded_tiles), palette_dist_matrix.shape[0]
+    flat_dist = palette_dist_matrix.ravel()
+    rows = expanded_tiles[row_start:row_end].astype(np.intp) * num_colors
+    cols = expanded_tiles[row_start + 1:].astype(np.intp)
+    diffs = flat_dist[rows[:, None, :] + cols[None, :, :]].sum(axis=2)
+
+    idx1 = np.arange(row_start, row_end)[:, None]
+    idx2 = np.arange(row_start + 1, num_tiles)[None, :]
+    costs = diffs * np.minimum(tile_counts[idx1], tile_counts[idx2]) # Cost is weighted by the losing tile's count
+    return costs[idx2 > idx1]
+
+def condensed_offset(num_tiles, row):
+    # Position of pair (row, row + 1) in the condensed upper-triangle order.
+    return row * (2 * num_tiles - row - 1) // 2
+
+def condensed_pair_indices(num_tiles, row_start, row_end):
+    # (i, j) index arrays of the condensed pairs whose first tile lies in [row_start, row_end).
+    rows = np.arange(row_start, row_end)
+    lengths = num_tiles - 1 - rows
+    idx1 = np.repeat(rows, lengths)
+    idx2 = np.arange(len(idx1)) - np.repeat(np.cumsum(lengths) - lengths, lengths) + idx1 + 1
+    return idx1, idx2
+
+def calculate_tile_neighbor_block(expanded_tiles, tile_counts, palette_dist_matrix, row_start, row_end, num_neighbors):
+    # The num_neighbors cheapest partners of each tile in [row_start, row_end), searched over all tiles.
+    num_tiles, num_colors = len(expanded_tiles), palette_dist_matrix.shape[0]
+    flat_dist = palette_dist_matrix.ravel()
+    rows = expanded_tiles[row_start:row_end].astype(np.intp) * num_colors
+    cols = expanded_tiles.astype(np.intp)
+    diffs = flat_dist[rows[:, None, :] + cols[None, :, :]].sum(axis=2)
+    costs = diffs * np.minimum(tile_counts[row_start:row_end, None], tile_counts[None, :])
+
+    ranking = costs.astype(np.float64)
+    ranking[diffs == 0] = np.inf # Also excludes each tile's pairing with itself
+    k = min(num_neighbors, num_tiles - 1)
+    nearest = np.argpartition(ranking, k - 1, axis=1)[:, :k]
+    nearest = np.take_along_axis(nearest, np.argsort(np.take_along_axis(ranking, nearest, axis=1), axis=1), axis=1)
+    is_valid = np.isfinite(np.take_along_axis(ranking, nearest, axis=1))
+    return np.take_along_axis(costs, nearest, axis=1), nearest, is_valid
+
+# --- Palette Search ---
+# Candidate palettes are judged by the error of 8-pixel rows sampled from the images. Source colours get one
+# distance table against all 512 MSX colours (CIE metrics use the precomputed master Lab values), so scoring a
+# palette is a table lookup. A fast estimate (each row takes its best colour pair of the source pixels) ranks
+# every single-colour swap; the best ranked are checked by converting the rows as the pipeline does.
+def master_palette_ids(colors_0_7):
+    return [r * 64 + g * 8 + b for r, g, b in colors_0_7]
+
+def sample_palette_rows(images, num_rows, rng):
+    # Up to num_rows random tile-aligned 8-pixel rows, shared out by image size. Returns the distinct source
+    # colours, the rows as indices into them (identical rows merged) and the row weights.
+    runs_per_line = [image.width // 8 for image in images]
+    image_runs = [image.height * line_runs for image, line_runs in zip(images, runs_per_line)]
+    sampled = []
+    for image, line_runs, num_runs in zip(images, runs_per_line, image_runs):
+        if num_runs == 0:
+            continue
+        count = min(num_runs, max(1, round(num_rows * num_runs / sum(image_runs))))
+        lines, columns = np.divmod(rng.choice(num_runs, count, replace=False), line_runs)
+        for y in np.unique(lines):
+            line = np.asarray(image.crop((0, int(y), line_runs * 8, int(y) + 1)).convert('RGB')).reshape(-1, 8, 3)
+            sampled.append(line[columns[lines == y]])
+    if not sampled:
+        return np.zeros((0, 3), dtype=np.uint8), np.zeros((0, 8), dtype=np.intp), np.zeros(0, dtype=np.float32)
+    source_colors, pixel_colors = np.unique(np.concatenate(sampled).reshape(-1, 3), axis=0, return_inverse=True)
+    rows, weights = np.unique(pixel_colors.reshape(-1, 8), axis=0, return_counts=True)
+    return source_colors, rows, weights.astype(np.float32)
+
+def source_to_master_distances(source_colors, metric_name, deadline):
+    # Distances from the source colours to all 512 MSX colours. Euclidean metrics take one matrix product over
+    # the metric features; CIEDE2000 goes block by block and gives up (None) once the deadline passes.
+    if metric_name == 'ciede2000':
+        source_lab, lab_master = rgb255_to_lab(source_colors), get_master_palette_lab()
+        distances = np.empty((len(source_colors), len(lab_master)), dtype=np.float32)
+        for start in range(0, len(source_colors), PALETTE_SEARCH_COLOR_BLOCK):
+            if time.monotonic() >= deadline:
+                return None
+            block_lab = source_lab[start:start + PALETTE_SEARCH_COLOR_BLOCK]
+            distances[start:start + len(block_lab)] = colour.delta_E(block_lab[:, None, :], lab_master[None, :, :], method='CIE 2000')
+        return distances
+    features = build_palette_features(source_colors, metric_name)
+    master_features = get_master_palette_lab() if metric_name in CIE_DELTA_E_METHODS else build_palette_features(MSX2_MASTER_PALETTE_255_NP, metric_name)
+    squared = (features ** 2).sum(axis=1)[:, None] + (master_features ** 2).sum(axis=1)[None, :] - 2 * features @ master_features.T
+    squared = np.maximum(squared, 0)
+    return (np.sqrt(squared) if metric_name in CIE_DELTA_E_METHODS else squared).astype(np.float32)
+
+def palette_pair_errors(row_costs):
+    # (rows, 8, K) pixel costs against the palette -> (rows, K, K) error of every colour pair per row.
+    return np.minimum(row_costs[:, :, :, None], row_costs[:, :, None, :]).sum(axis=1)
+
+def score_palette_swaps(arrays, palette_ids, free_slots, deadline=None):
+    # Estimated error of every palette with one free slot swapped for any MSX colour: a row keeps its best pair
+    # without the swapped slot, or pairs the new colour with a remaining one (or uses it alone).
+    # Returns None if the deadline passes before all rows are scored.
+    rows, weights, source_dist = arrays["rows"], arrays["weights"], arrays["source_dist"]
+    swap_errors = np.zeros((len(free_slots), source_dist.shape[1]))
+    for row_start in range(0, len(rows), PALETTE_SEARCH_ROW_BLOCK):
+        if deadline is not None and time.monotonic() >= deadline:
+            return None
+        block_weights = weights[row_start:row_start + PALETTE_SEARCH_ROW_BLOCK]
+        candidate_costs = source_dist[rows[row_start:row_start + PALETTE_SEARCH_ROW_BLOCK]]
+        row_costs = candidate_costs[:, :, palette_ids]
+        pair_errors = palette_pair_errors(row_costs)
+
+        new_pair_errors = np.zeros((len(block_weights), source_dist.shape[1], len(palette_ids)), dtype=np.float32)
+        for col in range(8):
+            new_pair_errors += np.minimum(candidate_costs[:, col, :, None], row_costs[:, col, None, :])
+        alone_errors = candidate_costs.sum(axis=1)
+        nearest_slot = new_pair_errors.argmin(axis=2)
+        nearest_errors = np.take_along_axis(new_pair_errors, nearest_slot[:, :, None], axis=2)[:, :, 0]
+        np.put_along_axis(new_pair_errors, nearest_slot[:, :, None], np.inf, axis=2)
+        second_errors = new_pair_errors.min(axis=2)
+
+        for i, slot in enumerate(free_slots):
+            without_slot = pair_errors.copy()
+            without_slot[:, slot, :] = np.inf
+            without_slot[:, :, slot] = np.inf
+            with_new = np.minimum(np.where(nearest_slot == slot, second_errors, nearest_errors), alone_errors)
+            swap_errors[i] += block_weights @ np.minimum(without_slot.min(axis=(1, 2))[:, None], with_new)
+    return swap_errors
+
+def palette_row_error(arrays, palette_ids, best_pairs):
+    # Error of the rows as converted by the pipeline: pixels remapped to the nearest palette colour (plain RGB,
+    # as the image remap does), then reduced to two colours per row by the SCREEN4 row quantizer.
+    rows = arrays["rows"]
+    remapped = arrays["source_rgb_dist"][rows][:, :, palette_ids].argmin(axis=2)
+    pattern_data, color_data = quantize_rows_for_screen4(remapped, arrays["master_dist"][np.ix_(palette_ids, palette_ids)], best_pairs)
+    is_fg = np.unpackbits(pattern_data[:, None], axis=1).astype(bool)
+    shown_ids = palette_ids[np.where(is_fg, (color_data >> 4)[:, None], (color_data & 0x0F)[:, None])]
+    return float(arrays["weights"] @ arrays["source_dist"][rows, shown_ids].sum(axis=1))
+
+def search_palette_locally(arrays, fixed_ids, auto_ids, best_pairs, deadline):
+    # Descent over single-colour swaps of the auto slots, until no checked swap lowers the error or time runs out.
+    # A step is only started when the time left covers the last one. Also returns the longest step's duration.
+    palette_ids = np.array(fixed_ids + auto_ids)
+    free_slots = np.arange(len(fixed_ids), len(palette_ids))
+    error = palette_row_error(arrays, palette_ids, best_pairs)
+    step_seconds = 0.0
+    while deadline - time.monotonic() > step_seconds:
+        step_start = time.monotonic()
+        swap_errors = score_palette_swaps(arrays, palette_ids, free_slots, deadline)
+        if swap_errors is None:
+            break
+        swap_errors[:, palette_ids] = np.inf # Colours already in the palette
+        best_swap = None
+        for flat_idx in np.argsort(swap_errors, axis=None)[:PALETTE_SEARCH_VERIFY_SWAPS]:
+            if time.monotonic() >= deadline:
+                break
+            slot, color = np.unravel_index(flat_idx, swap_errors.shape)
+            candidate_ids = palette_ids.copy()
+            candidate_ids[free_slots[slot]] = color
+            candidate_error = palette_row_error(arrays, candidate_ids, best_pairs)
+            if candidate_error < error * (1 - 1e-9):
+                error, best_swap = candidate_error, candidate_ids
+        step_seconds = max(step_seconds, time.monotonic() - step_start)
+        if best_swap is None:
+            break
+        palette_ids = best_swap
+    return error, palette_ids[len(fixed_ids):].tolist(), step_seconds
+
+def _search_palette_worker(args):
+    fixed_ids, auto_ids, best_pairs, time_budget = args
+    return search_palette_locally(worker_arrays, fixed_ids, auto_ids, best_pairs, time.monotonic() + time_budget)
+
+def random_palette_start(source_colors, rows, weights, num_colors, excluded_ids, rng):
+    # Distinct MSX colours drawn by how often they are the nearest one to a sampled pixel, topped up at random.
+    nearest = np.rint(source_colors.astype(np.float64) * 7 / 255).astype(np.intp) @ np.array([64, 8, 1])
+    frequency = np.bincount(nearest[rows].ravel(), weights=np.repeat(weights, 8), minlength=len(MSX2_MASTER_PALETTE_0_7))
+    frequency[excluded_ids] = 0
+    present = np.flatnonzero(frequency)
+    picked = rng.choice(present, min(num_colors, len(present)), replace=False, p=frequency[present] / frequency[present].sum()).tolist()
+    if len(picked) < num_colors:
+        others = np.setdiff1d(np.arange(len(MSX2_MASTER_PALETTE_0_7)), list(excluded_ids) + picked)
+        picked += rng.choice(others, num_colors - len(picked), replace=False).tolist()
+    return picked
+
+def search_auto_colors(images, auto_colors_0_7, fixed_colors_0_7, color_metric, time_budget, num_cores, best_pairs=False, cancel_event=None):
+    # Multi-start local search over the 512 MSX colours for the auto slots. The given auto colours are the first
+    # start and further starts are drawn from the image colours; rounds of num_cores starts run in parallel
+    # until the time budget, which includes building the distance tables, is spent. Returns the auto colours of
+    # the lowest row error.
+    deadline = time.monotonic() + time_budget
+    rng = np.random.default_rng(0)
+    source_colors, rows, weights = sample_palette_rows(images, PALETTE_SEARCH_ROWS, rng)
+    if not auto_colors_0_7 or len(rows) == 0:
+        return auto_colors_0_7
+    print(f"   Searching auto palette colours for {time_budget:g}s on {num_cores} cores...")
+    source_dist = source_to_master_distances(source_colors, color_metric, deadline)
+    if source_dist is None:
+        print("   [INFO] Palette search: the time budget ran out while building the distance table; keeping the palette.")
+        return auto_colors_0_7
+    search_arrays = {
+        "rows": rows,
+        "weights": weights,
+        "source_dist": source_dist,
+        "source_rgb_dist": source_to_master_distances(source_colors, 'rgb', deadline),
+        "master_dist": get_master_distance_table(color_metric),
+    }
+    fixed_ids, seed_ids = master_palette_ids(fixed_colors_0_7), master_palette_ids(auto_colors_0_7)
+    seed_error = palette_row_error(search_arrays, np.array(fixed_ids + seed_ids), best_pairs)
+
+    def run_starts(run_round):
+        # A round is only started when the time left covers the longest step measured so far
+        results, starts = [], [seed_ids]
+        while not results or deadline - time.monotonic() > max(step_seconds for _, _, step_seconds in results):
+            check_cancelled(cancel_event)
+            while len(starts) < num_cores:
+                starts.append(random_palette_start(source_colors, rows, weights, len(seed_ids), fixed_ids, rng))
+            results += run_round([(fixed_ids, start, best_pairs, max(0.0, deadline - time.monotonic())) for start in starts])
+            starts = []
+        return results
+
+    if num_cores > 1:
+        with shared_arrays(**search_arrays) as (_, array_specs):
+            with worker_pool(num_cores, initializer=_init_shared_worker, initargs=(array_specs,)) as pool:
+                results = run_starts(lambda jobs: pool.map(_search_palette_worker, jobs))
+    else:
+        results = run_starts(lambda jobs: [search_palette_locally(search_arrays, *job[:3], time.monotonic() + job[3]) for job in jobs])
+    best_error, best_ids, _ = min(results, key=lambda result: result[0])
+    num_pixels = float(weights.sum()) * 8
+    print(f"   [INFO] Palette search over {len(results)} starting palettes, row error per pixel {seed_error / num_pixels:.1f} -> {best_error / num_pixels:.1f}.")
+    if best_error >= seed_error:
+        return auto_colors_0_7
+    return [MSX2_MASTER_PALETTE_0_7[i] for i in best_ids]
+
+# --- Stage Cache ---
+def image_cache_key(image):
+    digest = hashlib.sha256(repr((image.mode, image.size)).encode())
+    if image.mode == 'P':
+        digest.update(bytes(image.getpalette() or []))
+    digest.update(image.tobytes())
+    return digest.hexdigest()
+
+def derive_stage_cache(cache, stage, *params):
+    # A stage's cache handle is (cache_dir, key); the key chains the parent stage's key with the parameters
+    # this stage depends on, so changing a late-stage parameter keeps every earlier entry valid.
+    if cache is None:
+        return None
+    cache_dir, parent_key = cache
+    return cache_dir, hashlib.sha256(repr((parent_key, stage, params)).encode()).hexdigest()
+
+def cached_stage(cache, stage, compute):
+    # Returns the dict of arrays of a stage: loaded from the cache directory when present, otherwise
+    # computed and stored. compute() must return a dict of numpy arrays.
+    if cache is None:
+        return compute()
+    cache_dir, key = cache
+    path = os.path.join(cache_dir, f"{stage}-{key}.npz")
+    try:
+        with np.load(path, allow_pickle=False) as data:
+            arrays = {name: data[name] for name in data.files}
+        print(f"   [INFO] Reusing cached {stage} ({key[:12]}).")
+        return arrays
+    except FileNotFoundError:
+        pass
+    except Exception as e:
+        print(f"   [WARN] Ignoring unreadable cache entry '{path}': {e}")
 
-def pad_image_to_tile_size(image: Image.Image):
-    width, height = image.size
-    pad_right = (8 - (width % 8)) % 8
-    pad_bottom = (8 - (height % 8)) % 8
-    if pad_right==0 and pad_bottom==0:
-        return image
-    new_width = width + pad_right
-    new_height = height + pad_bottom
-    padded_image = Image.new('P', (new_width, new_height), color=0)
-    padded_image.putpalette(image.getpalette())
-    padded_image.paste(image, (0, 0))
-    return padded_image
+    arrays = compute()
+    temp_path = f"{path}.{os.getpid()}.tmp"
+    try:
+        os.makedirs(cache_dir, exist_ok=True)
+        with open(temp_path, "wb") as f:
+            np.savez(f, **arrays)
+        os.replace(temp_path, path) # Readers never see a partial entry
+    except OSError as e:
+        print(f"   [WARN] Could not write cache entry '{path}': {e}")
+    return arrays
+
+def iter_cost_blocks(num_tiles, num_cores, full_rows=False):
+    # Lazily yields row ranges sized so each block's lookup array stays around COST_BLOCK_TARGET_ELEMENTS.
+    rows_per_block = max(1, COST_BLOCK_TARGET_ELEMENTS // max(1, num_tiles * 64))
+    rows_per_block = min(rows_per_block, max(1, num_tiles // (num_cores * 4)))
+    last_row = num_tiles if full_rows else num_tiles - 1
+    for start in range(0, last_row, rows_per_block):
+        yield (start, min(start + rows_per_block, last_row))
+
+def choose_neighbor_count(num_tiles, max_memory_mb, num_cores):
+    # Largest k whose O(N*k) neighbour structures fit the budget next to the workers' block buffers.
+    block_bytes = COST_BLOCK_TARGET_ELEMENTS * 16 * num_cores
+    budget_bytes = max_memory_mb * 1024 * 1024 - block_bytes
+    num_neighbors = budget_bytes // max(1, num_tiles * STREAMING_BYTES_PER_NEIGHBOR)
+    return int(max(1, min(num_tiles - 1, num_neighbors)))
+
+def calculate_pair_cost_array(expanded_tiles, tile_counts, palette_dist_matrix, num_cores, cancel_event=None):
+    # Condensed (i < j) costs of all tile pairs, filled block by block by the worker pool. A cancellation
+    # leaves the pool's context, which terminates the workers.
+    num_tiles = len(expanded_tiles)
+    num_pairs = num_tiles * (num_tiles - 1) // 2
+    print(f"   Initializing worker pool on {num_cores} cores...")
+    with shared_arrays(expanded_tiles=expanded_tiles, tile_counts=tile_counts, palette_dist=palette_dist_matrix,
+                       pair_costs=((num_pairs,), np.float64)) as (arrays, array_specs):
+        with worker_pool(num_cores, initializer=_init_shared_worker, initargs=(array_specs,)) as pool:
+            with tqdm(total=num_pairs, desc="   Pre-calculating costs", mininterval=10.0) as pbar:
+                for row_start, row_end in pool.imap_unordered(_calculate_cost_block_worker, iter_cost_blocks(num_tiles, num_cores)):
+                    check_cancelled(cancel_event)
+                    pbar.update(condensed_offset(num_tiles, row_end) - condensed_offset(num_tiles, row_start))
+        return arrays["pair_costs"].copy()
+
+def compute_all_pair_costs(expanded_tiles, tile_counts, palette_dist_matrix, num_cores, cache=None, cancel_event=None):
+    # Exact mode: every pair with a non-zero cost goes to the heap and the similarity map. The heap still
+    # holds one tuple per pair, so memory stays quadratic in the tile count.
+    num_tiles = len(expanded_tiles)
+    num_pairs = num_tiles * (num_tiles - 1) // 2
+    merge_heap = []
+    similarity_map = defaultdict(list)
+    print(f"   Generating memory structure for {num_pairs} tile pairs...")
+    if num_pairs:
+        pair_costs = cached_stage(cache, "pair-costs", lambda: {
+            "pair_costs": calculate_pair_cost_array(expanded_tiles, tile_counts, palette_dist_matrix, num_cores, cancel_event)})["pair_costs"]
+        # One float per kept pair and one int per tile, shared by the heap and both similarity map entries
+        kept = pair_costs != 0
+        cost_objects = pair_costs[kept].tolist()
+        kept_positions = np.cumsum(kept) - 1
+        tile_objects = list(range(num_tiles))
+        # Heap entries are added one row block at a time, so only one block's index arrays exist next to the heap
+        for row_start, row_end in iter_cost_blocks(num_tiles, num_cores):
+            check_cancelled(cancel_event)
+            first, last = condensed_offset(num_tiles, row_start), condensed_offset(num_tiles, row_end)
+            idx1, idx2 = condensed_pair_indices(num_tiles, row_start, row_end)
+            block_kept = kept[first:last]
+            merge_heap.extend(zip(map(cost_objects.__getitem__, kept_positions[first:last][block_kept].tolist()),
+                                  map(tile_objects.__getitem__, idx1[block_kept].tolist()),
+                                  map(tile_objects.__getitem__, idx2[block_kept].tolist())))
+            del idx1, idx2, block_kept
+        heapq.heapify(merge_heap)
+        # Each tile's pairs are its condensed row plus its column in the earlier rows, sorted by (cost, neighbour)
+        for tile in range(num_tiles):
+            check_cancelled(cancel_event)
+            earlier = np.arange(tile)
+            neighbors = np.concatenate((earlier, np.arange(tile + 1, num_tiles)))
+            positions = np.concatenate((condensed_offset(num_tiles, earlier) + tile - earlier - 1,
+                                        np.arange(condensed_offset(num_tiles, tile), condensed_offset(num_tiles, tile + 1))))
+            is_kept = kept[positions]
+            neighbors, positions = neighbors[is_kept], positions[is_kept]
+            if len(positions):
+                order = np.lexsort((neighbors, pair_costs[positions]))
+                similarity_map[tile] = list(zip(map(cost_objects.__getitem__, kept_positions[positions[order]].tolist()),
+                                                map(tile_objects.__getitem__, neighbors[order].tolist())))
+        del cost_objects, kept_positions, kept
+    return merge_heap, similarity_map
+
+def build_tile_features(expanded_tiles, palette_features):
+    # Compact per-tile vectors: per-pixel colour coordinates projected on their main principal components.
+    features = palette_features[expanded_tiles].reshape(len(expanded_tiles), -1).astype(np.float32)
+    features -= features.mean(axis=0)
+    num_dims = min(ANN_FEATURE_DIMS, features.shape[0], features.shape[1])
+    sample_step = max(1, len(features) // ANN_PCA_SAMPLE_SIZE)
+    _, _, components = np.linalg.svd(features[::sample_step], full_matrices=False)
+    return features @ components[:num_dims].T
+
+def find_candidate_tiles(expanded_tiles, palette_features, k, num_cores):
+    # The k nearest tiles of every tile in feature space (the tile itself included).
+    features = build_tile_features(expanded_tiles, palette_features)
+    _, candidates = cKDTree(features).query(features, k=k, workers=num_cores)
+    return np.asarray(candidates).reshape(len(expanded_tiles), k)
+
+def compute_candidate_neighbor_costs(expanded_tiles, tile_counts, palette_dist_matrix, palette_features, num_candidates, num_cores, tile_ids=None, desc="   Finding nearest tiles", cache=None, cancel_event=None):
+    # A KD-tree over tile features proposes candidates; exact costs are computed only for those pairs.
+    num_tiles, num_colors = len(expanded_tiles), palette_dist_matrix.shape[0]
+    if tile_ids is None:
+        tile_ids = range(num_tiles)
+    candidate_pairs = set()
+    similarity_map = defaultdict(list)
+    if num_tiles > 1:
+        k = min(num_candidates + 1, num_tiles) # The tile itself comes back as its own nearest candidate
+        candidates = cached_stage(cache, "tile-candidates", lambda: {
+            "candidates": find_candidate_tiles(expanded_tiles, palette_features, k, num_cores)})["candidates"]
+
+        flat_dist = palette_dist_matrix.ravel()
+        rows_all = expanded_tiles.astype(np.intp) * num_colors
+        cols_all = expanded_tiles.astype(np.intp)
+        rows_per_chunk = max(1, COST_BLOCK_TARGET_ELEMENTS // (k * 64))
+        with tqdm(total=num_tiles, desc=desc, unit="tile", leave=False) as pbar:
+            for start in range(0, num_tiles, rows_per_chunk):
+                check_cancelled(cancel_event)
+                end = min(start + rows_per_chunk, num_tiles)
+                chunk_candidates = candidates[start:end]
+                diffs = flat_dist[rows_all[start:end, None, :] + cols_all[chunk_candidates]].sum(axis=2)
+                costs = diffs * np.minimum(tile_counts[start:end, None], tile_counts[chunk_candidates])
+                for offset, (row_costs, row_candidates, row_diffs) in enumerate(zip(costs.tolist(), chunk_candidates.tolist(), diffs.tolist())):
+                    tile_id = tile_ids[start + offset]
+                    for cost, neighbor, diff in zip(row_costs, row_candidates, row_diffs):
+                        if diff == 0: # Also skips the tile itself
+                            continue
+                        neighbor_id = tile_ids[neighbor]
+                        similarity_map[tile_id].append((cost, neighbor_id))
+                        candidate_pairs.add((cost, min(tile_id, neighbor_id), max(tile_id, neighbor_id)))
+                pbar.update(end - start)
+
+    merge_heap = list(candidate_pairs)
+    heapq.heapify(merge_heap)
+    for idx in similarity_map:
+        similarity_map[idx].sort()
+    return merge_heap, similarity_map
+
+def find_tile_neighbor_costs(expanded_tiles, tile_counts, palette_dist_matrix, num_neighbors, num_cores, palette_features=None, tile_ids=None, desc="   Finding nearest tiles", cache=None, cancel_event=None):
+    # Neighbour-limited cost search: KD-tree candidates when features are given, exact streaming otherwise.
+    if palette_features is not None:
+        return compute_candidate_neighbor_costs(expanded_tiles, tile_counts, palette_dist_matrix, palette_features, num_neighbors, num_cores, tile_ids, desc, cache, cancel_event)
+    return compute_nearest_neighbor_costs(expanded_tiles, tile_counts, palette_dist_matrix, num_neighbors, num_cores, tile_ids, desc, cache, cancel_event)
+
+def calculate_neighbor_cost_arrays(expanded_tiles, tile_counts, palette_dist_matrix, k, num_cores, desc, cancel_event=None):
+    # Costs, ids and validity of each tile's k cheapest partners, filled block by block by the worker pool.
+    num_tiles = len(expanded_tiles)
+    with shared_arrays(expanded_tiles=expanded_tiles, tile_counts=tile_counts, palette_dist=palette_dist_matrix,
+                       neighbor_costs=((num_tiles, k), np.float64), neighbors=((num_tiles, k), np.intp),
+                       neighbor_valid=((num_tiles, k), np.bool_)) as (arrays, array_specs):
+        with worker_pool(num_cores, initializer=_init_shared_worker, initargs=(array_specs, k)) as pool:
+            with tqdm(total=num_tiles, desc=desc, unit="tile", leave=False) as pbar:
+                for row_start, row_end in pool.imap_unordered(_calculate_neighbor_block_worker, iter_cost_blocks(num_tiles, num_cores, full_rows=True)):
+                    check_cancelled(cancel_event)
+                    pbar.update(row_end - row_start)
+        return {name: arrays[name].copy() for name in ("neighbor_costs", "neighbors", "neighbor_valid")}
+
+def compute_nearest_neighbor_costs(expanded_tiles, tile_counts, palette_dist_matrix, num_neighbors, num_cores, tile_ids=None, desc="   Finding nearest tiles", cache=None, cancel_event=None):
+    # Streaming mode: only each tile's num_neighbors cheapest partners are kept, so memory stays O(N*k).
+    num_tiles = len(expanded_tiles)
+    if tile_ids is None:
+        tile_ids = range(num_tiles)
+    candidate_pairs = set()
+    similarity_map = defaultdict(list)
+    if num_tiles > 1:
+        k = min(num_neighbors, num_tiles - 1)
+        arrays = cached_stage(cache, "neighbor-costs", lambda: calculate_neighbor_cost_arrays(
+            expanded_tiles, tile_counts, palette_dist_matrix, k, num_cores, desc, cancel_event))
+        block = zip(arrays["neighbor_costs"].tolist(), arrays["neighbors"].tolist(), arrays["neighbor_valid"].tolist())
+        for offset, (row_costs, row_neighbors, row_valid) in enumerate(block):
+            tile_id = tile_ids[offset]
+            for cost, neighbor, valid in zip(row_costs, row_neighbors, row_valid):
+                if not valid:
+                    continue
+                neighbor_id = tile_ids[neighbor]
+                similarity_map[tile_id].append((cost, neighbor_id))
+                candidate_pairs.add((cost, min(tile_id, neighbor_id), max(tile_id, neighbor_id)))
+
+    merge_heap = list(candidate_pairs)
+    heapq.heapify(merge_heap)
+    for idx in similarity_map:
+        similarity_map[idx].sort()
+    return merge_heap, similarity_map
+
+def pad_indices_to_tile_size(indices_np):
+    # Pads a palette index image with index 0 on the right and bottom to whole tiles.
+    height, width = indices_np.shape
+    return np.pad(indices_np, ((0, (8 - height % 8) % 8), (0, (8 - width % 8) % 8)))
+
+# --- Shared-Memory Worker Data ---
+@contextmanager
+def shared_arrays(**arrays):
+    # Places numpy arrays (or empty (shape, dtype) result buffers) in shared memory blocks for the duration of
+    # the block. Yields the parent's views and the picklable specs workers attach to; views die with the block.
+    blocks, views, specs = [], {}, {}
+    try:
+        for key, array in arrays.items():
+            shape, dtype = array if isinstance(array, tuple) else (array.shape, array.dtype)
+            dtype = np.dtype(dtype)
+            block = shared_memory.SharedMemory(create=True, size=max(1, int(np.prod(shape)) * dtype.itemsize))
+            blocks.append(block)
+            views[key] = np.ndarray(shape, dtype=dtype, buffer=block.buf)
+            if not isinstance(array, tuple):
+                views[key][...] = array
+            specs[key] = (block.name, shape, dtype.str)
+        yield views, specs
+    finally:
+        views.clear()
+        for block in blocks:
+            block.close()
+            block.unlink()
+
+def attach_shared_arrays(array_specs):
+    # Worker side of shared_arrays: the blocks must stay referenced for as long as the views are used.
+    blocks, arrays = [], {}
+    for key, (name, shape, dtype) in array_specs.items():
+        block = shared_memory.SharedMemory(name=name)
+        blocks.append(block)
+        arrays[key] = np.ndarray(shape, dtype=dtype, buffer=block.buf)
+    return blocks, arrays
 
 # --- Multiprocessing Worker and Initializer ---
-def _init_worker(tiles_data, palette, metric_name):
-    global worker_tiles_data, worker_palette, worker_color_dist_func
+def worker_pool(num_cores, initializer=None, initargs=()):
+    # Conversions running off the main thread (e.g. under a GUI) spawn their workers, as forking a process
+    # with other threads running can copy locks held by those threads.
+    start_method = None if threading.current_thread() is threading.main_thread() else "spawn"
+    return multiprocessing.get_context(start_method).Pool(processes=num_cores, initializer=_init_pool_worker,
+                                                          initargs=(initializer, initargs))
+
+def _init_pool_worker(initializer, initargs):
+    # Spawned workers of a windowed build have no sys.stderr either; their progress bars write to os.devnull.
+    if sys.stderr is None:
+        sys.stderr = open(os.devnull, "w")
+    if initializer is not None:
+        initializer(*initargs)
+
+def _init_shared_worker(array_specs, num_neighbors=None):
+    global worker_shared_blocks, worker_arrays, worker_num_neighbors
     if COLOUR_SCIENCE_AVAILABLE:
         warnings.filterwarnings("ignore", category=ColourUsageWarning)
-    worker_tiles_data = tiles_data
-    worker_palette = palette
-    worker_color_dist_func = get_color_distance_function(metric_name)
-
-def _calculate_initial_costs_worker(pair):
-    idx1, idx2 = pair
-    tile1, tile2 = worker_tiles_data[idx1], worker_tiles_data[idx2]
-    diff = calculate_tile_difference(tile1["data"], tile2["data"], worker_palette, worker_color_dist_func)
-    if diff == 0:
-        return None
-    if tile1["count"] > tile2["count"]:
-        loser_count = tile2["count"]
-    elif tile2["count"] > tile1["count"]:
-        loser_count = tile1["count"]
-    else:
-        loser_count = tile1["count"]
-    cost = diff * loser_count
-    return (cost, idx1, idx2)
-
-def synthesize_ideal_tile(tile_group, palette_255, color_dist_func):
-    num_tiles_in_group = len(tile_group)
-    if num_tiles_in_group == 0:
-        return np.zeros(8, dtype=np.uint8), np.zeros(8, dtype=np.uint8)
-
-    avg_rgb_tile = np.zeros((8, 8, 3), dtype=np.float32)
-    for tile_indices in tile_group:
-        for r in range(8):
-            for c in range(8):
-                palette_idx = tile_indices[r, c]
-                avg_rgb_tile[r, c] += palette_255[palette_idx]
-    
-    avg_rgb_tile /= num_tiles_in_group
-
-    final_indices_tile = np.zeros((8, 8), dtype=np.uint8)
-    for r in range(8):
-        for c in range(8):
-            avg_rgb = tuple(avg_rgb_tile[r, c])
-            best_dist = float('inf')
-            best_idx = 0
-            for i, p_color in enumerate(palette_255):
-                dist = color_distance_rgb(avg_rgb, p_color)
-                if dist < best_dist:
-                    best_dist = dist
-                    best_idx = i
-            final_indices_tile[r, c] = best_idx
-            
-    return process_tile_for_screen4(final_indices_tile, palette_255, color_dist_func)
-
-
-def optimize_by_precomputation_and_heap(all_source_tiles_sc4, all_source_tiles_quantized, max_tiles, tm_width, tm_height, palette_255, num_cores, color_metric, synthesize, sort_strategy='cluster'):
-    print("   Finding unique source tiles and their map counts...")
-    unique_tile_groups = defaultdict(list)
-    for i, tile_data in enumerate(all_source_tiles_sc4):
-        key = tile_data[0].tobytes() + tile_data[1].tobytes()
-        unique_tile_groups[key].append(i)
-    
-    initial_unique_count = len(unique_tile_groups)
+    worker_shared_blocks, worker_arrays = attach_shared_arrays(array_specs)
+    worker_num_neighbors = num_neighbors
+
+def _calculate_cost_block_worker(row_range):
+    row_start, row_end = row_range
+    num_tiles = len(worker_arrays["expanded_tiles"])
+    costs = calculate_tile_cost_block(worker_arrays["expanded_tiles"], worker_arrays["tile_counts"], worker_arrays["palette_dist"], row_start, row_end)
+    worker_arrays["pair_costs"][condensed_offset(num_tiles, row_start):condensed_offset(num_tiles, row_end)] = costs
+    return row_start, row_end
+
+def _calculate_neighbor_block_worker(row_range):
+    row_start, row_end = row_range
+    costs, nearest, is_valid = calculate_tile_neighbor_block(worker_arrays["expanded_tiles"], worker_arrays["tile_counts"], worker_arrays["palette_dist"], row_start, row_end, worker_num_neighbors)
+    worker_arrays["neighbor_costs"][row_start:row_end] = costs
+    worker_arrays["neighbors"][row_start:row_end] = nearest
+    worker_arrays["neighbor_valid"][row_start:row_end] = is_valid
+    return row_start, row_end
+
+def snap_to_palette_rgb(avg_rgb_tiles, palette_255):
+    # Nearest palette index per pixel by squared RGB distance, in the input's precision (as color_distance_rgb).
+    palette_np = np.asarray(palette_255, dtype=avg_rgb_tiles.dtype)
+    diff = avg_rgb_tiles[..., None, :] - palette_np
+    dists = diff[..., 0] ** 2 + diff[..., 1] ** 2 + diff[..., 2] ** 2
+    return dists.argmin(axis=-1).astype(np.uint8)
+
+def synthesize_tiles_from_averages(avg_rgb_tiles, palette_255, palette_dist_matrix, desc=None):
+    # Batched synthesis: (G, 8, 8, 3) average colour images are snapped to the palette and reduced to SCREEN4 rows.
+    indices = np.empty(avg_rgb_tiles.shape[:3], dtype=np.uint8)
+    groups_per_block = max(1, SC4_ROW_BLOCK // 8)
+    for group_start in range(0, len(avg_rgb_tiles), groups_per_block):
+        indices[group_start:group_start + groups_per_block] = snap_to_palette_rgb(avg_rgb_tiles[group_start:group_start + groups_per_block], palette_255)
+    pattern_data, color_data = quantize_rows_in_blocks(indices.reshape(-1, 8), palette_dist_matrix, desc=desc)
+    return list(zip(pattern_data.reshape(-1, 8), color_data.reshape(-1, 8)))
+
+def synthesize_tile_from_average(avg_rgb_tile, palette_255, palette_dist_matrix):
+    return synthesize_tiles_from_averages(avg_rgb_tile[None], palette_255, palette_dist_matrix)[0]
+
+def calculate_tile_costs_to_neighbors(expanded_tiles, tile_counts, palette_dist_matrix, tile_idx, neighbor_ids):
+    # Fresh costs between one tile and a list of others, as a single array lookup.
+    num_colors = palette_dist_matrix.shape[0]
+    neighbor_ids = np.asarray(neighbor_ids, dtype=np.intp)
+    lookup = expanded_tiles[tile_idx].astype(np.intp) * num_colors + expanded_tiles[neighbor_ids].astype(np.intp)
+    diffs = palette_dist_matrix.ravel()[lookup].sum(axis=1)
+    return diffs * np.minimum(tile_counts[tile_idx], tile_counts[neighbor_ids]), diffs
+
+def is_current_merge_entry(entry, tile_versions):
+    # Entries are (cost, idx1, idx2) from a neighbour search or (cost, idx1, idx2, version1, version2) once pushed.
+    version1, version2 = entry[3:] if len(entry) > 3 else (0, 0)
+    return version1 == tile_versions[entry[1]] and version2 == tile_versions[entry[2]]
+
+# --- Unique Tile Table ---
+def new_tile_table(track_rgb=False):
+    # Unique 16-byte (pattern + colour) tiles in order of first occurrence with their counts, the render tile of
+    # their first occurrence and, with track_rgb, the summed RGB of their source pixels for tile synthesis.
+    return {"index": {}, "size": 0, "tiles": np.zeros((0, 16), dtype=np.uint8), "render_tiles": np.zeros((0, 16), dtype=np.uint8),
+            "counts": np.zeros(0, dtype=np.int64), "rgb_sums": np.zeros((0, 8, 8, 3), dtype=np.float64) if track_rgb else None}
+
+def _reserve_rows(array, num_rows):
+    # Grows geometrically, so folding many strips into a table stays linear overall.
+    if num_rows <= len(array):
+        return array
+    grown = np.zeros((max(num_rows, 2 * len(array)),) + array.shape[1:], dtype=array.dtype)
+    grown[:len(array)] = array
+    return grown
+
+def fold_tiles_into_table(table, tiles, render_tiles, source_tiles=None, palette_255=None):
+    # Adds (N, 16) tiles to the table and returns their int32 table ids. render_tiles are the tiles as rendered
+    # (the same array outside balanced mode); source_tiles are the (N, 8, 8) palette indices they were made from,
+    # whose palette_255 colours are summed when the table tracks RGB.
+    tiles = np.ascontiguousarray(tiles)
+    if len(tiles) == 0:
+        return np.zeros(0, dtype=np.int32)
+    keys = tiles.view(np.dtype((np.void, tiles.shape[1]))).ravel()
+    _, first_seen, inverse, counts = np.unique(keys, return_index=True, return_inverse=True, return_counts=True)
+    inverse = inverse.ravel()
+
+    # Only the distinct tiles of this batch touch the dictionary; new ones are numbered in order of first occurrence
+    index = table["index"]
+    batch_ids = np.empty(len(first_seen), dtype=np.int32)
+    new_rows = []
+    for u in np.argsort(first_seen).tolist():
+        row = int(first_seen[u])
+        key = keys[row].tobytes()
+        tile_id = index.get(key)
+        if tile_id is None:
+            tile_id = index[key] = len(index)
+            new_rows.append(row)
+        batch_ids[u] = tile_id
+
+    start, size = table["size"], len(index)
+    for name, rows in (("tiles", tiles), ("render_tiles", render_tiles)):
+        table[name] = _reserve_rows(table[name], size)
+        table[name][start:size] = rows[new_rows]
+    table["counts"] = _reserve_rows(table["counts"], size)
+    table["counts"][batch_ids] += counts
+    tile_ids = batch_ids[inverse]
+
+    if table["rgb_sums"] is not None:
+        table["rgb_sums"] = _reserve_rows(table["rgb_sums"], size)
+        palette = np.asarray(palette_255, dtype=np.float64)
+        for chunk_start in range(0, len(tiles), RGB_SUM_CHUNK_TILES):
+            chunk_ids = tile_ids[chunk_start:chunk_start + RGB_SUM_CHUNK_TILES]
+            order = np.argsort(chunk_ids, kind='stable')
+            sorted_ids = chunk_ids[order]
+            group_starts = np.flatnonzero(np.r_[True, sorted_ids[1:] != sorted_ids[:-1]])
+            source_rgb = palette[source_tiles[chunk_start:chunk_start + RGB_SUM_CHUNK_TILES][order]]
+            table["rgb_sums"][sorted_ids[group_starts]] += np.add.reduceat(source_rgb, group_starts, axis=0)
+    table["size"] = size
+    return tile_ids
+
+# --- Cluster-Based Tile Reduction ---
+def _assign_cluster_chunk_worker(row_range):
+    row_start, row_end = row_range
+    labels, sq_dists = assign_to_centroids(worker_arrays["features"][row_start:row_end], worker_arrays["centroids"])
+    worker_arrays["labels"][row_start:row_end] = labels
+    worker_arrays["sq_dists"][row_start:row_end] = sq_dists
+
+def assign_to_centroids(features, centroids):
+    # Nearest centroid of each row, with squared distances expanded into one matrix product.
+    sq_dists = (features ** 2).sum(axis=1)[:, None] - 2.0 * (features @ centroids.T) + (centroids ** 2).sum(axis=1)[None, :]
+    labels = sq_dists.argmin(axis=1)
+    return labels, np.maximum(sq_dists[np.arange(len(features)), labels], 0.0)
+
+def seed_centroids(features, weights, num_clusters, rng):
+    # Weighted k-means++: each new centre is drawn with probability proportional to weight * distance^2.
+    sq_norms = (features ** 2).sum(axis=1)
+    chosen = [rng.choice(len(features), p=weights / weights.sum())]
+    closest = np.maximum(sq_norms - 2.0 * (features @ features[chosen[0]]) + sq_norms[chosen[0]], 0.0)
+    for _ in range(1, num_clusters):
+        scores = weights * closest
+        total = scores.sum()
+        if total <= 0:
+            break # Fewer distinct tiles than clusters
+        chosen.append(rng.choice(len(features), p=scores / total))
+        new_dists = np.maximum(sq_norms - 2.0 * (features @ features[chosen[-1]]) + sq_norms[chosen[-1]], 0.0)
+        closest = np.minimum(closest, new_dists)
+    return features[chosen].copy()
+
+def weighted_cluster_means(features, weights, labels, num_clusters):
+    cluster_weights = np.bincount(labels, weights=weights, minlength=num_clusters)
+    sums = np.stack([np.bincount(labels, weights=weights * features[:, d], minlength=num_clusters) for d in range(features.shape[1])], axis=1)
+    return sums / np.maximum(cluster_weights, 1e-12)[:, None], cluster_weights
+
+def cluster_tiles(features, weights, num_clusters, num_cores, max_iterations=CLUSTER_MAX_ITERATIONS, cancel_event=None):
+    # Weighted k-means (Lloyd); each iteration is O(N*K) and the assignment step is split across the pool.
+    rng = np.random.default_rng(0)
+    centroids = seed_centroids(features, weights, num_clusters, rng).astype(np.float32)
+    num_clusters = len(centroids)
+    chunk_size = max(1, -(-len(features) // (num_cores * 4)))
+    chunks = [(start, min(start + chunk_size, len(features))) for start in range(0, len(features), chunk_size)]
+
+    labels = None
+    with shared_arrays(features=features, centroids=centroids, labels=((len(features),), np.intp),
+                       sq_dists=((len(features),), np.float32)) as (arrays, array_specs):
+        with worker_pool(num_cores, initializer=_init_shared_worker, initargs=(array_specs,)) as pool:
+            for _ in tqdm(range(max_iterations), desc="   Clustering tiles", unit="iter", leave=False):
+                check_cancelled(cancel_event)
+                arrays["centroids"][...] = centroids
+                pool.map(_assign_cluster_chunk_worker, chunks)
+                new_labels = arrays["labels"].copy()
+                if labels is not None and np.array_equal(new_labels, labels):
+                    break
+                labels = new_labels
+                sq_dists = arrays["sq_dists"].copy()
+                centroids, cluster_weights = weighted_cluster_means(features, weights, labels, num_clusters)
+                # An emptied cluster is reseeded with the worst-served tile
+                for empty_cluster in np.flatnonzero(cluster_weights == 0):
+                    worst = int(np.argmax(weights * sq_dists))
+                    centroids[empty_cluster] = features[worst]
+                    sq_dists[worst] = 0.0
+                centroids = centroids.astype(np.float32)
+
+    centroids, _ = weighted_cluster_means(features, weights, labels, num_clusters)
+    return labels, centroids
+
+def reduce_tiles_by_clustering(active_tiles, features, weights, max_tiles, num_cores, cancel_event=None):
+    # Groups unique tiles into at most max_tiles clusters, each represented by its medoid (a valid SC4 tile).
+    labels, centroids = cluster_tiles(features, weights, max_tiles, num_cores, cancel_event=cancel_event)
+    dist_to_centre = ((features - centroids[labels]) ** 2).sum(axis=1)
+    order = np.lexsort((dist_to_centre, labels))
+    group_starts = np.flatnonzero(np.r_[True, labels[order][1:] != labels[order][:-1]])
+    reduced_tiles = {}
+    for members in np.split(order, group_starts[1:]):
+        medoid = int(members[0])
+        reduced_tiles[medoid] = {
+            "data": active_tiles[medoid]["data"],
+            "count": int(weights[members].sum()),
+            "original_indices": set(members.tolist()),
+        }
+    return reduced_tiles
+
+def optimize_by_precomputation_and_heap(tile_table, tile_ids, max_tiles, palette_255, num_cores, color_metric, synthesize, sort_strategy='cluster', max_memory_mb=None, ann_neighbors=None, merge_costs='incremental', reduction_mode='merge', sort_refine_seconds=0, cancel_event=None, cache=None, report=None):
+    # Reduces the unique tiles of tile_table (see fold_tiles_into_table) to max_tiles. Returns the final
+    # (pattern, color) tiles and tile_ids translated to final tile indices.
+    initial_unique_count = tile_table["size"]
     print(f"   [INFO] Found {initial_unique_count} unique tiles.")
 
     if initial_unique_count == 0:
-        return [], np.zeros((tm_height, tm_width), dtype=np.int16)
+        return [], np.zeros(np.shape(tile_ids), dtype=np.int16)
 
     # --- Step 1: Build initial tile data and calculate all-pairs similarity ---
-    unique_sc4_keys = list(unique_tile_groups.keys())
-    unique_sc4_to_idx = {key: i for i, key in enumerate(unique_sc4_keys)}
-
-    active_tiles = { i: {"data": all_source_tiles_sc4[locs[0]], "count": len(locs), "original_indices": {i}}
-                     for i, (key, locs) in enumerate(unique_tile_groups.items()) }
-
-    all_pairs = list(combinations(active_tiles.keys(), 2))
-    print(f"   Generating memory structure for {len(all_pairs)} tile pairs...")
-    
-    merge_heap = []
-    similarity_map = defaultdict(list)
-    
-    if all_pairs:
-        print(f"   Initializing worker pool and transferring data to {num_cores} cores.\r\n      -> This may take some seconds, please wait..")
-        chunksize = max(1, len(all_pairs) // (num_cores * 16))
-        init_args = (active_tiles, palette_255, color_metric)
-        with multiprocessing.Pool(processes=num_cores, initializer=_init_worker, initargs=init_args) as pool:
-            for result in tqdm(pool.imap_unordered(_calculate_initial_costs_worker, all_pairs, chunksize=chunksize), total=len(all_pairs), desc="   Pre-calculating costs", mininterval=10.0):
-                if result:
-                    cost, idx1, idx2 = result
-                    heapq.heappush(merge_heap, result)
-                    similarity_map[idx1].append((cost, idx2))
-                    similarity_map[idx2].append((cost, idx1))
-
-    for idx in similarity_map:
-        similarity_map[idx].sort()
+    mark_stage(report, "pair_costs")
+    unique_tiles = tile_table["tiles"]
+    active_tiles = { i: {"data": (unique_tiles[i, :8], unique_tiles[i, 8:]), "count": count, "original_indices": {i}}
+                     for i, count in enumerate(tile_table["counts"][:initial_unique_count].tolist()) }
+
+    palette_dist_matrix = build_palette_distance_matrix(palette_255, color_metric)
+    expanded_tiles = expand_sc4_tiles([active_tiles[i]["data"] for i in range(initial_unique_count)])
+    tile_counts = np.array([active_tiles[i]["count"] for i in range(initial_unique_count)], dtype=np.int64)
+
+    num_neighbors = None
+    palette_features = None
+    if max_memory_mb is not None:
+        num_neighbors = choose_neighbor_count(initial_unique_count, max_memory_mb, num_cores)
+        if num_neighbors >= initial_unique_count - 1:
+            print(f"   [INFO] All tile pairs fit in the {max_memory_mb} MB memory budget.")
+            num_neighbors = None
+        else:
+            print(f"   [INFO] Memory budget of {max_memory_mb} MB: keeping the {num_neighbors} nearest neighbours of each tile.")
+    if ann_neighbors:
+        num_neighbors = min(ann_neighbors, num_neighbors or ann_neighbors)
+        palette_features = build_palette_features(palette_255, color_metric)
+        print(f"   [INFO] Approximate search: exact costs only for each tile's {num_neighbors} KD-tree candidates.")
+
+    if reduction_mode == 'cluster':
+        merge_heap, similarity_map = [], {} # Pair costs are only needed among the final representatives
+    elif num_neighbors is None:
+        merge_heap, similarity_map = compute_all_pair_costs(expanded_tiles, tile_counts, palette_dist_matrix, num_cores,
+                                                            cache=derive_stage_cache(cache, "pair-costs", color_metric), cancel_event=cancel_event)
+    else:
+        cost_cache = derive_stage_cache(cache, "neighbor-costs", color_metric, num_neighbors, palette_features is not None)
+        merge_heap, similarity_map = find_tile_neighbor_costs(expanded_tiles, tile_counts, palette_dist_matrix, num_neighbors, num_cores, palette_features, cache=cost_cache,
+                                                              cancel_event=cancel_event)
 
     # --- Step 2: Merge tiles if necessary ---
-    if initial_unique_count > max_tiles:
+    mark_stage(report, "merging")
+    if initial_unique_count > max_tiles and reduction_mode == 'cluster':
+        print(f"   Clustering {initial_unique_count} unique tiles into {max_tiles} representatives...")
+        cluster_features = build_palette_features(palette_255, color_metric)[expanded_tiles].reshape(initial_unique_count, -1).astype(np.float32)
+        active_tiles = reduce_tiles_by_clustering(active_tiles, cluster_features, tile_counts.astype(np.float64), max_tiles, num_cores, cancel_event)
+    elif initial_unique_count > max_tiles:
         num_merges_to_perform = len(active_tiles) - max_tiles
         print(f"   Performing {num_merges_to_perform} merges to reach target of {max_tiles} tiles...")
         is_active = {idx: True for idx in active_tiles.keys()}
+
+        # Incremental costs: pushed heap entries carry the versions of both tiles, and a merge bumps the
+        # winner's version so its old entries are skipped lazily when they surface. Entries from the
+        # initial search have no versions and are only valid while both tiles are still at version 0.
+        incremental = merge_costs == 'incremental'
+        rgb_sums = None
+        if incremental:
+            tile_versions = [0] * initial_unique_count
+            heap_compaction_size = max(2 * len(merge_heap), 1024)
+            if synthesize:
+                rgb_sums = tile_table["rgb_sums"][:initial_unique_count].copy()
         
         with tqdm(total=num_merges_to_perform, desc="   Merging tiles") as pbar:
             merges_done = 0
-            while merges_done < num_merges_to_perform and merge_heap:
-                cost, idx1, idx2 = heapq.heappop(merge_heap)
+            while merges_done < num_merges_to_perform:
+                check_cancelled(cancel_event)
+                if not merge_heap:
+                    if num_neighbors is None and not incremental:
+                        break
+                    # Out of candidates (neighbour-limited costs): search again among the surviving tiles
+                    active_ids = sorted(active_tiles.keys())
+                    merge_heap, _ = find_tile_neighbor_costs(
+                        expanded_tiles[active_ids], np.array([active_tiles[i]["count"] for i in active_ids], dtype=np.int64),
+                        palette_dist_matrix, num_neighbors or MERGE_REFRESH_NEIGHBORS, num_cores, palette_features,
+                        tile_ids=active_ids, desc="   Refreshing nearest tiles", cancel_event=cancel_event)
+                    if not merge_heap:
+                        break
+                    if incremental:
+                        merge_heap = [(cost, idx1, idx2, tile_versions[idx1], tile_versions[idx2]) for cost, idx1, idx2 in merge_heap]
+                    continue
+                entry = heapq.heappop(merge_heap)
+                cost, idx1, idx2 = entry[0], entry[1], entry[2]
                 if not (is_active.get(idx1) and is_active.get(idx2)):
                     continue
+                if incremental and not is_current_merge_entry(entry, tile_versions):
+                    continue # Stale: one of the tiles changed since this cost was computed
                 
                 tile1, tile2 = active_tiles[idx1], active_tiles[idx2]
                 if tile1["count"] > tile2["count"]:
@@ -515,22 +1235,67 @@ def optimize_by_precomputation_and_heap(all_source_tiles_sc4, all_source_tiles_q
                 is_active[loser_idx] = False
                 merges_done += 1
                 pbar.update(1)
+
+                if not incremental:
+                    continue
+                tile_versions[winner_idx] += 1
+                tile_counts[winner_idx] = active_tiles[winner_idx]["count"]
+                if rgb_sums is not None:
+                    rgb_sums[winner_idx] += rgb_sums[loser_idx]
+                    avg_rgb_tile = (rgb_sums[winner_idx] / tile_counts[winner_idx]).astype(np.float32)
+                    active_tiles[winner_idx]["data"] = synthesize_tile_from_average(avg_rgb_tile, palette_255, palette_dist_matrix)
+                    expanded_tiles[winner_idx] = expand_sc4_tile(active_tiles[winner_idx]["data"]).ravel()
+
+                # Recompute only the merged representative against its own nearest neighbours. The loser's
+                # neighbours are not inherited: on neighbour-limited graphs that funnels every tile into one group.
+                similarity_map.pop(loser_idx, None)
+                winner_neighbors = similarity_map.get(winner_idx, [])
+                neighbor_ids = []
+                scan_end = 0
+                for scan_end, (_, neighbor) in enumerate(winner_neighbors, start=1):
+                    if is_active.get(neighbor):
+                        neighbor_ids.append(neighbor)
+                        if len(neighbor_ids) >= MERGE_REFRESH_NEIGHBORS:
+                            break
+                if not neighbor_ids:
+                    continue
+                costs, diffs = calculate_tile_costs_to_neighbors(expanded_tiles, tile_counts, palette_dist_matrix, winner_idx, neighbor_ids)
+                fresh_neighbors = [(cost, neighbor) for cost, neighbor, diff in zip(costs.tolist(), neighbor_ids, diffs.tolist()) if diff != 0]
+                # Farther neighbours keep their previous costs, which are only used for tileset sorting
+                similarity_map[winner_idx] = sorted(fresh_neighbors + winner_neighbors[scan_end:])
+                for cost, neighbor in fresh_neighbors:
+                    low_idx, high_idx = min(winner_idx, neighbor), max(winner_idx, neighbor)
+                    heapq.heappush(merge_heap, (cost, low_idx, high_idx, tile_versions[low_idx], tile_versions[high_idx]))
+
+                if len(merge_heap) > heap_compaction_size: # Drop stale entries once they dominate the heap
+                    merge_heap = [e for e in merge_heap if is_active.get(e[1]) and is_active.get(e[2]) and is_current_merge_entry(e, tile_versions)]
+                    heapq.heapify(merge_heap)
+                    heap_compaction_size = max(2 * len(merge_heap), 1024)
     else:
         print(f"   [INFO] Initial unique tile count ({initial_unique_count}) is within limit. No merge needed.")
 
     # --- Step 3: Synthesize new tiles if requested ---
-    if synthesize and initial_unique_count > max_tiles:
+    if synthesize and initial_unique_count > max_tiles and merge_costs == 'incremental' and reduction_mode == 'merge':
+        print("   [INFO] Merged groups were synthesized incrementally during merging.")
+    elif synthesize and initial_unique_count > max_tiles:
+        mark_stage(report, "synthesis")
         print("   Synthesizing ideal tiles for merged groups...")
-        color_dist_func = get_color_distance_function(color_metric)
-        for tile_info in tqdm(active_tiles.values(), desc="   Synthesizing"):
-            if len(tile_info["original_indices"]) > 1:
-                group_locations = []
-                for original_unique_idx in tile_info["original_indices"]:
-                    key = unique_sc4_keys[original_unique_idx]
-                    group_locations.extend(unique_tile_groups[key])
-                
-                quantized_tiles_for_group = [all_source_tiles_quantized[i] for i in group_locations]
-                tile_info["data"] = synthesize_ideal_tile(quantized_tiles_for_group, palette_255, color_dist_func)
+        merged_ids = [idx for idx, tile_info in active_tiles.items() if len(tile_info["original_indices"]) > 1]
+        group_sizes = np.array([active_tiles[idx]["count"] for idx in merged_ids], dtype=np.float32)
+        if merged_ids:
+            rgb_sums = np.stack([tile_table["rgb_sums"][sorted(active_tiles[idx]["original_indices"])].sum(axis=0) for idx in merged_ids])
+            avg_rgb_tiles = rgb_sums.astype(np.float32) / group_sizes[:, None, None, None]
+            for idx, tile_data in zip(merged_ids, synthesize_tiles_from_averages(avg_rgb_tiles, palette_255, palette_dist_matrix, desc="   Synthesizing")):
+                active_tiles[idx]["data"] = tile_data
+
+    mark_stage(report, "sorting")
+    if reduction_mode == 'cluster' and sort_strategy != 'none':
+        # The sort only needs pair costs among the surviving representatives
+        final_ids = list(active_tiles.keys())
+        final_expanded = expand_sc4_tiles([active_tiles[idx]["data"] for idx in final_ids])
+        final_counts = np.array([active_tiles[idx]["count"] for idx in final_ids], dtype=np.int64)
+        _, final_similarity = compute_all_pair_costs(final_expanded, final_counts, palette_dist_matrix, num_cores, cancel_event=cancel_event)
+        similarity_map = {final_ids[i]: [(cost, final_ids[j]) for cost, j in neighbors] for i, neighbors in final_similarity.items()}
 
     # --- Step 4: Sort final tiles by similarity ---
     print("   Sorting final tileset for visual coherence...")
@@ -538,7 +1303,8 @@ def optimize_by_precomputation_and_heap(all_source_tiles_sc4, all_source_tiles_q
         list(active_tiles.values()),
         similarity_map,
         active_tiles,
-        strategy=sort_strategy
+        strategy=sort_strategy,
+        refine_seconds=sort_refine_seconds
     )
     
     # --- Step 5: Build final tileset and map based on sorted order ---
@@ -546,81 +1312,84 @@ def optimize_by_precomputation_and_heap(all_source_tiles_sc4, all_source_tiles_q
     final_patterns = [info['data'] for info in sorted_tile_infos]
     
     # Create the final mapping from an original unique tile to its new sorted final index
-    final_merge_map = {}
+    final_merge_lut = np.zeros(initial_unique_count, dtype=np.int16)
     for winner_idx, tile_info in active_tiles.items():
         if winner_idx not in old_winner_to_new_map: continue
-        new_sorted_idx = old_winner_to_new_map[winner_idx]
-        for original_unique_idx in tile_info["original_indices"]:
-            final_merge_map[original_unique_idx] = new_sorted_idx
-
-    final_tile_map = np.zeros((tm_height, tm_width), dtype=np.int16)
-    for i, tile_data in enumerate(all_source_tiles_sc4):
-        key = tile_data[0].tobytes() + tile_data[1].tobytes()
-        if key in unique_sc4_to_idx:
-            unique_idx = unique_sc4_to_idx[key]
-            if unique_idx in final_merge_map:
-                final_idx = final_merge_map[unique_idx]
-                r, c = divmod(i, tm_width)
-                final_tile_map[r, c] = final_idx
-    
-    return final_patterns, final_tile_map
+        final_merge_lut[list(tile_info["original_indices"])] = old_winner_to_new_map[winner_idx]
+
+    return final_patterns, final_merge_lut[tile_ids]
 
-def write_sc4_palette(filename, final_palette_0_7):
-    with open(filename, "wb") as f:
-        f.write(b'\x00' * 4) # Reserved header
-        for r,g,b in final_palette_0_7:
-            f.write(bytes([r, g, b]))
+def encode_sc4_palette(final_palette_0_7):
+    return b'\x00' * 4 + bytes(c for rgb in final_palette_0_7 for c in rgb) # Reserved header, then RGB triplets
 
-def write_sc4_tiles(filename, unique_patterns):
+def encode_sc4_tiles(unique_patterns):
     num_tiles = len(unique_patterns)
     header_byte = num_tiles if num_tiles < 256 else 0
-    with open(filename, "wb") as f:
-        f.write(bytes([header_byte]))
-        f.write(b'\x00' * 4)
-        for pattern_data, _ in unique_patterns:
-            f.write(pattern_data.tobytes())
-        for _, color_data in unique_patterns:
-            f.write(color_data.tobytes())
-
-def write_sc4_supertiles(filename, supertile_definitions, super_w, super_h):
+    return b''.join([
+        bytes([header_byte]),
+        b'\x00' * 4,
+        np.array([pattern_data for pattern_data, _ in unique_patterns], dtype=np.uint8).tobytes(),
+        np.array([color_data for _, color_data in unique_patterns], dtype=np.uint8).tobytes(),
+    ])
+
+def encode_sc4_supertiles(supertile_definitions, super_w, super_h):
     num_supertiles = len(supertile_definitions)
-    with open(filename, "wb") as f:
-        if num_supertiles > 255:
-            f.write(b'\x00')
-            f.write(num_supertiles.to_bytes(2, 'little'))
-        else:
-            f.write(bytes([num_supertiles]))
-        f.write(bytes([super_w, super_h]))
-        f.write(b'\x00' * 4)
-        for supertile_block in supertile_definitions:
-            max_idx = np.max(supertile_block)
-            bytes_per_idx = 2 if max_idx > 255 else 1
-            for base_tile_idx in supertile_block.flat:
-                f.write(int(base_tile_idx).to_bytes(bytes_per_idx, 'little'))
-
-def write_sc4_map(filename, tile_map, num_supertiles):
+    if num_supertiles > 255:
+        chunks = [b'\x00', num_supertiles.to_bytes(2, 'little')]
+    else:
+        chunks = [bytes([num_supertiles])]
+    chunks += [bytes([super_w, super_h]), b'\x00' * 4]
+    for supertile_block in supertile_definitions:
+        index_dtype = '<u2' if np.max(supertile_block) > 255 else 'u1' # Chosen per supertile
+        chunks.append(np.ascontiguousarray(supertile_block).astype(index_dtype).tobytes())
+    return b''.join(chunks)
+
+def encode_sc4_map(tile_map, num_supertiles):
     map_height, map_width = tile_map.shape
     bytes_per_index = 2 if num_supertiles > 255 else 1
-    with open(filename, "wb") as f:
-        f.write(map_width.to_bytes(2, 'little'))
-        f.write(map_height.to_bytes(2, 'little'))
-        f.write(b'\x00' * 4)
-        for tile_idx in tile_map.flat:
-            f.write(int(tile_idx).to_bytes(bytes_per_index, 'little'))
-
-def reconstruct_sc4_tile_pil(pattern_data, color_data, pil_palette_flat):
-    tile_img = Image.new('P', (8, 8))
-    tile_img.putpalette(pil_palette_flat)
-    pixels = tile_img.load()
-    for r in range(8):
-        color_byte = color_data[r]
-        pattern_byte = pattern_data[r]
-        bg_idx = int(color_byte & 0x0F)
-        fg_idx = int((color_byte >> 4) & 0x0F)
-        for c in range(8):
-            is_fg_pixel = (pattern_byte >> (7 - c)) & 1
-            pixels[c, r] = fg_idx if is_fg_pixel else bg_idx
-    return tile_img
+    return b''.join([
+        map_width.to_bytes(2, 'little'),
+        map_height.to_bytes(2, 'little'),
+        b'\x00' * 4,
+        np.ascontiguousarray(tile_map).astype('<u2' if bytes_per_index == 2 else 'u1').tobytes(),
+    ])
+
+def encode_sc4_project(result):
+    # File contents of the four project components, keyed by their extension.
+    super_w, super_h = result["supertile_size"]
+    return {
+        "SC4Pal": encode_sc4_palette(result["palette"]),
+        "SC4Tiles": encode_sc4_tiles(result["tiles"]),
+        "SC4Super": encode_sc4_supertiles(result["supertiles"], super_w, super_h),
+        "SC4Map": encode_sc4_map(result["map"], len(result["supertiles"])),
+    }
+
+def write_sc4_project(full_output_path, result):
+    for extension, data in encode_sc4_project(result).items():
+        with open(f"{full_output_path}.{extension}", "wb") as f:
+            f.write(data)
+
+def render_tile_map(tile_map, tiles):
+    # Palette index image of a whole tile map, expanded in one step through a (tiles, 8, 8) lookup array.
+    # Cells that do not point to a tile are left at index 0.
+    num_tiles = len(tiles)
+    tile_pixels = np.zeros((num_tiles + 1, 8, 8), dtype=np.uint8)
+    tile_pixels[:num_tiles] = expand_sc4_tiles(tiles).reshape(num_tiles, 8, 8)
+    cells = np.where((tile_map >= 0) & (tile_map < num_tiles), tile_map, num_tiles)
+    map_height, map_width = tile_map.shape
+    return tile_pixels[cells].transpose(0, 2, 1, 3).reshape(map_height * 8, map_width * 8)
+
+def index_image_to_pil(index_image, pil_palette_flat):
+    height, width = index_image.shape
+    img = Image.frombytes('P', (width, height), np.ascontiguousarray(index_image, dtype=np.uint8).tobytes())
+    img.putpalette(pil_palette_flat)
+    return img
+
+def build_palette_remap_lut(source_palette_255, target_palette_255):
+    # For each source colour, the nearest target colour by squared RGB distance (the first one on ties).
+    source_np = np.asarray(source_palette_255, dtype=np.int64)
+    target_np = np.asarray(target_palette_255, dtype=np.int64)
+    return ((source_np[:, None, :] - target_np[None, :, :]) ** 2).sum(axis=2).argmin(axis=1).astype(np.uint8)
 
 def discover_supertiles(tile_map, super_w, super_h):
     map_h, map_w = tile_map.shape
@@ -652,6 +1421,121 @@ def discover_supertiles(tile_map, super_w, super_h):
                 
     return supertile_definitions, supertile_map
 
+def supertile_mask_positions(super_w, super_h):
+    # Position sets left out of the candidate hash: each position, each row, each column and each half.
+    grid = np.arange(super_w * super_h).reshape(super_h, super_w)
+    masks = [[p] for p in grid.ravel()] + list(grid) + list(grid.T)
+    masks += [grid[:super_h // 2], grid[super_h // 2:], grid[:, :super_w // 2], grid[:, super_w // 2:]]
+    unique_masks = {}
+    for mask in masks:
+        mask = tuple(sorted(np.ravel(mask).tolist()))
+        if 0 < len(mask) < grid.size:
+            unique_masks.setdefault(mask, None)
+    return [np.array(mask) for mask in unique_masks]
+
+def _nearest_supertile_pairs(members, st_tiles, tile_distances, num_neighbors):
+    # Each member paired with its num_neighbors nearest members by summed per-position tile distance.
+    k = min(num_neighbors, len(members) - 1)
+    member_tiles = st_tiles[members]
+    block_rows = max(1, COST_BLOCK_TARGET_ELEMENTS // max(1, len(members) * st_tiles.shape[1]))
+    pairs_a, pairs_b, pair_dists = [], [], []
+    for row_start in range(0, len(members), block_rows):
+        block = member_tiles[row_start:row_start + block_rows]
+        block_ids = np.arange(len(block))
+        distances = tile_distances[block[:, None, :], member_tiles[None, :, :]].sum(axis=2)
+        distances[block_ids, row_start + block_ids] = np.inf
+        nearest = np.argpartition(distances, k - 1, axis=1)[:, :k]
+        pairs_a.append(np.repeat(members[row_start:row_start + len(block)], k))
+        pairs_b.append(members[nearest].ravel())
+        pair_dists.append(distances[block_ids[:, None], nearest].ravel())
+    return np.concatenate(pairs_a), np.concatenate(pairs_b), np.concatenate(pair_dists)
+
+def find_supertile_merge_candidates(st_tiles, active_ids, tile_distances, masks, num_neighbors):
+    # Supertiles that agree outside a masked position set hash together; within each hash group the nearest
+    # members become candidates. A mask of None groups all supertiles. Returns unique pairs (a < b) and distances.
+    pairs_a, pairs_b, pair_dists = [], [], []
+    active_tiles = st_tiles[active_ids]
+    for mask in masks:
+        if mask is None:
+            group_of = np.zeros(len(active_ids), dtype=np.intp)
+        else:
+            kept = np.ascontiguousarray(np.delete(active_tiles, mask, axis=1))
+            keys = kept.view(np.dtype((np.void, kept.shape[1] * kept.itemsize))).ravel()
+            _, group_of = np.unique(keys, return_inverse=True)
+        order = np.argsort(group_of.ravel(), kind='stable')
+        sorted_groups = group_of.ravel()[order]
+        group_starts = np.flatnonzero(np.r_[True, sorted_groups[1:] != sorted_groups[:-1]])
+        for members in np.split(order, group_starts[1:]):
+            if len(members) > 1:
+                a, b, dists = _nearest_supertile_pairs(active_ids[members], st_tiles, tile_distances, num_neighbors)
+                pairs_a.append(a); pairs_b.append(b); pair_dists.append(dists)
+    if not pairs_a:
+        return np.zeros(0, dtype=np.intp), np.zeros(0, dtype=np.intp), np.zeros(0)
+    pairs_a, pairs_b, pair_dists = np.concatenate(pairs_a), np.concatenate(pairs_b), np.concatenate(pair_dists)
+    low, high = np.minimum(pairs_a, pairs_b), np.maximum(pairs_a, pairs_b)
+    _, first = np.unique(low * len(st_tiles) + high, return_index=True)
+    return low[first], high[first], pair_dists[first]
+
+def merge_supertiles(supertile_definitions, supertile_map, max_supertiles, base_tiles, palette_dist_matrix):
+    # Greedily merges near-identical supertiles until at most max_supertiles remain. As with tiles, a merge costs
+    # the distance (summed tile distance over positions) times the less used supertile's map count, and the more
+    # used one absorbs the other. Candidates come from masked-position hashing; once those run out, each
+    # survivor's nearest survivors are used. Returns the surviving definitions and the remapped supertile map.
+    num_supertiles = len(supertile_definitions)
+    super_h, super_w = supertile_definitions[0].shape
+    num_tiles = len(base_tiles)
+    tile_distances = np.zeros((num_tiles + 1, num_tiles + 1)) # Extra row/column for out-of-range indices
+    tile_distances[:num_tiles, :num_tiles] = calculate_tile_distance_matrix(expand_sc4_tiles(base_tiles), palette_dist_matrix)
+    st_tiles = np.minimum(np.array([st.ravel() for st in supertile_definitions], dtype=np.intp), num_tiles)
+    counts = np.bincount(supertile_map.ravel(), minlength=num_supertiles).astype(np.int64)
+    merged_into = np.arange(num_supertiles)
+    is_active = np.ones(num_supertiles, dtype=bool)
+    remaining = num_supertiles
+
+    with tqdm(total=num_supertiles - max_supertiles, desc="   Merging supertiles") as pbar:
+        for masks in (supertile_mask_positions(super_w, super_h), [None]):
+            while remaining > max_supertiles:
+                pairs_a, pairs_b, pair_dists = find_supertile_merge_candidates(st_tiles, np.flatnonzero(is_active), tile_distances, masks, SUPERTILE_MERGE_NEIGHBORS)
+                costs = pair_dists * np.minimum(counts[pairs_a], counts[pairs_b])
+                order = np.lexsort((pairs_b, pairs_a, costs))
+                merge_heap = list(zip(costs[order].tolist(), pairs_a[order].tolist(), pairs_b[order].tolist(), pair_dists[order].tolist())) # Sorted, so already a heap
+                remaining_before = remaining
+                while merge_heap and remaining > max_supertiles:
+                    cost, idx1, idx2, distance = heapq.heappop(merge_heap)
+                    if not (is_active[idx1] and is_active[idx2]):
+                        continue
+                    current_cost = distance * min(counts[idx1], counts[idx2])
+                    if current_cost > cost: # Counts only grow, so a re-pushed entry is never too cheap
+                        heapq.heappush(merge_heap, (current_cost, idx1, idx2, distance))
+                        continue
+                    winner_idx, loser_idx = (idx1, idx2) if counts[idx1] >= counts[idx2] else (idx2, idx1)
+                    merged_into[loser_idx] = winner_idx
+                    counts[winner_idx] += counts[loser_idx]
+                    is_active[loser_idx] = False
+                    remaining -= 1
+                    pbar.update(1)
+                if remaining == remaining_before:
+                    break
+
+    while True: # Follow merge chains to their surviving supertile
+        resolved = merged_into[merged_into]
+        if np.array_equal(resolved, merged_into):
+            break
+        merged_into = resolved
+    survivors = np.flatnonzero(is_active)
+    new_ids = np.zeros(num_supertiles, dtype=np.intp)
+    new_ids[survivors] = np.arange(len(survivors))
+    return [supertile_definitions[i] for i in survivors], new_ids[merged_into][supertile_map].astype(supertile_map.dtype)
+
+def apply_supertiles_to_tile_map(tile_map, supertile_definitions, supertile_map):
+    # The tile map as drawn by the supertile map; cells outside whole supertiles keep their tiles.
+    super_map_h, super_map_w = supertile_map.shape
+    super_h, super_w = supertile_definitions[0].shape
+    blocks = np.stack(supertile_definitions)[supertile_map]
+    drawn_map = tile_map.copy()
+    drawn_map[:super_map_h * super_h, :super_map_w * super_w] = blocks.transpose(0, 2, 1, 3).reshape(super_map_h * super_h, super_map_w * super_w)
+    return drawn_map
+
 def translate_tile_indices(tile_tuple, working_to_final_map):
     pattern_data, color_data = tile_tuple
     final_color_data = np.zeros_like(color_data)
@@ -666,24 +1550,38 @@ def translate_tile_indices(tile_tuple, working_to_final_map):
         final_color_data[r] = (final_fg << 4) | final_bg
     return (pattern_data, final_color_data)
 
-def calculate_supertile_difference(st1_block, st2_block, base_tiles, final_pil_palette_flat, color_dist_func):
-    total_damage = 0
-    h, w = st1_block.shape
-    for r in range(h):
-        for c in range(w):
-            idx1 = st1_block[r, c]
-            idx2 = st2_block[r, c]
-            if idx1 == idx2:
-                continue
-            # Ensure indices are within bounds before accessing
-            if idx1 >= len(base_tiles) or idx2 >= len(base_tiles):
-                continue
-            tile1_data = base_tiles[idx1]
-            tile2_data = base_tiles[idx2]
-            total_damage += calculate_tile_difference(tile1_data, tile2_data, final_pil_palette_flat, color_dist_func)
-    # Avoid division by zero if supertile is 1x1
-    denominator = (w * h) if (w * h) > 0 else 1
-    return total_damage / denominator
+def calculate_tile_distance_matrix(expanded_tiles, palette_dist_matrix):
+    # Full tile-to-tile distance matrix, built from row blocks of whole-array lookups.
+    num_tiles = len(expanded_tiles)
+    distances = np.zeros((num_tiles, num_tiles))
+    block_rows = max(1, COST_BLOCK_TARGET_ELEMENTS // max(1, num_tiles * 64))
+    for row_start in range(0, num_tiles, block_rows):
+        block = expanded_tiles[row_start:row_start + block_rows]
+        distances[row_start:row_start + len(block)] = palette_dist_matrix[block[:, None, :], expanded_tiles[None, :, :]].sum(axis=2)
+    return distances
+
+def build_supertile_similarity_map(supertile_definitions, base_tiles, palette_dist_matrix):
+    # Supertile distance is the mean tile distance over positions, gathered from one tile distance matrix.
+    num_tiles = len(base_tiles)
+    tile_distances = np.zeros((num_tiles + 1, num_tiles + 1)) # Extra row/column for out-of-range indices
+    tile_distances[:num_tiles, :num_tiles] = calculate_tile_distance_matrix(expand_sc4_tiles(base_tiles), palette_dist_matrix)
+    st_tiles = np.minimum(np.array([st.ravel() for st in supertile_definitions], dtype=np.intp), num_tiles)
+    num_supertiles, num_positions = st_tiles.shape
+
+    similarity_map = defaultdict(list)
+    block_rows = max(1, COST_BLOCK_TARGET_ELEMENTS // max(1, num_supertiles * num_positions))
+    for row_start in tqdm(range(0, num_supertiles, block_rows), desc="   Clustering supertiles", leave=False):
+        block = st_tiles[row_start:row_start + block_rows]
+        distances = np.zeros((len(block), num_supertiles))
+        for pos in range(num_positions):
+            distances += tile_distances[block[:, pos][:, None], st_tiles[:, pos][None, :]]
+        distances /= max(num_positions, 1)
+        for offset, row in enumerate(distances):
+            idx = row_start + offset
+            order = np.lexsort((np.arange(num_supertiles), row))
+            order = order[order != idx]
+            similarity_map[idx] = list(zip(row[order].tolist(), order.tolist()))
+    return similarity_map
 
 def _sort_greedy_chain(items_to_sort, similarity_map, old_indices):
     if not items_to_sort:
@@ -715,7 +1613,7 @@ def _sort_greedy_chain(items_to_sort, similarity_map, old_indices):
         
         # Fallback if no pre-calculated neighbor is found (shouldn't happen)
         if best_next_index == -1:
-            best_next_index = list(remaining_indices)[0]
+            best_next_index = next(iter(remaining_indices))
 
         sorted_indices.append(best_next_index)
         remaining_indices.remove(best_next_index)
@@ -758,11 +1656,11 @@ def _sort_cluster_aware(items_to_sort, similarity_map, old_indices, threshold_mu
             continue
         
         current_cluster = []
-        q = [seed_idx]
+        q = deque([seed_idx])
         visited_in_cluster = {seed_idx}
         
         while q:
-            current_idx = q.pop(0)
+            current_idx = q.popleft()
             if current_idx in remaining_indices:
                 current_cluster.append(current_idx)
                 remaining_indices.remove(current_idx)
@@ -815,15 +1713,123 @@ def _sort_cluster_aware(items_to_sort, similarity_map, old_indices, threshold_mu
         
     return final_sorted_indices
 
-def sort_items_by_similarity(items_to_sort, similarity_map, original_indices_map, strategy='cluster', threshold=2.5):
+def _nearest_item_neighbors(similarity_map, item_set, idx, num_neighbors):
+    # The first entries of a sorted similarity list that point to items still being sorted.
+    neighbors = []
+    for cost, neighbor_idx in similarity_map.get(idx, ()):
+        if neighbor_idx in item_set and neighbor_idx != idx:
+            neighbors.append((cost, neighbor_idx))
+            if len(neighbors) == num_neighbors:
+                break
+    return neighbors
+
+def _sort_mst_walk(similarity_map, old_indices, num_neighbors=SORT_GRAPH_NEIGHBORS):
+    # Prim's minimum spanning forest over each item's nearest neighbours, linearized by a depth-first walk.
+    item_set = set(old_indices)
+    adjacency = defaultdict(list)
+    for idx in old_indices:
+        for cost, neighbor_idx in _nearest_item_neighbors(similarity_map, item_set, idx, num_neighbors):
+            adjacency[idx].append((cost, neighbor_idx))
+            adjacency[neighbor_idx].append((cost, idx))
+
+    children = defaultdict(list)
+    roots = []
+    in_tree = set()
+    next_root = 0
+    while len(in_tree) < len(old_indices):
+        while old_indices[next_root] in in_tree:
+            next_root += 1
+        root = old_indices[next_root]
+        roots.append(root)
+        in_tree.add(root)
+        frontier = [(cost, neighbor_idx, root) for cost, neighbor_idx in adjacency[root]]
+        heapq.heapify(frontier)
+        while frontier:
+            cost, idx, parent = heapq.heappop(frontier)
+            if idx in in_tree:
+                continue
+            in_tree.add(idx)
+            children[parent].append((cost, idx))
+            for edge_cost, neighbor_idx in adjacency[idx]:
+                if neighbor_idx not in in_tree:
+                    heapq.heappush(frontier, (edge_cost, neighbor_idx, idx))
+
+    # Preorder walk, nearest child first
+    sorted_indices = []
+    for root in roots:
+        stack = deque([root])
+        while stack:
+            idx = stack.pop()
+            sorted_indices.append(idx)
+            stack.extend(child for _, child in sorted(children[idx], reverse=True))
+    return sorted_indices
+
+def _refine_order_2opt(sorted_indices, similarity_map, time_budget, num_neighbors=SORT_GRAPH_NEIGHBORS):
+    # 2-opt segment reversals that bring an item next to one of its nearest neighbours, until no move
+    # shortens the path or the time budget runs out. Pairs missing from the similarity lists are never used.
+    deadline = time.monotonic() + time_budget
+    order = list(sorted_indices)
+    position = {idx: i for i, idx in enumerate(order)}
+    item_set = set(order)
+    known_costs = {idx: {} for idx in order}
+
+    def pair_cost(a, b):
+        if b not in known_costs[a]:
+            cost = next((c for c, n in similarity_map.get(a, ()) if n == b), None)
+            known_costs[a][b] = known_costs[b][a] = cost
+        return known_costs[a][b]
+
+    def reversal_gain(start, end):
+        # Path length saved by reversing order[start:end + 1]; None if a needed cost is unknown
+        removed, added = 0.0, 0.0
+        if start > 0:
+            left = order[start - 1]
+            old_cost, new_cost = pair_cost(left, order[start]), pair_cost(left, order[end])
+            if old_cost is None or new_cost is None:
+                return None
+            removed, added = removed + old_cost, added + new_cost
+        if end < len(order) - 1:
+            right = order[end + 1]
+            old_cost, new_cost = pair_cost(order[end], right), pair_cost(order[start], right)
+            if old_cost is None or new_cost is None:
+                return None
+            removed, added = removed + old_cost, added + new_cost
+        return removed - added
+
+    near = {idx: [n for _, n in _nearest_item_neighbors(similarity_map, item_set, idx, num_neighbors)] for idx in order}
+    improved = True
+    while improved and time.monotonic() < deadline:
+        improved = False
+        for i in range(len(order) - 1):
+            if time.monotonic() >= deadline:
+                break
+            for neighbor_idx in near[order[i]]:
+                j = position[neighbor_idx]
+                start, end = (i + 1, j) if j > i + 1 else (j + 1, i) if j < i - 1 else (None, None)
+                if start is None:
+                    continue
+                gain = reversal_gain(start, end)
+                if gain is not None and gain > 1e-9:
+                    order[start:end + 1] = order[start:end + 1][::-1]
+                    for k in range(start, end + 1):
+                        position[order[k]] = k
+                    improved = True
+    return order
+
+def sort_items_by_similarity(items_to_sort, similarity_map, original_indices_map, strategy='cluster', threshold=2.5, refine_seconds=0):
     old_indices = list(original_indices_map.keys())
     
     if strategy == 'cluster':
         sorted_indices = _sort_cluster_aware(items_to_sort, similarity_map, old_indices, threshold)
     elif strategy == 'greedy':
         sorted_indices = _sort_greedy_chain(items_to_sort, similarity_map, old_indices)
+    elif strategy == 'mst':
+        sorted_indices = _sort_mst_walk(similarity_map, old_indices)
     else: # 'none' or invalid
-        return items_to_sort, {i: i for i in range(len(items_to_sort))}
+        sorted_indices = old_indices
+
+    if refine_seconds > 0 and strategy != 'none' and len(sorted_indices) > 3:
+        sorted_indices = _refine_order_2opt(sorted_indices, similarity_map, refine_seconds)
 
     old_to_new_map = {old_idx: new_idx for new_idx, old_idx in enumerate(sorted_indices)}
     
@@ -835,92 +1841,301 @@ def sort_items_by_similarity(items_to_sort, similarity_map, original_indices_map
     return final_sorted_items, old_to_new_map
 
 def remap_indices(map_array, old_to_new_map):
-    h, w = map_array.shape
-    new_map = np.zeros_like(map_array)
-    for r in range(h):
-        for c in range(w):
-            old_idx = map_array[r,c]
-            if old_idx in old_to_new_map:
-                new_map[r,c] = old_to_new_map[old_idx]
-    return new_map
-
-def _init_supertile_worker(st_defs, base_tiles, palette, metric_name):
-    global worker_st_defs, worker_base_tiles, worker_palette, worker_color_dist_func
-    if COLOUR_SCIENCE_AVAILABLE:
-        warnings.filterwarnings("ignore", category=ColourUsageWarning)
-    worker_st_defs = st_defs
-    worker_base_tiles = base_tiles
-    worker_palette = palette
-    worker_color_dist_func = get_color_distance_function(metric_name)
-
-def _calculate_supertile_cost_worker(pair):
-    idx1, idx2 = pair
-    st1_block = worker_st_defs[idx1]
-    st2_block = worker_st_defs[idx2]
-    dist = calculate_supertile_difference(st1_block, st2_block, worker_base_tiles, worker_palette, worker_color_dist_func)
-    return dist, idx1, idx2
-
-def main():
-    if COLOUR_SCIENCE_AVAILABLE:
-        warnings.filterwarnings("ignore", category=ColourUsageWarning)
-        
-    print_splash_screen(SCRIPT_NAME, SCRIPT_VERSION)
-    
-    parser = argparse.ArgumentParser(
-        description=f"Transforming maps in MSX SC4 tiles like a charm.",
-        formatter_class=argparse.RawTextHelpFormatter
-    )
-    parser.add_argument("input_image", help="Input image file path")
-    parser.add_argument("--max-tiles", type=int, default=256, help="Target maximum number of unique tiles")
-    parser.add_argument("--output-dir", default=".", help="Directory for output files (defaults to current directory).")
-    parser.add_argument("--output-basename", help="Basename for output files (defaults to the input file's name).")
-    parser.add_argument("--no-dithering", action="store_true", help="Disable dithering during color quantization.")
-    parser.add_argument("--cores", type=int, default=os.cpu_count(), help="Number of CPU cores to use. Defaults to all.")
-    parser.add_argument("--color-metric", choices=['rgb', 'weighted-rgb', 'cie76', 'ciede2000'], default='weighted-rgb',
-                        help="Algorithm for color difference calculation. 'weighted-rgb' is default. CIE modes require 'pip install colormath'.")
-    parser.add_argument("--supertile-width", type=int, default=4, help="Width of supertiles in tiles. Default: 4")
-    parser.add_argument("--supertile-height", type=int, default=4, help="Height of supertiles in tiles. Default: 4")
-    parser.add_argument("--find-best-offset", action="store_true", help="[EXPERIMENTAL] Test all 64 tile offsets in parallel and pick the one which reduces color clash.")
-    parser.add_argument("--synthesize-tiles", action="store_true", help="[EXPERIMENTAL] Generate new 'ideal' tiles for merged groups instead of picking an existing one.")
+    # Indices missing from old_to_new_map become 0.
+    lookup_size = max(int(map_array.max(initial=0)), max(old_to_new_map, default=0)) + 1
+    lookup = np.zeros(lookup_size, dtype=map_array.dtype)
+    for old_idx, new_idx in old_to_new_map.items():
+        lookup[old_idx] = new_idx
+    return lookup[map_array]
 
-    parser.add_argument("--optimization-mode", type=str, choices=['neutral', 'sharp', 'balanced', 'soft'], default='neutral', 
-                        help="Palette strategy for optimization.\n"
-                             "  neutral (default): Faithful, neutral color selection.\n"
-                             "  sharp: High contrast palette for render and metrics.\n"
-                             "  balanced: High contrast palette or rendering,low contrast palette for metrics (better tile reduction).\n"
-                             "  soft: Low contrast for render and metrics (better tile reduction, 'washed' final image).")
+def render_previews(result):
+    # Reconstructed image and a 16-tiles-per-row tileset sheet, both as paletted PIL images.
+    final_pil_palette = [(0,0,0)] * 16
+    for i, color in enumerate(result["palette"]):
+        if color[0] < 128:
+            final_pil_palette[i] = (color[0]*255//7, color[1]*255//7, color[2]*255//7)
 
-    parser.add_argument("--sort-tileset", type=str, choices=['none', 'greedy', 'cluster'], default='cluster',
-                    help="Method to sort the final tileset for visual coherence.\n"
-                            "  cluster (default): Groups tiles into visually similar clusters.\n"
-                            "  greedy: Creates a continuous chain of most-similar tiles.\n"
-                            "  none: Disables sorting, uses arbitrary order.")
+    pil_final_palette_flat = [c for rgb in final_pil_palette for c in rgb]
+    pil_final_palette_flat.extend([0,0,0] * (256-16))
 
-    palette_group = parser.add_argument_group('Palette Constraints', 
-        'Rules for controlling palette slots. Later rules override earlier ones.\n'
-        'Rule formats: "auto", "block", or a color like "700" (R=7, G=0, B=0).\n'
-        'Example: --palette-slot 0 700 --palette-slot 15 block')
-    palette_group.add_argument("--palette", help="Defines all 16 palette slots in a single comma-separated string.\nIf used, this overrides all other palette arguments.\nExample: \"700,auto,auto,block,...\"")
-    palette_group.add_argument("--palette-all-slots", metavar=('<RULE>'), default="auto", help="Baseline rule for all 16 slots.")
-    palette_group.add_argument("--palette-constraints-file", help="Path to a text file with palette rules (e.g., '0 700').")
-    palette_group.add_argument("--palette-slot", nargs=2, action='append', metavar=('<INDEX>', '<RULE>'), help="Set a rule for a specific slot. Can be used multiple times.")
+    tiles = result["tiles"]
+    reconstructed_img = index_image_to_pil(render_tile_map(result["tile_map"], tiles), pil_final_palette_flat)
 
-    args = parser.parse_args()
+    tiles_per_row = 16
+    num_rows = (len(tiles) + tiles_per_row - 1) // tiles_per_row
+    tileset_layout = np.full(num_rows * tiles_per_row, -1, dtype=np.int64)
+    tileset_layout[:len(tiles)] = np.arange(len(tiles))
+    tileset_vis = index_image_to_pil(render_tile_map(tileset_layout.reshape(num_rows, tiles_per_row), tiles), pil_final_palette_flat)
+    return reconstructed_img, tileset_vis
+
+# --- Library API ---
+class ConversionCancelled(Exception):
+    pass
+
+def check_cancelled(cancel_event):
+    if cancel_event is not None and cancel_event.is_set():
+        raise ConversionCancelled()
+
+class ProgressLog(io.TextIOBase):
+    # Stands in for stdout while a conversion reports to a progress_callback: complete lines printed by the
+    # converting thread are passed on as progress_callback(None, line), other threads write to the old stream.
+    def __init__(self, progress_callback, stream):
+        self.progress_callback = progress_callback
+        self.stream = stream
+        self.thread_id = threading.get_ident()
+        self.pending = ""
+
+    def writable(self):
+        return True
+
+    def write(self, text):
+        if threading.get_ident() != self.thread_id:
+            return self.stream.write(text) if self.stream is not None else len(text)
+        *lines, self.pending = (self.pending + text).split("\n")
+        for line in lines:
+            if line.strip():
+                self.progress_callback(None, line.rstrip("\r"))
+        return len(text)
+
+def routes_progress_output(convert):
+    # Printed progress goes to the progress_callback when one is given. Without a console (sys.stderr is None
+    # in windowed builds) the progress bars write to os.devnull instead of failing.
+    @functools.wraps(convert)
+    def convert_with_progress_output(*args, progress_callback=None, **options):
+        with ExitStack() as stack:
+            if progress_callback is not None:
+                stack.enter_context(redirect_stdout(ProgressLog(progress_callback, sys.stdout)))
+            if sys.stderr is None:
+                stack.enter_context(redirect_stderr(stack.enter_context(open(os.devnull, "w"))))
+            return convert(*args, progress_callback=progress_callback, **options)
+    return convert_with_progress_output
+
+def process_cpu_seconds():
+    # CPU time of this process and of its finished worker processes.
+    times = os.times()
+    return times.user + times.system + times.children_user + times.children_system
+
+def reset_peak_rss():
+    # Linux can restart the peak RSS (VmHWM) count of a process, which makes peaks per stage measurable.
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+    except OSError:
+        pass
 
-    if (args.color_metric in ['cie76', 'ciede2000']) and not COLOUR_SCIENCE_AVAILABLE:
-        print("\n--- ERROR ---")
-        print(f"Color metric '{args.color_metric}' requires the 'colour-science' library.")
-        print("Please install it using: pip install colour-science")
+def peak_rss_mb():
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    if resource is not None:
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / (1024 * 1024 if sys.platform == 'darwin' else 1024)
+    return None
+
+def _report_stage_entry(report, name):
+    return report.setdefault("stages", {}).setdefault(name, {"wall_seconds": 0.0, "cpu_seconds": 0.0, "peak_rss_mb": None})
+
+def mark_stage(report, name):
+    # Ends the running stage of a report dict (if any) and starts timing the stage called name; None only ends it.
+    # Stages entered several times accumulate wall and CPU seconds and keep their highest peak RSS.
+    if report is None:
         return
+    running = report.pop("_running", None)
+    if running is not None:
+        entry = _report_stage_entry(report, running[0])
+        entry["wall_seconds"] += time.perf_counter() - running[1]
+        entry["cpu_seconds"] += process_cpu_seconds() - running[2]
+        peak = peak_rss_mb()
+        if peak is not None:
+            entry["peak_rss_mb"] = max(entry["peak_rss_mb"] or 0.0, peak)
+    if name is not None:
+        reset_peak_rss()
+        report["_running"] = (name, time.perf_counter(), process_cpu_seconds())
+
+def merge_report_stages(report, other):
+    # Adds the stage timings of a worker's report; wall seconds of parallel workers add up.
+    for name, timing in other.get("stages", {}).items():
+        entry = _report_stage_entry(report, name)
+        entry["wall_seconds"] += timing["wall_seconds"]
+        entry["cpu_seconds"] += timing["cpu_seconds"]
+        if timing["peak_rss_mb"] is not None:
+            entry["peak_rss_mb"] = max(entry["peak_rss_mb"] or 0.0, timing["peak_rss_mb"])
+
+def reconstruction_error(tile_map, tiles, source_strips, palette_255):
+    # Summed squared RGB error and channel sample count of a tile map drawn with (pattern, color) tiles against
+    # its palette index source, given as consecutive padded strips of whole tile rows.
+    palette = np.asarray(palette_255, dtype=np.float64).reshape(-1, 3)
+    squared_color_errors = ((palette[:, None, :] - palette[None, :, :]) ** 2).sum(axis=2)
+    squared_error, num_samples, map_row = 0.0, 0, 0
+    for source in source_strips:
+        strip_rows = source.shape[0] // 8
+        drawn = render_tile_map(tile_map[map_row:map_row + strip_rows], tiles)
+        squared_error += squared_color_errors[source, drawn].sum()
+        num_samples += source.size * 3
+        map_row += strip_rows
+    return squared_error, num_samples
+
+def error_metrics(squared_error, num_samples):
+    mse = squared_error / max(num_samples, 1)
+    return {"mse": mse, "psnr": 10 * np.log10(255 ** 2 / mse) if mse > 0 else None}
+
+def combine_images_for_palette(images):
+    # Palette selection only looks at the colour distribution, so several images are joined into one pixel column.
+    if len(images) == 1:
+        return images[0]
+    pixels = np.concatenate([np.asarray(image.convert('RGB')).reshape(-1, 3) for image in images])
+    return Image.fromarray(pixels.reshape(-1, 1, 3), 'RGB')
+
+def extract_image_tiles(image, image_key, render_working_palette_0_7, metric_working_palette_0_7, color_metric, dithering,
+                        find_best_offset, offset_criterion, best_color_pairs, balanced, palette_cache, report=None):
+    # Remaps one image to the render palette, crops it to its best tile grid offset and converts it to SC4 tiles.
+    # Returns the padded index image, the (tiles, 8) render (and, when balanced, metric) pattern and colour
+    # arrays, and the cache handle of the tiles stage.
+    quantized_cache = derive_stage_cache(palette_cache, "quantized", image_key, dithering)
+
+    def remap_image():
+        print(f"   [INFO] Remapping image to {len(render_working_palette_0_7)}-color render palette...")
+        return {"indices": np.asarray(remap_image_to_palette(image, render_working_palette_0_7, dithering), dtype=np.uint8)}
+
+    mark_stage(report, "quantization")
+    quantized_np_indices = cached_stage(quantized_cache, "quantized", remap_image)["indices"]
+
+    render_palette_255 = [(r*255//7, g*255//7, b*255//7) for r,g,b in render_working_palette_0_7]
+    render_palette_dist = build_palette_distance_matrix(render_palette_255, color_metric)
+
+    dx, dy = 0, 0
+    if find_best_offset:
+        mark_stage(report, "offset_search")
+        offset_cache = derive_stage_cache(quantized_cache, "offset", offset_criterion, best_color_pairs)
+        best_offset = cached_stage(offset_cache, "offset", lambda: {
+            "offset": np.array(find_best_tiling_offset(quantized_np_indices, render_palette_dist, offset_criterion, best_color_pairs))})["offset"]
+        dx, dy = (int(v) for v in best_offset)
+        print(f"   [INFO] Optimal offset found at ({dx}, {dy}). Cropping image.")
+
+    mark_stage(report, "extraction")
+    quantized_np_indices = pad_indices_to_tile_size(quantized_np_indices[dy:, dx:])
+    tiles_cache = derive_stage_cache(quantized_cache, "tiles", dx, dy, best_color_pairs)
+
+    def quantize_tiles():
+        arrays = {}
+        arrays["render_patterns"], arrays["render_colors"] = quantize_image_to_sc4_arrays(quantized_np_indices, render_palette_dist, best_color_pairs)
+        if balanced:
+            # Render palette indices are remapped to their nearest metric palette colour through a lookup table
+            metric_palette_255 = [(r*255//7, g*255//7, b*255//7) for r,g,b in metric_working_palette_0_7]
+            metric_palette_dist = build_palette_distance_matrix(metric_palette_255, color_metric)
+            metric_indices = build_palette_remap_lut(render_palette_255, metric_palette_255)[quantized_np_indices]
+            arrays["metric_patterns"], arrays["metric_colors"] = quantize_image_to_sc4_arrays(metric_indices, metric_palette_dist, best_color_pairs)
+        return arrays
+
+    extracted = cached_stage(tiles_cache, "tiles", quantize_tiles)
+    extracted["indices"] = quantized_np_indices
+    return extracted, tiles_cache
+
+def _extract_image_tiles_worker(job):
+    # A worker times its stages in its own report, which travels back with the result
+    *args, report = job
+    worker_report = {} if report is not None else None
+    extracted = extract_image_tiles(*args, report=worker_report)
+    mark_stage(worker_report, None)
+    return extracted, worker_report
+
+def remap_image_in_strips(image, strip_rows, working_palette_0_7, dithering, report=None):
+    # Yields the palette index image in padded strips of strip_rows tile rows. Dithering error flows into each
+    # strip from one tile row of context above it.
+    width, height = image.size
+    strip_height = strip_rows * 8
+    for top in range(0, height, strip_height):
+        mark_stage(report, "quantization")
+        context = min(top, 8) if dithering else 0
+        strip = remap_image_to_palette(image.crop((0, top - context, width, min(top + strip_height, height))), working_palette_0_7, dithering)
+        yield pad_indices_to_tile_size(np.asarray(strip, dtype=np.uint8)[context:])
+
+def stream_image_tiles(image, tile_table, strip_rows, render_working_palette_0_7, metric_working_palette_0_7, color_metric,
+                       dithering, best_color_pairs, balanced, cancel_event=None, report=None):
+    # Remaps and converts an image in strips of strip_rows tile rows, folding each strip straight into tile_table,
+    # so only the table and the int32 tile id map outlive a strip. Returns the (tile rows, tile columns) id map.
+    render_palette_255 = [(r*255//7, g*255//7, b*255//7) for r,g,b in render_working_palette_0_7]
+    render_palette_dist = build_palette_distance_matrix(render_palette_255, color_metric)
+    metric_palette_255 = [(r*255//7, g*255//7, b*255//7) for r,g,b in metric_working_palette_0_7]
+    if balanced:
+        metric_palette_dist = build_palette_distance_matrix(metric_palette_255, color_metric)
+        metric_lut = build_palette_remap_lut(render_palette_255, metric_palette_255)
+
+    strip_tile_ids = []
+    num_strips = -(-image.size[1] // (strip_rows * 8))
+    for strip_indices in tqdm(remap_image_in_strips(image, strip_rows, render_working_palette_0_7, dithering, report), total=num_strips, desc="   Streaming strips"):
+        check_cancelled(cancel_event)
+        mark_stage(report, "extraction")
+        tile_map_height, tile_map_width = strip_indices.shape[0] // 8, strip_indices.shape[1] // 8
+
+        render_tiles = np.hstack(quantize_image_to_sc4_arrays(strip_indices, render_palette_dist, best_color_pairs, desc=None))
+        if balanced:
+            metric_tiles = np.hstack(quantize_image_to_sc4_arrays(metric_lut[strip_indices], metric_palette_dist, best_color_pairs, desc=None))
+        else:
+            metric_tiles = render_tiles
+        source_tiles = strip_indices.reshape(tile_map_height, 8, tile_map_width, 8).swapaxes(1, 2).reshape(-1, 8, 8)
+        strip_tile_ids.append(fold_tiles_into_table(tile_table, metric_tiles, render_tiles, source_tiles, metric_palette_255).reshape(tile_map_height, tile_map_width))
+    return np.concatenate(strip_tile_ids)
+
+def convert_image(image, **options):
+    # Converts a PIL image into an SC4 project held in memory; see convert_images for the options and result.
+    return convert_images([image], **options)[0]
+
+@routes_progress_output
+def convert_images(images, palette_rules=None, max_tiles=256, dithering=True, cores=None, color_metric='weighted-rgb',
+                   supertile_width=4, supertile_height=4, find_best_offset=False, offset_criterion='error',
+                   best_color_pairs=False, synthesize_tiles=False, merge_costs='incremental', reduction_mode='merge',
+                   ann_neighbors=None, max_memory=None, optimization_mode='neutral', sort_tileset='cluster',
+                   sort_refine_seconds=0, palette_search_seconds=0, cache_dir=None, strip_rows=None, max_supertiles=None,
+                   progress_callback=None, cancel_event=None, report=None):
+    # Converts PIL images into SC4 projects held in memory that share one palette and one tileset of at most
+    # max_tiles tiles. Options mirror the command line flags.
+    # progress_callback(stage, message) is called at the start of each stage and with stage None for every other
+    # progress line; without a callback, progress is printed. cancel_event (anything with is_set(), e.g.
+    # threading.Event) is polled between stages and while reducing tiles, and raises ConversionCancelled.
+    # Invalid options raise ValueError. With a cache_dir, the palettes, quantized images, SC4 tiles and initial
+    # tile cost tables are reused from earlier runs whose inputs to that stage match.
+    # With strip_rows, images are remapped and converted in strips of that many tile rows that are folded into
+    # the unique tile table one at a time; quantized images and SC4 tiles are then neither held nor cached.
+    # max_supertiles caps the supertiles of each image by merging near-identical ones.
+    # palette_search_seconds > 0 refines the auto colours of the render palette by a local search over the
+    # master palette, scored by the error of sampled rows converted to two colours.
+    # A report dict receives wall time, CPU time and peak RSS per pipeline stage under "stages" and tile counts
+    # and the reconstruction error against the quantized source (MSE, PSNR) under "result".
+    # Returns one dict per image with the 16-slot "palette" (0-7 RGB, blocked slots as (128,0,0)), "tiles" as
+    # (pattern, colors) pairs, its "tile_map", its "supertiles" (index arrays of "supertile_size") and its supertile "map".
+    if COLOUR_SCIENCE_AVAILABLE:
+        warnings.filterwarnings("ignore", category=ColourUsageWarning)
+
+    def stage(label, message):
+        check_cancelled(cancel_event)
+        if progress_callback is not None:
+            progress_callback(label, message)
+        else:
+            print(f"{label}. {message}")
+
+    if (color_metric in ['cie76', 'ciede2000']) and not COLOUR_SCIENCE_AVAILABLE:
+        raise ValueError(f"Color metric '{color_metric}' requires the 'colour-science' library (pip install colour-science).")
+    if max_supertiles is not None and max_supertiles < 1:
+        raise ValueError("The supertile budget must be at least 1.")
+    if max_supertiles and supertile_width == 1 and supertile_height == 1:
+        raise ValueError("A supertile budget needs supertiles larger than 1x1; with 1x1 supertiles the tile budget (--max-tiles) applies.")
+    if strip_rows is not None and strip_rows < 1:
+        raise ValueError("Strips must be at least one tile row high.")
+    if strip_rows and find_best_offset:
+        raise ValueError("The tile offset search needs the whole remapped image and cannot be combined with streamed strips.")
+    cores = cores or os.cpu_count()
+    final_rules = palette_rules or ['auto'] * 16
 
     # --- 1. Process Palette Constraints ---
-    print("1. Processing palette constraints...")
-    final_rules = process_palette_constraints(args)
-    
+    stage("1", "Processing palette constraints...")
     fixed_colors_0_7 = []
     fixed_slot_indices = []
     auto_slot_indices = []
-    
+
     for i, rule in enumerate(final_rules):
         if rule == 'auto':
             auto_slot_indices.append(i)
@@ -933,129 +2148,127 @@ def main():
                 fixed_colors_0_7.append((r, g, b))
                 fixed_slot_indices.append(i)
             except (ValueError, IndexError):
-                print(f"Error: Invalid color rule '{rule}' for slot {i}. Rules must be either 3 digits from 0-7 (e.g., '700'), 'block' or 'auto'.")
-                sys.exit(1)
+                raise ValueError(f"Invalid color rule '{rule}' for slot {i}. Rules must be either 3 digits from 0-7 (e.g., '700'), 'block' or 'auto'.")
 
     num_auto_colors = len(auto_slot_indices)
     num_valid_colors = len(fixed_colors_0_7) + num_auto_colors
     print(f"   [INFO] Palette config: {len(fixed_colors_0_7)} fixed, {num_auto_colors} auto, {16-num_valid_colors} blocked.")
-    
-    if num_valid_colors == 0:
-        print("Error: All palette slots are blocked. Cannot process image.")
-        return
-    
-    try:
-        original_pil_image = Image.open(args.input_image)
-    except FileNotFoundError:
-        print(f"Error: Input image '{args.input_image}' not found.")
-        return
-
-    if args.output_basename:
-        base_name = args.output_basename
-    else:
-        base_name = os.path.splitext(os.path.basename(args.input_image))[0]
 
-    full_output_path = os.path.join(args.output_dir, base_name)
-    color_dist_func = get_color_distance_function(args.color_metric)
+    if num_valid_colors == 0:
+        raise ValueError("All palette slots are blocked. Cannot process image.")
 
     # --- 2. Generate Palettes based on Mode ---
-    print(f"2. Generating palettes (mode: {args.optimization_mode})...")
-    
-    if args.optimization_mode == 'neutral':
-        render_palette_func = find_best_auto_colors_neutral
-        metric_palette_func = find_best_auto_colors_neutral
-    elif args.optimization_mode == 'sharp':
-        render_palette_func = find_best_auto_colors_sharp
-        metric_palette_func = find_best_auto_colors_sharp
-    elif args.optimization_mode == 'balanced':
-        render_palette_func = find_best_auto_colors_sharp
-        metric_palette_func = find_best_auto_colors_soft
-    else: # soft
-        render_palette_func = find_best_auto_colors_soft
-        metric_palette_func = find_best_auto_colors_soft
-
-    render_auto_colors = render_palette_func(original_pil_image, num_auto_colors, fixed_colors_0_7, color_dist_func)
+    stage("2", f"Generating palettes (mode: {optimization_mode})...")
+    image_keys = [image_cache_key(image) for image in images] if cache_dir else [None] * len(images)
+    cache = (cache_dir, hashlib.sha256(repr(image_keys).encode()).hexdigest()) if cache_dir else None
+    palette_cache = derive_stage_cache(cache, "palettes", final_rules, optimization_mode, color_metric, palette_search_seconds,
+                                       best_color_pairs if palette_search_seconds > 0 else None)
+    palette_image = combine_images_for_palette(images)
+
+    def generate_palettes():
+        if optimization_mode == 'neutral':
+            render_palette_func = find_best_auto_colors_neutral
+            metric_palette_func = find_best_auto_colors_neutral
+        elif optimization_mode == 'sharp':
+            render_palette_func = find_best_auto_colors_sharp
+            metric_palette_func = find_best_auto_colors_sharp
+        elif optimization_mode == 'balanced':
+            render_palette_func = find_best_auto_colors_sharp
+            metric_palette_func = find_best_auto_colors_soft
+        else: # soft
+            render_palette_func = find_best_auto_colors_soft
+            metric_palette_func = find_best_auto_colors_soft
+
+        render_auto_colors = render_palette_func(palette_image, num_auto_colors, fixed_colors_0_7, color_metric)
+        if palette_search_seconds > 0:
+            render_auto_colors = search_auto_colors(images, render_auto_colors, fixed_colors_0_7, color_metric, palette_search_seconds,
+                                                    cores, best_color_pairs, cancel_event)
+        if optimization_mode == 'balanced':
+            print(f"   [INFO] Generating separate 'soft' palette for optimization metrics...")
+            metric_auto_colors = metric_palette_func(palette_image, num_auto_colors, fixed_colors_0_7, color_metric)
+        else:
+            metric_auto_colors = render_auto_colors
+        return {
+            "render_auto_colors": np.array(render_auto_colors, dtype=np.uint8).reshape(-1, 3),
+            "metric_auto_colors": np.array(metric_auto_colors, dtype=np.uint8).reshape(-1, 3),
+        }
+
+    mark_stage(report, "palette")
+    palettes = cached_stage(palette_cache, "palettes", generate_palettes)
+    render_auto_colors = [tuple(color) for color in palettes["render_auto_colors"].tolist()]
     print(f"   [INFO] Found {len(render_auto_colors)} unique colors for final render palette.")
     render_working_palette_0_7 = fixed_colors_0_7 + render_auto_colors
     working_to_final_map = {i: final_slot for i, final_slot in enumerate(fixed_slot_indices + auto_slot_indices[:len(render_auto_colors)])}
-    
-    if args.optimization_mode == 'balanced':
-        print(f"   [INFO] Generating separate 'soft' palette for optimization metrics...")
-        metric_auto_colors = metric_palette_func(original_pil_image, num_auto_colors, fixed_colors_0_7, color_dist_func)
-        metric_working_palette_0_7 = fixed_colors_0_7 + metric_auto_colors
-    else:
-        metric_working_palette_0_7 = render_working_palette_0_7
-
-    # --- 3. Remap image and process tiles ---
-    print(f"   [INFO] Remapping image to {len(render_working_palette_0_7)}-color render palette...")
-    quantized_pil_image = remap_image_to_palette(original_pil_image, render_working_palette_0_7, not args.no_dithering)
-
-    if args.find_best_offset:
-        print(f"3b. Evaluating 64 possible offsets on {args.cores} cores...")
-        best_offset = find_best_tiling_offset(quantized_pil_image, args.cores)
-        dx, dy = best_offset
-        print(f"   [INFO] Optimal offset found at ({dx}, {dy}). Cropping image.")
-        width, height = quantized_pil_image.size
-        quantized_pil_image = quantized_pil_image.crop((dx, dy, width, height))
-
-    quantized_pil_image = pad_image_to_tile_size(quantized_pil_image)
-    img_width, img_height = quantized_pil_image.size
-    tile_map_width, tile_map_height = img_width // 8, img_height // 8
+    metric_working_palette_0_7 = fixed_colors_0_7 + [tuple(color) for color in palettes["metric_auto_colors"].tolist()]
 
-    print("4. Extracting and processing source tiles...")
-    all_source_tiles_sc4_render = []
-    all_source_tiles_sc4_metric = []
-    all_source_tiles_quantized = [] # For synthesis
-    
-    render_palette_255 = [(r*255//7, g*255//7, b*255//7) for r,g,b in render_working_palette_0_7]
+    # --- 3. Remap images and process tiles ---
+    check_cancelled(cancel_event)
     metric_palette_255 = [(r*255//7, g*255//7, b*255//7) for r,g,b in metric_working_palette_0_7]
-
-    quantized_np_indices = np.array(quantized_pil_image.getdata(), dtype=np.uint8).reshape((img_height, img_width))
-    for ty in tqdm(range(tile_map_height), desc="   Processing Tiles"):
-        for tx in range(tile_map_width):
-            tile_block = quantized_np_indices[ty*8:(ty+1)*8, tx*8:(tx+1)*8]
-            all_source_tiles_quantized.append(tile_block)
-            
-            all_source_tiles_sc4_render.append(process_tile_for_screen4(tile_block, render_palette_255, color_dist_func))
-            
-            if args.optimization_mode == 'balanced':
-                metric_remapped_tile_block = np.zeros_like(tile_block)
-                for r in range(8):
-                    for c in range(8):
-                        render_idx = tile_block[r,c]
-                        render_color_255 = render_palette_255[render_idx]
-                        best_dist = float('inf')
-                        best_metric_idx = 0
-                        for i, metric_color_255 in enumerate(metric_palette_255):
-                            dist = color_distance_rgb(render_color_255, metric_color_255)
-                            if dist < best_dist:
-                                best_dist = dist
-                                best_metric_idx = i
-                        metric_remapped_tile_block[r,c] = best_metric_idx
-                all_source_tiles_sc4_metric.append(process_tile_for_screen4(metric_remapped_tile_block, metric_palette_255, color_dist_func))
-            else:
-                all_source_tiles_sc4_metric = all_source_tiles_sc4_render
-
-    print(f"   [INFO] Image contains a total of {len(all_source_tiles_sc4_render)} tiles (including duplicates).")
+    balanced = optimization_mode == 'balanced'
+    tile_table = new_tile_table(track_rgb=synthesize_tiles)
+    if strip_rows:
+        stage("4", f"Streaming images through tile extraction in strips of {strip_rows} tile rows...")
+        image_tile_ids = [stream_image_tiles(image, tile_table, strip_rows, render_working_palette_0_7, metric_working_palette_0_7, color_metric,
+                                             dithering, best_color_pairs, balanced, cancel_event, report) for image in images]
+        tiles_cache = derive_stage_cache(palette_cache, "streamed-tiles", dithering, best_color_pairs, strip_rows)
+        source_indices = None
+    else:
+        if find_best_offset:
+            stage("3b", f"Evaluating 64 possible offsets by {offset_criterion}...")
+        jobs = [(image, image_key, render_working_palette_0_7, metric_working_palette_0_7, color_metric, dithering,
+                 find_best_offset, offset_criterion, best_color_pairs, balanced, palette_cache, report)
+                for image, image_key in zip(images, image_keys)]
+        if len(jobs) == 1 or cores == 1:
+            extracted_images = [extract_image_tiles(*job) for job in jobs]
+        else:
+            # Images are independent until the shared tileset is optimized
+            mark_stage(report, None)
+            extracted_images = []
+            with worker_pool(min(cores, len(jobs))) as pool:
+                for extracted, worker_report in pool.imap(_extract_image_tiles_worker, jobs):
+                    check_cancelled(cancel_event)
+                    extracted_images.append(extracted)
+                    if report is not None:
+                        merge_report_stages(report, worker_report)
+
+        stage("4", "Extracting and processing source tiles...")
+        tiles_cache = extracted_images[0][1] if len(images) == 1 else derive_stage_cache(palette_cache, "tiles", [handle for _, handle in extracted_images])
+
+        # All images' tiles go into one table (image by image, row-major within each) for the shared optimization
+        mark_stage(report, "extraction")
+        print("   Finding unique source tiles and their map counts...")
+        image_tile_ids = []
+        for extracted, _ in extracted_images:
+            tile_map_height, tile_map_width = extracted["indices"].shape[0] // 8, extracted["indices"].shape[1] // 8
+            render_tiles = np.hstack((extracted["render_patterns"], extracted["render_colors"]))
+            metric_tiles = np.hstack((extracted["metric_patterns"], extracted["metric_colors"])) if balanced else render_tiles
+            source_tiles = extracted["indices"].reshape(tile_map_height, 8, tile_map_width, 8).swapaxes(1, 2).reshape(-1, 8, 8) if synthesize_tiles else None
+            image_tile_ids.append(fold_tiles_into_table(tile_table, metric_tiles, render_tiles, source_tiles, metric_palette_255).reshape(tile_map_height, tile_map_width))
+        # The error report compares against the quantized source, which streamed strips remap again instead
+        source_indices = [extracted["indices"] for extracted, _ in extracted_images] if report is not None else None
+        del extracted_images
+
+    image_tile_shapes = [tile_ids.shape for tile_ids in image_tile_ids]
+    all_tile_ids = np.concatenate([tile_ids.ravel() for tile_ids in image_tile_ids])
+    if len(images) == 1:
+        print(f"   [INFO] Image contains a total of {len(all_tile_ids)} tiles (including duplicates).")
+    else:
+        print(f"   [INFO] {len(images)} images contain a total of {len(all_tile_ids)} tiles (including duplicates).")
 
     # --- 5. Optimize Tiles ---
-    print("5. Optimizing tiles...")
-    optimized_patterns_metric, final_tile_map_indices = optimize_by_precomputation_and_heap(
-        all_source_tiles_sc4_metric, all_source_tiles_quantized, args.max_tiles, tile_map_width, tile_map_height,
-        metric_palette_255, args.cores, args.color_metric, args.synthesize_tiles, args.sort_tileset)    
+    stage("5", "Optimizing tiles...")
+    # The optimizer sees the tile ids of all images in a row; its map is cut back into one tile map per image afterwards
+    optimized_patterns_metric, all_tile_map_indices = optimize_by_precomputation_and_heap(
+        tile_table, all_tile_ids, max_tiles, metric_palette_255, cores, color_metric, synthesize_tiles, sort_tileset, max_memory, ann_neighbors, merge_costs, reduction_mode, sort_refine_seconds,
+        cancel_event, tiles_cache, report)
     # --- 6. Translate to Final Render Tiles ---
-    print("6. Translating tiles to final format...")
-    if args.optimization_mode == 'balanced':
-        unique_metric_tile_groups = defaultdict(list)
-        for i, tile_data in enumerate(all_source_tiles_sc4_metric):
-            key = tile_data[0].tobytes() + tile_data[1].tobytes()
-            unique_metric_tile_groups[key].append(i)
-        
+    stage("6", "Translating tiles to final format...")
+    if balanced:
+        # Each metric tile is rendered as the render tile of its first occurrence
         final_render_patterns = []
         for metric_tile in optimized_patterns_metric:
-            key = metric_tile[0].tobytes() + metric_tile[1].tobytes()
-            original_location = unique_metric_tile_groups[key][0]
-            final_render_patterns.append(all_source_tiles_sc4_render[original_location])
+            render_tile = tile_table["render_tiles"][tile_table["index"][metric_tile[0].tobytes() + metric_tile[1].tobytes()]]
+            final_render_patterns.append((render_tile[:8], render_tile[8:]))
     else:
         final_render_patterns = optimized_patterns_metric
 
@@ -1063,117 +2276,242 @@ def main():
     num_unique_base_patterns = len(final_unique_patterns)
     print(f"   [INFO] Optimization complete. Final tile count: {num_unique_base_patterns}")
 
-    # --- 7. Supertile Discovery and Sorting ---
-    supertile_definitions = []
-    final_map_to_write = final_tile_map_indices
-    num_supertiles = num_unique_base_patterns
-    use_supertiles = args.supertile_width > 1 or args.supertile_height > 1
+    image_tile_counts = [tile_map_height * tile_map_width for tile_map_height, tile_map_width in image_tile_shapes]
+    image_tile_maps = [cells.reshape(shape) for cells, shape in zip(np.split(all_tile_map_indices, np.cumsum(image_tile_counts)[:-1]), image_tile_shapes)]
 
-    # Part A: Discover unique supertiles
+    # --- 7. Supertile Discovery and Sorting ---
+    mark_stage(report, "supertiles")
+    use_supertiles = supertile_width > 1 or supertile_height > 1
     if use_supertiles:
-        print(f"7. Discovering {args.supertile_width}x{args.supertile_height} supertiles...")
-        supertile_definitions, supertile_map = discover_supertiles(final_tile_map_indices, args.supertile_width, args.supertile_height)
-        num_supertiles = len(supertile_definitions)
-        final_map_to_write = supertile_map
-        print(f"   [INFO] Found {num_supertiles} unique {args.supertile_width}x{args.supertile_height} supertiles.")
+        stage("7", f"Discovering {supertile_width}x{supertile_height} supertiles...")
     else:
-        print("7. Generating 1x1 supertile definitions...")
-        for i in range(num_unique_base_patterns):
-            supertile_definitions.append(np.array([[i]], dtype=np.int16))
+        stage("7", "Generating 1x1 supertile definitions...")
 
-    # Part B: Create the final MSX palette (must be done before sorting supertiles)
+    # Part A: Create the final MSX palette (must be done before sorting supertiles)
     final_palette_0_7 = [(0,0,0)] * 16
     for i, slot_rule in enumerate(final_rules):
         if slot_rule == 'block':
+            # red channel bit 7 is the flag for MSX Tile Forge to skip importing blocked slot
             final_palette_0_7[i] = (128, 0, 0)
     for i, color in enumerate(render_working_palette_0_7):
         final_slot = working_to_final_map[i]
         final_palette_0_7[final_slot] = color
 
-    # Part C: Sort the supertiles by visual similarity if requested
-    if use_supertiles and args.sort_tileset != 'none' and num_supertiles > 1:
-        # Create a PIL-compatible RGB 0-255 palette for the comparison function
-        final_pil_palette_for_compare = [(c[0]*255//7, c[1]*255//7, c[2]*255//7) if c[0] < 128 else (0,0,0) for c in final_palette_0_7]
-        pil_final_palette_flat_for_compare = [comp for rgb in final_pil_palette_for_compare for comp in rgb]
-        
-        print(f"   Sorting {num_supertiles} supertiles for visual coherence...")
-        st_similarity_map = defaultdict(list)
-        st_pairs = list(combinations(range(num_supertiles), 2))
-        
-        st_similarity_map = defaultdict(list)
-        st_pairs = list(combinations(range(num_supertiles), 2))
+    # Create a PIL-compatible RGB 0-255 palette for the comparison function
+    final_pil_palette_for_compare = [(c[0]*255//7, c[1]*255//7, c[2]*255//7) if c[0] < 128 else (0,0,0) for c in final_palette_0_7]
+    final_palette_dist = build_palette_distance_matrix(final_pil_palette_for_compare, color_metric)
 
-        init_args = (supertile_definitions, final_unique_patterns, final_pil_palette_for_compare, args.color_metric)
-        chunksize = max(1, len(st_pairs) // (args.cores * 16))
+    results = []
+    for final_tile_map_indices in image_tile_maps:
+        check_cancelled(cancel_event)
+        mark_stage(report, "supertiles")
+        supertile_definitions = []
+        final_map_to_write = final_tile_map_indices
+        num_supertiles = num_unique_base_patterns
+
+        # Part B: Discover unique supertiles
+        if use_supertiles:
+            supertile_definitions, supertile_map = discover_supertiles(final_tile_map_indices, supertile_width, supertile_height)
+            num_supertiles = len(supertile_definitions)
+            print(f"   [INFO] Found {num_supertiles} unique {supertile_width}x{supertile_height} supertiles.")
+            if max_supertiles and num_supertiles > max_supertiles:
+                supertile_definitions, supertile_map = merge_supertiles(supertile_definitions, supertile_map, max_supertiles, final_unique_patterns, final_palette_dist)
+                num_supertiles = len(supertile_definitions)
+                final_tile_map_indices = apply_supertiles_to_tile_map(final_tile_map_indices, supertile_definitions, supertile_map)
+                print(f"   [INFO] Merged near-identical supertiles down to {num_supertiles}.")
+            final_map_to_write = supertile_map
+        else:
+            for i in range(num_unique_base_patterns):
+                supertile_definitions.append(np.array([[i]], dtype=np.int16))
+
+        # Part C: Sort the supertiles by visual similarity if requested
+        if use_supertiles and sort_tileset != 'none' and num_supertiles > 1:
+            mark_stage(report, "sorting")
+            print(f"   Sorting {num_supertiles} supertiles for visual coherence...")
+            st_similarity_map = build_supertile_similarity_map(supertile_definitions, final_unique_patterns, final_palette_dist)
+
+            original_st_map = {i: st for i, st in enumerate(supertile_definitions)}
+            sorted_supertiles, old_st_to_new_map = sort_items_by_similarity(
+                supertile_definitions,
+                st_similarity_map,
+                original_st_map,
+                strategy=sort_tileset,
+                refine_seconds=sort_refine_seconds
+            )
+
+            # Update the definitions and map with the new sorted order
+            supertile_definitions = sorted_supertiles
+            final_map_to_write = remap_indices(supertile_map, old_st_to_new_map)
+
+        results.append({
+            "palette": final_palette_0_7,
+            "tiles": final_unique_patterns,
+            "tile_map": final_tile_map_indices,
+            "supertiles": supertile_definitions,
+            "supertile_size": (supertile_width, supertile_height),
+            "map": final_map_to_write,
+        })
+
+    if report is not None:
+        mark_stage(report, "metrics")
+        render_palette_255 = [(r*255//7, g*255//7, b*255//7) for r,g,b in render_working_palette_0_7]
+        image_reports = []
+        total_error, total_samples = 0.0, 0
+        for i, (image, result) in enumerate(zip(images, results)):
+            if source_indices is not None:
+                source_strips = [source_indices[i]]
+            else:
+                source_strips = remap_image_in_strips(image, strip_rows, render_working_palette_0_7, dithering)
+            squared_error, num_samples = reconstruction_error(result["tile_map"], final_render_patterns, source_strips, render_palette_255)
+            total_error += squared_error
+            total_samples += num_samples
+            map_height, map_width = result["tile_map"].shape
+            image_reports.append({"map_tiles": [map_width, map_height], "supertiles": len(result["supertiles"]), **error_metrics(squared_error, num_samples)})
+        report["result"] = {
+            "source_tiles": int(len(all_tile_ids)),
+            "unique_source_tiles": int(tile_table["size"]),
+            "final_tiles": num_unique_base_patterns,
+            **error_metrics(total_error, total_samples),
+            "images": image_reports,
+        }
+        mark_stage(report, None)
+    return results
 
-        with multiprocessing.Pool(processes=args.cores, initializer=_init_supertile_worker, initargs=init_args) as pool:
-            for dist, idx1, idx2 in tqdm(pool.imap_unordered(_calculate_supertile_cost_worker, st_pairs, chunksize=chunksize), total=len(st_pairs), desc="   Clustering supertiles", leave=False):
-                st_similarity_map[idx1].append((dist, idx2))
-                st_similarity_map[idx2].append((dist, idx1))
+def main():
+    print_splash_screen(SCRIPT_NAME, SCRIPT_VERSION)
 
-        for idx in st_similarity_map:
-            st_similarity_map[idx].sort()
+    parser = argparse.ArgumentParser(
+        description=f"Transforming maps in MSX SC4 tiles like a charm.",
+        formatter_class=argparse.RawTextHelpFormatter
+    )
+    parser.add_argument("input_images", nargs='+', metavar="input_image",
+                        help="Input image file path. With several images, one palette and one tileset of --max-tiles tiles\nis shared by all of them, and each image gets its own supertiles and map.")
+    parser.add_argument("--max-tiles", type=int, default=256, help="Target maximum number of unique tiles")
+    parser.add_argument("--output-dir", default=".", help="Directory for output files (defaults to current directory).")
+    parser.add_argument("--output-basename", help="Basename for output files (defaults to the input file's name).\nWith several images it prefixes each image's name.")
+    parser.add_argument("--no-dithering", action="store_true", help="Disable dithering during color quantization.")
+    parser.add_argument("--cores", type=int, default=os.cpu_count(), help="Number of CPU cores to use. Defaults to all.")
+    parser.add_argument("--color-metric", choices=['rgb', 'weighted-rgb', 'cie76', 'ciede2000'], default='weighted-rgb',
+                        help="Algorithm for color difference calculation. 'weighted-rgb' is default. CIE modes require 'pip install colormath'.")
+    parser.add_argument("--supertile-width", type=int, default=4, help="Width of supertiles in tiles. Default: 4")
+    parser.add_argument("--supertile-height", type=int, default=4, help="Height of supertiles in tiles. Default: 4")
+    parser.add_argument("--max-supertiles", type=int, metavar="N", help="Target maximum number of unique supertiles (per image). Near-identical supertiles are\nmerged, cheapest first by tile distance weighted by use, until the budget holds.\nA budget of 255 keeps the map at one byte per cell. Not valid with 1x1 supertiles.\nDefault: no limit.")
+    parser.add_argument("--find-best-offset", action="store_true", help="[EXPERIMENTAL] Test all 64 tile offsets and pick the best one (see --offset-criterion).")
+    parser.add_argument("--offset-criterion", choices=['error', 'clash', 'tiles'], default='error',
+                        help="How --find-best-offset ranks offsets.\n"
+                             "  error (default): Lowest colour error of the two-colour row conversion.\n"
+                             "  clash: Fewest 8-pixel rows with more than two colours.\n"
+                             "  tiles: Fewest unique tiles after conversion.")
+    parser.add_argument("--best-color-pairs", action="store_true", help="Pick the two colours of each 8-pixel row by testing all colour pairs for minimal error,\ninstead of taking the two most frequent ones.")
+    parser.add_argument("--synthesize-tiles", action="store_true", help="[EXPERIMENTAL] Generate new 'ideal' tiles for merged groups instead of picking an existing one.")
+    parser.add_argument("--merge-costs", choices=['incremental', 'static'], default='incremental',
+                        help="How pair costs evolve while merging tiles.\n"
+                             "  incremental (default): Costs of a merged tile are recomputed from its new count (and synthesized pixels).\n"
+                             "  static: Costs computed once before merging are used throughout.")
+    parser.add_argument("--reduction-mode", choices=['merge', 'cluster'], default='merge',
+                        help="How unique tiles are reduced to --max-tiles.\n"
+                             "  merge (default): Greedily merge the cheapest tile pairs.\n"
+                             "  cluster: Weighted k-means over tile pixels; each cluster keeps its medoid tile. Scales as N*K per iteration.")
+    parser.add_argument("--ann-neighbors", type=int, metavar="K", help="Approximate search for large images: a KD-tree over tile features proposes\nK candidates per tile and exact costs are computed only for those.")
+    parser.add_argument("--cache-dir", metavar="DIR", help="Reuse stage results (palettes, quantized image, SC4 tiles, tile costs) of earlier runs\non the same image. Only stages whose inputs changed are recomputed.")
+    parser.add_argument("--strip-rows", type=int, metavar="ROWS", help="Remap and convert images in strips of ROWS tile rows, keeping only unique tiles and\na tile id map in memory. For very large images. Dithering restarts at strip edges\n(with one tile row of context); cannot be combined with --find-best-offset.")
+    parser.add_argument("--report", metavar="FILE", help="Write a JSON report: wall time, CPU time and peak RSS per pipeline stage, tile counts\nand the reconstruction error (MSE, PSNR) against the quantized source.")
+    parser.add_argument("--max-memory", type=int, metavar="MB", help="Memory budget for tile pair costs. If all pairs do not fit, only each tile's\nnearest neighbours are kept (the count is chosen from the budget).\nWithout a budget, exact mode keeps every tile pair as Python objects, so its\nmemory and setup time grow with the square of the unique tile count.")
 
-        original_st_map = {i: st for i, st in enumerate(supertile_definitions)}
-        sorted_supertiles, old_st_to_new_map = sort_items_by_similarity(
-            supertile_definitions,
-            st_similarity_map,
-            original_st_map,
-            strategy=args.sort_tileset
-        )
+    parser.add_argument("--optimization-mode", type=str, choices=['neutral', 'sharp', 'balanced', 'soft'], default='neutral', 
+                        help="Palette strategy for optimization.\n"
+                             "  neutral (default): Faithful, neutral color selection.\n"
+                             "  sharp: High contrast palette for render and metrics.\n"
+                             "  balanced: High contrast palette or rendering,low contrast palette for metrics (better tile reduction).\n"
+                             "  soft: Low contrast for render and metrics (better tile reduction, 'washed' final image).")
 
-        # Update the definitions and map with the new sorted order
-        supertile_definitions = sorted_supertiles
-        final_map_to_write = remap_indices(supertile_map, old_st_to_new_map)
+    parser.add_argument("--sort-tileset", type=str, choices=['none', 'greedy', 'cluster', 'mst'], default='cluster',
+                    help="Method to sort the final tileset for visual coherence.\n"
+                            "  cluster (default): Groups tiles into visually similar clusters.\n"
+                            "  greedy: Creates a continuous chain of most-similar tiles.\n"
+                            "  mst: Walks a minimum spanning tree of nearest neighbours. Scales to thousands of items.\n"
+                            "  none: Disables sorting, uses arbitrary order.")
+    parser.add_argument("--sort-refine-seconds", type=float, default=0, metavar="S",
+                        help="Time budget for a 2-opt pass that shortens the sorted order (tiles and supertiles each). Default: 0 (off)")
+    parser.add_argument("--palette-search-seconds", type=float, default=0, metavar="S",
+                        help="Time budget for a multi-start local search over the 512 MSX colours that refines the\nauto palette slots by the error of sampled 8-pixel rows converted to two colours.\nRuns on --cores.\nDefault: 0 (off)")
+
+    palette_group = parser.add_argument_group('Palette Constraints', 
+        'Rules for controlling palette slots. Later rules override earlier ones.\n'
+        'Rule formats: "auto", "block", or a color like "700" (R=7, G=0, B=0).\n'
+        'Example: --palette-slot 0 700 --palette-slot 15 block')
+    palette_group.add_argument("--palette", help="Defines all 16 palette slots in a single comma-separated string.\nIf used, this overrides all other palette arguments.\nExample: \"700,auto,auto,block,...\"")
+    palette_group.add_argument("--palette-all-slots", metavar=('<RULE>'), default="auto", help="Baseline rule for all 16 slots.")
+    palette_group.add_argument("--palette-constraints-file", help="Path to a text file with palette rules (e.g., '0 700').")
+    palette_group.add_argument("--palette-slot", nargs=2, action='append', metavar=('<INDEX>', '<RULE>'), help="Set a rule for a specific slot. Can be used multiple times.")
+
+    args = parser.parse_args()
+
+    final_rules = process_palette_constraints(args)
+
+    original_pil_images = []
+    for input_image in args.input_images:
+        try:
+            original_pil_images.append(Image.open(input_image))
+        except FileNotFoundError:
+            print(f"Error: Input image '{input_image}' not found.")
+            return
+
+    image_names = [os.path.splitext(os.path.basename(input_image))[0] for input_image in args.input_images]
+    if len(image_names) == 1:
+        base_names = [args.output_basename or image_names[0]]
+    else:
+        # Every image gets its own project; images sharing a name are told apart by their position
+        base_names = [name if image_names.count(name) == 1 else f"{name}_{i}" for i, name in enumerate(image_names)]
+        if args.output_basename:
+            base_names = [f"{args.output_basename}_{name}" for name in base_names]
+
+    report = {} if args.report else None
+    start_wall, start_cpu = time.perf_counter(), process_cpu_seconds()
+    try:
+        results = convert_images(
+            original_pil_images, palette_rules=final_rules, max_tiles=args.max_tiles, dithering=not args.no_dithering,
+            cores=args.cores, color_metric=args.color_metric, supertile_width=args.supertile_width,
+            supertile_height=args.supertile_height, find_best_offset=args.find_best_offset,
+            offset_criterion=args.offset_criterion, best_color_pairs=args.best_color_pairs,
+            synthesize_tiles=args.synthesize_tiles, merge_costs=args.merge_costs, reduction_mode=args.reduction_mode,
+            ann_neighbors=args.ann_neighbors, max_memory=args.max_memory, optimization_mode=args.optimization_mode,
+            sort_tileset=args.sort_tileset, sort_refine_seconds=args.sort_refine_seconds,
+            palette_search_seconds=args.palette_search_seconds, cache_dir=args.cache_dir,
+            strip_rows=args.strip_rows, max_supertiles=args.max_supertiles, report=report)
+    except ValueError as e:
+        print(f"Error: {e}")
+        sys.exit(1)
 
     # --- 8. Generate Output Files ---
     print("8. Generating output files...")
+    mark_stage(report, "writing")
     os.makedirs(args.output_dir, exist_ok=True)
-    
-    final_palette_0_7 = [(0,0,0)] * 16
-    for i, slot_rule in enumerate(final_rules):
-        if slot_rule == 'block':
-            # red channel bit 7 is the flag for MSX Tile Forge to skip importing blocked slot
-            final_palette_0_7[i] = (128, 0, 0)
-    for i, color in enumerate(render_working_palette_0_7):
-        final_slot = working_to_final_map[i]
-        final_palette_0_7[final_slot] = color
-        
-    write_sc4_palette(f"{full_output_path}.SC4Pal", final_palette_0_7)
-    write_sc4_tiles(f"{full_output_path}.SC4Tiles", final_unique_patterns)
-    write_sc4_supertiles(f"{full_output_path}.SC4Super", supertile_definitions, args.supertile_width, args.supertile_height)
-    write_sc4_map(f"{full_output_path}.SC4Map", final_map_to_write, num_supertiles)
+    for base_name, result in zip(base_names, results):
+        write_sc4_project(os.path.join(args.output_dir, base_name), result)
 
     # --- 9. Generate Visual Outputs ---
     print("9. Generating visual outputs...")
-    final_pil_palette = [(0,0,0)] * 16
-    for i, color in enumerate(final_palette_0_7):
-        if color[0] < 128:
-            final_pil_palette[i] = (color[0]*255//7, color[1]*255//7, color[2]*255//7)
-    
-    pil_final_palette_flat = [c for rgb in final_pil_palette for c in rgb]
-    pil_final_palette_flat.extend([0,0,0] * (256-16))
-
-    reconstructed_img = Image.new('P', (img_width, img_height), color=0)
-    reconstructed_img.putpalette(pil_final_palette_flat)
-    for r_map in range(tile_map_height):
-        for c_map in range(tile_map_width):
-            pattern_idx = final_tile_map_indices[r_map, c_map]
-            if 0 <= pattern_idx < num_unique_base_patterns:
-                tile_to_paste = reconstruct_sc4_tile_pil(final_unique_patterns[pattern_idx][0], final_unique_patterns[pattern_idx][1], pil_final_palette_flat)
-                reconstructed_img.paste(tile_to_paste, (c_map * 8, r_map * 8))
-    reconstructed_img.save(f"{full_output_path}_reconstructed.png")
+    for base_name, result in zip(base_names, results):
+        full_output_path = os.path.join(args.output_dir, base_name)
+        reconstructed_img, tileset_vis = render_previews(result)
+        reconstructed_img.save(f"{full_output_path}_reconstructed.png")
+        tileset_vis.save(f"{full_output_path}_tileset.png")
+
+    if report is not None:
+        mark_stage(report, None)
+        for image_report, input_image in zip(report["result"]["images"], args.input_images):
+            image_report["image"] = input_image
+        stage_peaks = [timing["peak_rss_mb"] for timing in report["stages"].values() if timing["peak_rss_mb"] is not None]
+        report["total"] = {
+            "wall_seconds": time.perf_counter() - start_wall,
+            "cpu_seconds": process_cpu_seconds() - start_cpu,
+            "peak_rss_mb": max(stage_peaks) if stage_peaks else None,
+        }
+        with open(args.report, "w") as f:
+            json.dump(report, f, indent=2)
+        print(f"   [INFO] Report written to '{args.report}'.")
 
-    tiles_per_row = 16
-    num_rows = (num_unique_base_patterns + tiles_per_row - 1) // tiles_per_row
-    tileset_vis = Image.new('P', (tiles_per_row*8, num_rows*8), color=0)
-    tileset_vis.putpalette(pil_final_palette_flat)
-    for i, (p_data, c_data) in enumerate(final_unique_patterns):
-        r_vis, c_vis = divmod(i, tiles_per_row)
-        tile_to_paste = reconstruct_sc4_tile_pil(p_data, c_data, pil_final_palette_flat)
-        tileset_vis.paste(tile_to_paste, (c_vis * 8, r_vis * 8))
-    tileset_vis.save(f"{full_output_path}_tileset.png")
-    
     print("\nProcessing complete.")
 
 if __name__ == "__main__":
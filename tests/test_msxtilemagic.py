@@ -0,0 +1,135 @@
+# Regression checks for msxtilemagic.py. They run the converter on a small synthetic image, so its
+# requirements (numpy, scipy, Pillow, tqdm) must be installed. Run with: python -m pytest tests
+import hashlib
+import json
+import os
+import re
+import subprocess
+import sys
+import threading
+
+import numpy as np
+import pytest
+from PIL import Image
+
+SCRIPT = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "msxtilemagic.py")
+PROJECT_EXTENSIONS = ("SC4Pal", "SC4Tiles", "SC4Super", "SC4Map")
+
+# SHA-256 of the project files written before merge costs became incremental, per option set.
+# --merge-costs static must still produce them.
+BASELINE_DIGESTS = {
+    ("--max-tiles", "48"): {
+        "SC4Pal": "19ba3b8b3d2defc99356eea70b908ac38720fe93b56979e97c37ef85e7e8b9e4",
+        "SC4Tiles": "b7636aba40534ea6fa53a1bb090f71e1daf7bb7777775dbb5f03eb06ea012f00",
+        "SC4Super": "1c088526cf2bb6c35b950b80043e2b803527bdccfc9bfd7fb40d6112c3a96a86",
+        "SC4Map": "f42829f46a8cfa046ee0391567a76d928fc60a38c4a9ef28c476164cd50a3bea",
+    },
+    ("--max-tiles", "32", "--supertile-width", "2", "--supertile-height", "2", "--optimization-mode", "balanced", "--no-dithering"): {
+        "SC4Pal": "19ba3b8b3d2defc99356eea70b908ac38720fe93b56979e97c37ef85e7e8b9e4",
+        "SC4Tiles": "02df15348ac9b9ee0286b041fb41956332438bd39e1fd9901b9655630e43fe7d",
+        "SC4Super": "569b08ecb57722bfddb44911fc42b2dc112dd996966cae1ce966319fd536210d",
+        "SC4Map": "9210368f50de2d6d56ba7dc329eda587025e82d426e44a31230a7b942e11761b",
+    },
+    ("--max-tiles", "40", "--synthesize-tiles", "--sort-tileset", "greedy"): {
+        "SC4Pal": "19ba3b8b3d2defc99356eea70b908ac38720fe93b56979e97c37ef85e7e8b9e4",
+        "SC4Tiles": "6a8cb4d08a5def524ebfccd931930854ff3546a68866dbdd3f6e36931a759d13",
+        "SC4Super": "ff244d99736153ec9710c8f0ec9a8ef92c891b2d6542c54c084198f4d32840e2",
+        "SC4Map": "ebe1f187d1be48356c1c31fa91cf35446add40685e62efe1b00b43a1d08a0d3f",
+    },
+}
+
+@pytest.fixture(scope="module")
+def source_image(tmp_path_factory):
+    # Gradients plus integer hash noise: deterministic, with enough unique tiles that every run merges.
+    y, x = np.mgrid[0:96, 0:128]
+    noise = ((x * 73 + y * 151) * 2654435761 % 2**32) >> 26
+    rgb = np.stack([x * 2, y * 2 + noise, ((x // 16 + y // 16) % 4) * 60 + noise], axis=2)
+    path = tmp_path_factory.mktemp("source") / "source.png"
+    Image.fromarray(np.clip(rgb, 0, 255).astype(np.uint8)).save(path)
+    return path
+
+def convert(source_image, output_dir, *options):
+    # Runs the command line and returns its output; the project files are written to output_dir.
+    output_dir.mkdir(parents=True, exist_ok=True)
+    result = subprocess.run([sys.executable, SCRIPT, str(source_image), "--output-dir", str(output_dir), "--cores", "2", *options],
+                            capture_output=True, text=True)
+    assert result.returncode == 0, result.stdout + result.stderr
+    return result.stdout
+
+def project_files(output_dir):
+    return {extension: (output_dir / f"source.{extension}").read_bytes() for extension in PROJECT_EXTENSIONS}
+
+def num_supertiles(output_dir):
+    data = (output_dir / "source.SC4Super").read_bytes()
+    return int.from_bytes(data[1:3], 'little') if data[0] == 0 else data[0]
+
+@pytest.mark.parametrize("options", list(BASELINE_DIGESTS))
+def test_static_merge_costs_match_baseline(source_image, tmp_path, options):
+    convert(source_image, tmp_path, *options, "--merge-costs", "static")
+    digests = {extension: hashlib.sha256(data).hexdigest() for extension, data in project_files(tmp_path).items()}
+    assert digests == BASELINE_DIGESTS[options]
+
+def test_cluster_reduction_respects_tile_budget(source_image, tmp_path):
+    convert(source_image, tmp_path, "--max-tiles", "24", "--reduction-mode", "cluster")
+    assert (tmp_path / "source.SC4Tiles").read_bytes()[0] <= 24
+
+def test_mst_sort_only_reorders_tiles(source_image, tmp_path):
+    # Sorting permutes tiles and supertiles, so the reconstructed image must not change.
+    convert(source_image, tmp_path / "none", "--max-tiles", "48", "--sort-tileset", "none")
+    convert(source_image, tmp_path / "mst", "--max-tiles", "48", "--sort-tileset", "mst", "--sort-refine-seconds", "0.5")
+    assert (tmp_path / "mst" / "source_reconstructed.png").read_bytes() == (tmp_path / "none" / "source_reconstructed.png").read_bytes()
+    assert project_files(tmp_path / "mst") != project_files(tmp_path / "none")
+
+def test_convert_image_in_thread_without_console(source_image, tmp_path, monkeypatch):
+    # As in the editor's windowed build: the conversion runs off the main thread and sys.stderr is None.
+    monkeypatch.syspath_prepend(os.path.dirname(SCRIPT))
+    import msxtilemagic
+    monkeypatch.setattr(sys, "stderr", None)
+    progress, outcome = [], {}
+
+    def run():
+        try:
+            result = msxtilemagic.convert_image(Image.open(source_image), max_tiles=48, cores=2,
+                                                progress_callback=lambda stage, message: progress.append((stage, message)))
+            outcome["files"] = msxtilemagic.encode_sc4_project(result)
+        except Exception as e:
+            outcome["error"] = e
+
+    thread = threading.Thread(target=run)
+    thread.start()
+    thread.join()
+    monkeypatch.undo()
+    assert "error" not in outcome, outcome.get("error")
+    assert ("1", "Processing palette constraints...") in progress
+    assert any(stage is None and "[INFO]" in message for stage, message in progress)
+    convert(source_image, tmp_path, "--max-tiles", "48")
+    assert outcome["files"] == project_files(tmp_path)
+
+def test_cache_rerun_reuses_every_stage(source_image, tmp_path):
+    cache_dir = tmp_path / "cache"
+    convert(source_image, tmp_path / "first", "--max-tiles", "48", "--cache-dir", str(cache_dir))
+    entries = sorted(os.listdir(cache_dir))
+    output = convert(source_image, tmp_path / "second", "--max-tiles", "48", "--cache-dir", str(cache_dir))
+    assert entries and output.count("[INFO] Reusing cached") == len(entries)
+    assert sorted(os.listdir(cache_dir)) == entries
+    assert project_files(tmp_path / "second") == project_files(tmp_path / "first")
+
+def test_streamed_strips_match_whole_image(source_image, tmp_path):
+    convert(source_image, tmp_path / "whole", "--max-tiles", "48", "--no-dithering")
+    convert(source_image, tmp_path / "strips", "--max-tiles", "48", "--no-dithering", "--strip-rows", "5")
+    assert project_files(tmp_path / "strips") == project_files(tmp_path / "whole")
+
+@pytest.mark.parametrize("budget", [3, 10])
+def test_supertile_budget_is_respected(source_image, tmp_path, budget):
+    convert(source_image, tmp_path / "free", "--max-tiles", "48", "--supertile-width", "2", "--supertile-height", "2")
+    convert(source_image, tmp_path / "budget", "--max-tiles", "48", "--supertile-width", "2", "--supertile-height", "2",
+            "--max-supertiles", str(budget))
+    assert num_supertiles(tmp_path / "free") > budget
+    assert num_supertiles(tmp_path / "budget") <= budget
+
+def test_palette_search_stays_in_budget_and_keeps_error(source_image, tmp_path):
+    report_path = tmp_path / "report.json"
+    output = convert(source_image, tmp_path, "--max-tiles", "48", "--palette-search-seconds", "1", "--report", str(report_path))
+    seed_error, best_error = map(float, re.search(r"row error per pixel (\d+\.\d+) -> (\d+\.\d+)", output).groups())
+    assert best_error <= seed_error
+    assert json.loads(report_path.read_text())["stages"]["palette"]["wall_seconds"] < 2.0